@@ -0,0 +1,120 @@
+"""
+Static web frontend.
+
+The files in `static/` are loaded once per process, compressed with gzip
+(and brotli, when the `brotli` package is installed) and served from
+memory. `{{ static:<name> }}` placeholders in `index.html` are replaced by
+asset URLs that carry a content hash, so assets can be cached by browsers
+for good, while the page itself is revalidated through its ETag.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from typing import Dict, Optional
+
+from fastapi import APIRouter, Request
+from fastapi.responses import Response
+
+from utils.logger import logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "static")
+
+_IMMUTABLE = "public, max-age=31536000, immutable"
+_REVALIDATE = "no-cache"
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class StaticAsset(object):
+
+    def __init__(self, content: bytes, media_type: str):
+        self.content = content
+        self.media_type = media_type
+        self.version = hashlib.sha256(content).hexdigest()[:16]
+        self.etag = f'"{self.version}"'
+        self.encodings: Dict[str, bytes] = {}
+        if media_type.startswith(_COMPRESSIBLE) and len(content) > 512:
+            if brotli is not None:
+                self.encodings["br"] = brotli.compress(content, quality=11)
+            self.encodings["gzip"] = gzip.compress(content, compresslevel=9, mtime=0)
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": cache_control,
+                   "Vary": "Accept-Encoding"}
+        if self.etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+
+        content = self.content
+        accepted = request.headers.get("accept-encoding", "")
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and encoding in accepted:
+                content = self.encodings[encoding]
+                headers["Content-Encoding"] = encoding
+                break
+        return Response(content=content, media_type=self.media_type, headers=headers)
+
+
+class StaticSite(object):
+    """The assets of `directory`, with `index.html` as the page served at '/'."""
+
+    def __init__(self, directory: str):
+        self.assets: Dict[str, StaticAsset] = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, directory).replace(os.sep, "/")
+                if relative == "index.html":
+                    continue
+                media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                with open(path, "rb") as f:
+                    self.assets[relative] = StaticAsset(f.read(), media_type)
+
+        with open(os.path.join(directory, "index.html"), encoding="utf-8") as f:
+            page = re.sub(r"\{\{\s*static:(\S+?)\s*\}\}",
+                          lambda match: self.url(match.group(1)), f.read())
+        self.index = StaticAsset(page.encode("utf-8"), "text/html; charset=utf-8")
+        logger.info("Loaded %d static assets", len(self.assets) + 1)
+
+    def url(self, name: str) -> str:
+        return f"/static/{name}?v={self.assets[name].version}"
+
+    def asset(self, name: str) -> Optional[StaticAsset]:
+        return self.assets.get(name)
+
+
+_site = None
+
+
+def get_site() -> StaticSite:
+    global _site
+    if _site is None:
+        _site = StaticSite(STATIC_DIR)
+    return _site
+
+
+frontend_router = APIRouter()
+
+
+@frontend_router.get("/", include_in_schema=False)
+async def read_root(request: Request):
+    return get_site().index.response(request, _REVALIDATE)
+
+
+@frontend_router.get("/static/{name:path}", include_in_schema=False)
+async def static_asset(name: str, request: Request):
+    site = get_site()
+    asset = site.asset(name)
+    if asset is None:
+        return Response(status_code=404)
+    # Versioned URLs change with the content, so they never go stale
+    immutable = request.query_params.get("v") == asset.version
+    return asset.response(request, _IMMUTABLE if immutable else _REVALIDATE)
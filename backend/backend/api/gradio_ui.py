@@ -0,0 +1,129 @@
+"""
+Gradio demo UI.
+
+The UI only talks to the backend's HTTP API at `GRADIO_BACKEND_URL`, so it
+can run as a separate service, keeping Gradio out of the backend workers:
+
+    python -m api.gradio_ui
+
+It can also be mounted into the backend at `/gradio` with `GRADIO_ENABLED`.
+"""
+import os
+
+import gradio as gr
+import httpx
+
+from config import settings
+
+
+async def _post(path, payload):
+    # All Gradio users share the quota of the UI's own API key
+    api_key = os.getenv("GRADIO_API_KEY")
+    headers = {"X-API-Key": api_key} if api_key else {}
+    async with httpx.AsyncClient(base_url=settings.GRADIO_BACKEND_URL,
+                                 headers=headers, timeout=None) as client:
+        response = await client.post(path, json=payload)
+        response.raise_for_status()
+        return response.json()["text"]
+
+
+async def research_assistant(text):
+    return await _post("/test", {"text": text})
+
+
+async def joke_generator(text):
+    return await _post("/joke", {"text": text})
+
+
+async def query_python_agent(text):
+    return await _post("/query", {"text": text})
+
+
+async def find_events(location, date):
+    return await _post("/events", {"location": location, "date": date})
+
+
+async def github_comment(repo, pr_number, request):
+    return await _post("/github_comment",
+                       {"repo": repo, "pr_number": int(pr_number), "comment": request})
+
+
+async def github_pr(repo, pr_number):
+    return await _post("/github_review", {"repo": repo, "pr_number": int(pr_number)})
+
+
+with gr.Blocks() as gradio_routes:
+    gr.Markdown("# LLM Assistant demo")
+    gr.Markdown("## Research Assistant")
+    with gr.Row():
+        with gr.Column():
+            research_input = gr.Textbox(label="Enter your topic here")
+            research_button = gr.Button("Research")
+        with gr.Column():
+            research_output = gr.Textbox(label="Response")
+    research_button.click(research_assistant,
+                          inputs=research_input, outputs=research_output)
+
+    gr.Markdown("## Joke Generator")
+    with gr.Row():
+        with gr.Column():
+            joke_input = gr.Textbox(label="Enter your subject here")
+            joke_button = gr.Button("Tell Joke")
+        with gr.Column():
+            joke_output = gr.Textbox(label="Response")
+    joke_button.click(joke_generator, inputs=joke_input, outputs=joke_output)
+
+    gr.Markdown("## Query Python Agent")
+    with gr.Row():
+        with gr.Column():
+            query_input = gr.Textbox(label="Enter your query here")
+            query_button = gr.Button("Query")
+        with gr.Column():
+            query_output = gr.Textbox(label="Response")
+    query_button.click(query_python_agent,
+                       inputs=query_input, outputs=query_output)
+
+    gr.Markdown("## Find Events")
+    with gr.Row():
+        with gr.Column():
+            location_input = gr.Textbox(label="Enter your location here")
+            date_input = gr.Textbox(label="Enter your date here")
+            events_button = gr.Button("Get Events")
+        with gr.Column():
+            events_output = gr.Textbox(label="Response")
+    events_button.click(find_events, inputs=[
+                        location_input, date_input], outputs=events_output)
+
+    gr.Markdown("## GitHub Comment")
+    with gr.Row():
+        with gr.Column():
+            repo_input = gr.Textbox(label="Enter the repository here")
+            pr_number_input = gr.Textbox(
+                label="Enter the pull request number here")
+            request_input = gr.Textbox(label="Enter your comment request here")
+            github_comment_button = gr.Button("Add Comment")
+        with gr.Column():
+            github_comment_output = gr.Textbox(label="Response")
+    github_comment_button.click(github_comment, inputs=[
+                                repo_input, pr_number_input, request_input],
+                                outputs=github_comment_output)
+
+    gr.Markdown("## GitHub PR Review")
+    with gr.Row():
+        with gr.Column():
+            repo_input = gr.Textbox(label="Enter the repository here")
+            pr_number_input = gr.Textbox(
+                label="Enter the pull request number here")
+            github_pr_button = gr.Button("Review PR")
+        with gr.Column():
+            github_pr_output = gr.Textbox(label="Response")
+    github_pr_button.click(github_pr, inputs=[
+        repo_input, pr_number_input],
+        outputs=github_pr_output)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    load_dotenv("secrets/.env")
+    gradio_routes.launch(server_name="0.0.0.0", server_port=7860)
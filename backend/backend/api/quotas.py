@@ -0,0 +1,136 @@
+"""
+User identity and rate limiting of the API endpoints.
+
+Users are identified by an API key, sent as `X-API-Key` or as a bearer
+token. Keys are configured in the `API_KEYS` secret as comma-separated
+`user:key` pairs; without it, the API is open and not rate limited, as
+client addresses behind a proxy do not tell users apart. Endpoints listed
+in `RATE_LIMIT_COSTS` draw from the user's token buckets (see
+`utils.ratelimit`) and answer 429 with a `Retry-After` header when the
+user is out of quota. A batch is charged per item; one costing more than
+the burst is admitted with a full bucket and leaves the rest as debt. The
+buckets live in SQLite, so they are updated in worker threads.
+
+This is a plain ASGI middleware rather than a dependency, so the LLM tokens
+of streamed batch responses are counted too.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+from config import settings
+from utils.logger import logger
+from utils.metrics import RATE_LIMIT_DECISIONS, span
+from utils.ratelimit import get_rate_limiter
+
+
+_api_keys: Dict[str, Dict[str, str]] = {}
+
+
+def _users_by_key() -> Dict[str, str]:
+    """Users by the SHA-256 of their API key, parsed from `API_KEYS`."""
+    value = os.getenv("API_KEYS", "")
+    if value not in _api_keys:
+        users = {}
+        for pair in value.split(","):
+            user, _, key = pair.strip().partition(":")
+            if user and key:
+                users[hashlib.sha256(key.encode("utf-8")).hexdigest()] = user
+        _api_keys.clear()
+        _api_keys[value] = users
+    return _api_keys[value]
+
+
+def identify(headers: Headers) -> Optional[str]:
+    """The user making a request, or None if it lacks a valid API key."""
+    users = _users_by_key()
+    key = headers.get("x-api-key")
+    if key is None:
+        scheme, _, credentials = headers.get("authorization", "").partition(" ")
+        key = credentials if scheme.lower() == "bearer" else None
+    if not key:
+        return None
+    return users.get(hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+
+async def _buffer_body(receive):
+    """Read the whole request body; returns it and a `receive` replaying it."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body = b"".join(chunks)
+    replayed = False
+
+    async def replay():
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return body, replay
+
+
+def _batch_size(body: bytes) -> int:
+    try:
+        items = json.loads(body).get("items")
+    except (ValueError, AttributeError):
+        return 1
+    return max(len(items), 1) if isinstance(items, list) else 1
+
+
+class QuotaMiddleware(object):
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path")
+        if (scope["type"] != "http" or not settings.RATE_LIMIT_ENABLED
+                or path not in settings.RATE_LIMIT_COSTS or not _users_by_key()):
+            await self.app(scope, receive, send)
+            return
+
+        user = identify(Headers(scope=scope))
+        if user is None:
+            RATE_LIMIT_DECISIONS.labels(path, "unauthorized").inc()
+            response = JSONResponse({"detail": "Invalid or missing API key"}, status_code=401,
+                                    headers={"WWW-Authenticate": "Bearer"})
+            await response(scope, receive, send)
+            return
+
+        cost = settings.RATE_LIMIT_COSTS[path]
+        if path.endswith("/batch"):
+            body, receive = await _buffer_body(receive)
+            cost *= _batch_size(body)
+
+        limiter = get_rate_limiter()
+        retry_after = await asyncio.to_thread(limiter.acquire, user, cost)
+        if retry_after:
+            RATE_LIMIT_DECISIONS.labels(path, "limited").inc()
+            logger.info("Rate limited %s on %s for %.1fs", user, path, retry_after)
+            response = JSONResponse({"detail": "Rate limit exceeded"}, status_code=429,
+                                    headers={"Retry-After": str(math.ceil(retry_after))})
+            await response(scope, receive, send)
+            return
+
+        RATE_LIMIT_DECISIONS.labels(path, "admitted").inc()
+        # LLM calls made for the request add their tokens to this span
+        with span("request", path) as record:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                await asyncio.to_thread(limiter.charge, user,
+                                        record.prompt_tokens + record.completion_tokens)
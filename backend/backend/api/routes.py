@@ -1,17 +1,26 @@
-from typing import Annotated
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import urllib.parse
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import HTMLResponse
+from typing import Annotated, AsyncIterator, Optional
 
-import gradio as gr
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                               generate_latest, multiprocess)
 
 from core.context import Context
 from services.business_logic import \
     get_test_result, get_joke, get_events, get_query_result, add_github_comment, \
-    review_github_pr
+    review_github_pr, get_jokes, get_events_batch, get_query_results, BatchResult
+from services.review_queue import get_review_queue, handle_pull_request_event
 
-from utils.logger import logger
-from .schemas import QueryRequestSchema, EventsRequestSchema, ResponseSchema, GitHubCommentRequestSchema
+from utils.logger import logger, truncate
+from .schemas import QueryRequestSchema, EventsRequestSchema, ResponseSchema, GitHubCommentRequestSchema, \
+    GitHubReviewRequestSchema, BatchQueryRequestSchema, BatchEventsRequestSchema, BatchItemResponseSchema
 
 
 api_router = APIRouter()
@@ -21,7 +30,7 @@ api_router = APIRouter()
 async def test_request(
     request: QueryRequestSchema, context: Annotated[Context, Depends()]
 ) -> ResponseSchema:
-    logger.info(f"Called endpoint /test with request: {request}")
+    logger.info("Called endpoint /test with request: %s", truncate(request))
     response = await get_test_result(context, request.text)
     return {"text": response}
 
@@ -30,7 +39,7 @@ async def test_request(
 async def joke_request(
     request: QueryRequestSchema, context: Annotated[Context, Depends()]
 ) -> ResponseSchema:
-    logger.info(f"Called endpoint /joke with request: {request}")
+    logger.info("Called endpoint /joke with request: %s", truncate(request))
     response = await get_joke(context, request.text)
     return {"text": response}
 
@@ -39,7 +48,7 @@ async def joke_request(
 async def query_request(
     request: QueryRequestSchema, context: Annotated[Context, Depends()]
 ) -> ResponseSchema:
-    logger.info(f"Called endpoint /query with request: {request}")
+    logger.info("Called endpoint /query with request: %s", truncate(request))
     response = await get_query_result(context, request.text)
     return {"text": response}
 
@@ -48,323 +57,113 @@ async def query_request(
 async def events_request(
     request: EventsRequestSchema, context: Annotated[Context, Depends()]
 ) -> ResponseSchema:
-    logger.info(f"Called endpoint /events with request: {request}")
+    logger.info("Called endpoint /events with request: %s", truncate(request))
     response = await get_events(context, request.location, request.date)
     return {"text": response}
 
 
+async def _ndjson(results: AsyncIterator[BatchResult]):
+    async for index, result in results:
+        if isinstance(result, Exception):
+            logger.warning("Batch item %d failed: %r", index, result)
+            item = BatchItemResponseSchema(index=index, error=repr(result))
+        else:
+            item = BatchItemResponseSchema(index=index, text=result)
+        yield item.model_dump_json(exclude_none=True) + "\n"
+
+
+@api_router.post("/joke/batch")
+async def joke_batch_request(
+    request: BatchQueryRequestSchema, context: Annotated[Context, Depends()]
+) -> StreamingResponse:
+    logger.info("Called endpoint /joke/batch with %d items", len(request.items))
+    results = get_jokes(context, [item.text for item in request.items],
+                        request.concurrency)
+    return StreamingResponse(_ndjson(results), media_type="application/x-ndjson")
+
+
+@api_router.post("/query/batch")
+async def query_batch_request(
+    request: BatchQueryRequestSchema, context: Annotated[Context, Depends()]
+) -> StreamingResponse:
+    logger.info("Called endpoint /query/batch with %d items", len(request.items))
+    results = get_query_results(context, [item.text for item in request.items],
+                                request.concurrency)
+    return StreamingResponse(_ndjson(results), media_type="application/x-ndjson")
+
+
+@api_router.post("/events/batch")
+async def events_batch_request(
+    request: BatchEventsRequestSchema, context: Annotated[Context, Depends()]
+) -> StreamingResponse:
+    logger.info("Called endpoint /events/batch with %d items", len(request.items))
+    results = get_events_batch(
+        context, [(item.location, item.date) for item in request.items],
+        request.concurrency)
+    return StreamingResponse(_ndjson(results), media_type="application/x-ndjson")
+
+
 @api_router.post("/github_comment")
 async def github_comment_request(
     request: GitHubCommentRequestSchema, context: Annotated[Context, Depends()]
 ) -> ResponseSchema:
-    logger.info(f"Called endpoint /github_comment with request: {request}")
+    logger.info("Called endpoint /github_comment with request: %s", truncate(request))
     response = await add_github_comment(context, request.repo, request.pr_number, request.comment)
     return {"text": response}
 
 
-@api_router.get("/", response_class=HTMLResponse)
-async def read_root():
-    html_content = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>LLM Application</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            margin: 20px;
-            background-color: #121212;
-            color: #e0e0e0;
-        }
-        h1 {
-            color: #ffffff;
-            font-size: 24px;
-        }
-        input[type="text"] {
-            width: 100%;
-            max-width: 500px;
-            padding: 12px;
-            margin: 12px 0;
-            box-sizing: border-box;
-            font-size: 16px;
-            background-color: #333;
-            color: #e0e0e0;
-            border: 1px solid #555;
-            border-radius: 5px;
-        }
-        button {
-            padding: 12px 24px;
-            margin: 12px 0;
-            font-size: 16px;
-            background-color: #1f8e3f;
-            color: #ffffff;
-            border: none;
-            cursor: pointer;
-            border-radius: 5px;
-            transition: background-color 0.3s ease;
-        }
-        button:hover {
-            background-color: #176a2d;
-        }
-        .response-container {
-            margin-top: 20px;
-            position: relative;
-            max-width: 600px;
-        }
-        #responseText {
-            padding: 15px;
-            font-size: 16px;
-            background-color: #333;
-            color: #e0e0e0;
-            border: 1px solid #555;
-            border-radius: 5px;
-            max-height: 300px;
-            overflow-y: auto;
-            white-space: pre-wrap;
-            word-wrap: break-word;
-            resize: vertical;
-        }
-        .toggle-wrap-btn, .copy-btn {
-            padding: 5px 10px;
-            font-size: 14px;
-            color: #e0e0e0;
-            background-color: #555;
-            border: none;
-            border-radius: 5px;
-            cursor: pointer;
-            margin-right: 5px;
-        }
-        .toggle-wrap-btn:hover, .copy-btn:hover {
-            background-color: #777;
-        }
-        .controls {
-            display: flex;
-            margin-top: 10px;
-        }
-    </style>
-</head>
-<body>
-    <h1>Research assistant</h1>
-    <input type="text" id="testInputText" placeholder="Enter your topic here">
-    <button onclick="getTestOutput()">Research</button>
-
-    <h1>Joke Generator</h1>
-    <input type="text" id="jokeInputText" placeholder="Enter your subject here">
-    <button onclick="tellJoke()">Tell Joke</button>
-
-    <h1>Query Python Agent</h1>
-    <input type="text" id="queryText" placeholder="Enter your query here">
-    <button onclick="query()">Query</button>
-
-    <h1>Find Events</h1>
-    <input type="text" id="locationInputText" placeholder="Enter your location here">
-    <input type="text" id="dateInputText" placeholder="Enter your date here">
-    <button onclick="getEvents()">Get Events</button>
-
-    <h1>GitHub Comment</h1>
-    <input type="text" id="repoInputText" placeholder="Enter the repository here">
-    <input type="text" id="prNumberInputText" placeholder="Enter the pull request number here">
-    <input type="text" id="commentInputText" placeholder="Enter your comment here">
-    <button onclick="addGitHubComment()">Add Comment</button>
-
-    <div class="response-container">
-        <div id="responseText">Your response will appear here...</div>
-        <div class="controls">
-            <button class="toggle-wrap-btn" onclick="toggleWordWrap()">Toggle Word Wrap</button>
-            <button class="copy-btn" onclick="copyToClipboard()">Copy to Clipboard</button>
-        </div>
-    </div>
-
-    <script>
-        function toggleWordWrap() {
-            const responseText = document.getElementById('responseText');
-            if (responseText.style.whiteSpace === 'pre-wrap') {
-                responseText.style.whiteSpace = 'pre';
-                responseText.style.wordWrap = 'normal';
-            } else {
-                responseText.style.whiteSpace = 'pre-wrap';
-                responseText.style.wordWrap = 'break-word';
-            }
-        }
-
-        function copyToClipboard() {
-            const responseText = document.getElementById('responseText').innerText;
-            navigator.clipboard.writeText(responseText)
-                .then(() => alert("Copied to clipboard!"))
-                .catch(() => alert("Failed to copy."));
-        }
-    </script>
-
-    <script>
-        async function getTestOutput() {
-            const testInputText = document.getElementById('testInputText').value;
-            const response = await fetch('/test', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ text: testInputText })
-            });
-            const data = await response.json();
-            document.getElementById('responseText').innerText = data.text;
-        }
-
-        async function tellJoke() {
-            const jokeInputText = document.getElementById('jokeInputText').value;
-            const response = await fetch('/joke', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ text: jokeInputText })
-            });
-            const data = await response.json();
-            document.getElementById('responseText').innerText = data.text;
-        }
-
-        async function query() {
-            const queryText = document.getElementById('queryText').value;
-            const response = await fetch('/query', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ text: queryText })
-            });
-            const data = await response.json();
-            document.getElementById('responseText').innerText = data.text;
-        }
-
-        async function getEvents() {
-            const locationInputText = document.getElementById('locationInputText').value;
-            const dateInputText = document.getElementById('dateInputText').value;
-            const response = await fetch('/events', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ location: locationInputText, date: dateInputText })
-            });
-            const data = await response.json();
-            document.getElementById('responseText').innerText = data.text;
-        }
-
-        async function addGitHubComment() {
-            const repoInputText = document.getElementById('repoInputText').value;
-            const prNumberInputText = document.getElementById('prNumberInputText').value;
-            const commentInputText = document.getElementById('commentInputText').value;
-            const response = await fetch('/github_comment', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ repo: repoInputText, pr_number: prNumberInputText, comment: commentInputText })
-            });
-            const data = await response.json();
-            document.getElementById('responseText').innerText = data.text;
-        }
-    </script>
-</body>
-</html>
-    """
-    return HTMLResponse(content=html_content)
-
-
-async def research_assistant(text):
-    response = await get_test_result(Context(), text)
-    return response
-
-
-async def joke_generator(text):
-    response = await get_joke(Context(), text)
-    return response
-
-
-async def query_python_agent(text):
-    response = await get_query_result(Context(), text)
-    return response
-
-
-async def find_events(location, date):
-    response = await get_events(Context(), location, date)
-    return response
-
-
-async def github_comment(repo, pr_number, request):
-    response = await add_github_comment(Context(), repo, pr_number, request)
-    return response
-
-
-async def github_pr(repo, pr_number):
-    response = await review_github_pr(Context(), repo, int(pr_number))
-    return response
-
-
-with gr.Blocks() as gradio_routes:
-    gr.Markdown("# LLM Assistant demo")
-    gr.Markdown("## Research Assistant")
-    with gr.Row():
-        with gr.Column():
-            research_input = gr.Textbox(label="Enter your topic here")
-            research_button = gr.Button("Research")
-        with gr.Column():
-            research_output = gr.Textbox(label="Response")
-    research_button.click(research_assistant,
-                          inputs=research_input, outputs=research_output)
-
-    gr.Markdown("## Joke Generator")
-    with gr.Row():
-        with gr.Column():
-            joke_input = gr.Textbox(label="Enter your subject here")
-            joke_button = gr.Button("Tell Joke")
-        with gr.Column():
-            joke_output = gr.Textbox(label="Response")
-    joke_button.click(joke_generator, inputs=joke_input, outputs=joke_output)
-
-    gr.Markdown("## Query Python Agent")
-    with gr.Row():
-        with gr.Column():
-            query_input = gr.Textbox(label="Enter your query here")
-            query_button = gr.Button("Query")
-        with gr.Column():
-            query_output = gr.Textbox(label="Response")
-    query_button.click(query_python_agent,
-                       inputs=query_input, outputs=query_output)
-
-    gr.Markdown("## Find Events")
-    with gr.Row():
-        with gr.Column():
-            location_input = gr.Textbox(label="Enter your location here")
-            date_input = gr.Textbox(label="Enter your date here")
-            events_button = gr.Button("Get Events")
-        with gr.Column():
-            events_output = gr.Textbox(label="Response")
-    events_button.click(find_events, inputs=[
-                        location_input, date_input], outputs=events_output)
-
-    gr.Markdown("## GitHub Comment")
-    with gr.Row():
-        with gr.Column():
-            repo_input = gr.Textbox(label="Enter the repository here")
-            pr_number_input = gr.Textbox(
-                label="Enter the pull request number here")
-            request_input = gr.Textbox(label="Enter your comment request here")
-            github_comment_button = gr.Button("Add Comment")
-        with gr.Column():
-            github_comment_output = gr.Textbox(label="Response")
-    github_comment_button.click(github_comment, inputs=[
-                                repo_input, pr_number_input, request_input],
-                                outputs=github_comment_output)
-
-    gr.Markdown("## GitHub PR Review")
-    with gr.Row():
-        with gr.Column():
-            repo_input = gr.Textbox(label="Enter the repository here")
-            pr_number_input = gr.Textbox(
-                label="Enter the pull request number here")
-            github_pr_button = gr.Button("Review PR")
-        with gr.Column():
-            github_pr_output = gr.Textbox(label="Response")
-    github_pr_button.click(github_pr, inputs=[
-        repo_input, pr_number_input],
-        outputs=github_pr_output)
+@api_router.post("/github_review")
+async def github_review_request(
+    request: GitHubReviewRequestSchema, context: Annotated[Context, Depends()]
+) -> ResponseSchema:
+    logger.info("Called endpoint /github_review with request: %s", truncate(request))
+    response = await review_github_pr(context, request.repo, request.pr_number)
+    return {"text": str(response)}
+
+
+def _verify_github_signature(secret: str, body: bytes, signature: Optional[str]):
+    expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    if not signature or not hmac.compare_digest(expected, signature):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+
+
+@api_router.post("/github/webhook", status_code=202)
+async def github_webhook(
+    request: Request,
+    x_github_event: Annotated[str, Header()] = "",
+    x_hub_signature_256: Annotated[Optional[str], Header()] = None,
+):
+    secret = os.getenv("GITHUB_WEBHOOK_SECRET")
+    if not secret:
+        raise HTTPException(status_code=503, detail="Webhook not configured")
+    body = await request.body()
+    _verify_github_signature(secret, body, x_hub_signature_256)
+
+    if x_github_event != "pull_request":
+        logger.info("Ignoring GitHub %s event", x_github_event)
+        return {"status": "ignored"}
+    try:
+        if request.headers.get("content-type", "").startswith(
+                "application/x-www-form-urlencoded"):
+            # Webhooks can be configured to send the JSON as a form field
+            form = urllib.parse.parse_qs(body.decode("utf-8"))
+            payload = json.loads(form["payload"][0])
+        else:
+            payload = json.loads(body)
+        status = await asyncio.to_thread(
+            lambda: handle_pull_request_event(get_review_queue(), payload))
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid webhook payload: {e}")
+    logger.info("GitHub pull_request event: %s", status)
+    return {"status": status}
+
+
+@api_router.get("/metrics")
+async def metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Aggregate the metrics of all gunicorn workers
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(content=generate_latest(registry),
+                        media_type=CONTENT_TYPE_LATEST)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+from config import settings
 
 
 class QueryRequestSchema(BaseModel):
@@ -18,3 +21,29 @@ class GitHubCommentRequestSchema(BaseModel):
     repo: str
     pr_number: int
     comment: str
+
+
+class GitHubReviewRequestSchema(BaseModel):
+    repo: str
+    pr_number: int
+
+
+class BatchQueryRequestSchema(BaseModel):
+    items: List[QueryRequestSchema] = Field(
+        ..., min_length=1, max_length=settings.BATCH_MAX_ITEMS)
+    concurrency: int = Field(settings.BATCH_CONCURRENCY, ge=1,
+                             le=settings.BATCH_CONCURRENCY)
+
+
+class BatchEventsRequestSchema(BaseModel):
+    items: List[EventsRequestSchema] = Field(
+        ..., min_length=1, max_length=settings.BATCH_MAX_ITEMS)
+    concurrency: int = Field(settings.BATCH_CONCURRENCY, ge=1,
+                             le=settings.BATCH_CONCURRENCY)
+
+
+class BatchItemResponseSchema(BaseModel):
+    """One NDJSON line of a batch response; `index` refers to the request item."""
+    index: int
+    text: Optional[str] = None
+    error: Optional[str] = None
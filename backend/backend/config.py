@@ -1,9 +1,139 @@
+from pydantic import BaseModel, field_validator
 from pydantic_settings import BaseSettings
+from typing import Dict, List, Literal, Optional, Union
+
+
+class GenerationProfile(BaseModel):
+    """Ollama generation parameters; unset values fall back to the "default" profile."""
+    num_predict: Optional[int] = None
+    num_ctx: Optional[int] = None
+    stop: Optional[List[str]] = None
+    keep_alive: Optional[Union[int, str]] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    top_k: Optional[int] = None
+    repeat_penalty: Optional[float] = None
+    seed: Optional[int] = None
 
 
 class Settings(BaseSettings):
     OLLAMA_ENDPOINT: str = "http://ollama:7869"
     OLLAMA_MODEL: str = "qwen2.5-coder:32b"
+    OLLAMA_EMBEDDING_MODEL: str = "nomic-embed-text"
+    TAVILY_ENDPOINT: str = "https://api.tavily.com"
+    GITHUB_ENDPOINT: str = "https://api.github.com"
+
+    GRADIO_ENABLED: bool = False
+    GRADIO_BACKEND_URL: str = "http://localhost:8000"
+
+    # Generation parameters per chain and agent, see `GenerationProfile`. All
+    # profiles use the same model, and Ollama reloads a model whenever the
+    # context size changes, so `num_ctx` is set in the "default" profile only
+    GENERATION_PROFILES: Dict[str, GenerationProfile] = {
+        "default": GenerationProfile(num_predict=1024, num_ctx=8192, keep_alive="5m"),
+        "joke": GenerationProfile(num_predict=200, temperature=0.9),
+        "queries": GenerationProfile(num_predict=300, temperature=0.1),
+        "summary": GenerationProfile(num_predict=1500, temperature=0.3),
+        "review": GenerationProfile(num_predict=800, temperature=0.1),
+        "events": GenerationProfile(num_predict=1024, temperature=0.3),
+        "python": GenerationProfile(num_predict=768, temperature=0.1),
+        "github_comment": GenerationProfile(num_predict=512, temperature=0.3),
+    }
+
+    # Loaded models are kept alive by `ModelKeeper` (see core/ollama.py)
+    OLLAMA_KEEPER_ENABLED: bool = True
+    OLLAMA_KEEPER_INTERVAL: float = 30.0
+    OLLAMA_KEEP_ALIVE_MIN: int = 300
+    OLLAMA_KEEP_ALIVE_MAX: int = 4 * 3600
+    OLLAMA_MEMORY_BUDGET: int = 0
+
+    WORKERS: int = 1
+    STATE_DIR: str = "/tmp/llm-assistant"
+    MODEL_READY_TTL: int = 3600
+
+    BATCH_MAX_ITEMS: int = 1000
+    BATCH_CONCURRENCY: int = 4
+
+    SEMANTIC_CACHE_ENABLED: bool = False
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95
+    SEMANTIC_CACHE_TTL: Dict[str, int] = {"query": 86400, "events": 3600, "test": 86400}
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 10000
+
+    RETRIEVAL_ENABLED: bool = False
+    RETRIEVAL_TOP_K: int = 4
+    RETRIEVAL_CHUNK_SIZE: int = 1000
+    RETRIEVAL_CHUNK_OVERLAP: int = 100
+    RETRIEVAL_BATCH_SIZE: int = 32
+    RETRIEVAL_MAX_CHUNKS: int = 200000
+
+    OLLAMA_TIMEOUT: float = 300.0
+    TAVILY_TIMEOUT: float = 30.0
+    GITHUB_TIMEOUT: float = 30.0
+    UPSTREAM_CONNECT_TIMEOUT: float = 5.0
+    UPSTREAM_RETRIES: int = 2
+    UPSTREAM_BACKOFF: float = 0.5
+    UPSTREAM_BACKOFF_MAX: float = 8.0
+    UPSTREAM_RETRY_BUDGET: int = 10
+    CIRCUIT_FAILURE_THRESHOLD: int = 5
+    CIRCUIT_RESET_TIMEOUT: float = 30.0
+
+    AGENT_MAX_STEPS: int = 8
+    AGENT_TIMEOUT: float = 120.0
+    AGENT_MAX_REPEATED_CALLS: int = 2
+    # Part of AGENT_TIMEOUT kept for the answer of a run that was stopped early
+    AGENT_FINAL_ANSWER_TIMEOUT: float = 20.0
+
+    REVIEW_DEBOUNCE: float = 30.0
+    REVIEW_CONCURRENCY: int = 2
+    REVIEW_TIMEOUT: float = 1800.0
+    REVIEW_MAX_ATTEMPTS: int = 3
+
+    GITHUB_CACHE_MAX_SIZE: int = 512 * 1024 * 1024
+
+    # Comments this similar (by words) to an earlier one of the same account
+    # are not posted
+    GITHUB_COMMENT_SIMILARITY: float = 0.85
+
+    SYMBOL_INDEX_ENABLED: bool = True
+    SYMBOL_INDEX_MAX_FETCH: int = 200
+    SYMBOL_INDEX_MAX_FILE_SIZE: int = 200000
+    SYMBOL_CONTEXT_MAX_LINES: int = 150
+
+    TRACE_ENABLED: bool = True
+    TRACE_RETENTION_DAYS: float = 7.0
+    # Longer inputs are recorded cut to this many characters, with their hash
+    TRACE_MAX_INPUT_CHARS: int = 2000
+    # Tool outputs are cut short the same way, unless recorded in full
+    TRACE_TOOL_OUTPUTS: bool = False
+
+    # Per-user token buckets; costs are request units per call, or per item
+    # of a batch call. Users are identified by the keys in the API_KEYS secret;
+    # without keys, the API is not rate limited
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_REQUESTS_PER_MINUTE: float = 30.0
+    RATE_LIMIT_REQUEST_BURST: float = 60.0
+    RATE_LIMIT_TOKENS_PER_MINUTE: float = 20000.0
+    RATE_LIMIT_TOKEN_BURST: float = 100000.0
+    RATE_LIMIT_COSTS: Dict[str, float] = {
+        "/test": 10, "/query": 5, "/events": 5, "/joke": 1,
+        "/joke/batch": 1, "/query/batch": 5, "/events/batch": 5,
+        "/github_comment": 5, "/github_review": 20,
+    }
+
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: Literal["text", "json"] = "text"
+    LOG_PAYLOAD_LIMIT: int = 500
+    LOG_SAMPLE_RATE: float = 1.0
+
+    @field_validator("GENERATION_PROFILES")
+    @classmethod
+    def _one_context_size(cls, profiles: Dict[str, GenerationProfile]):
+        default = profiles.get("default", GenerationProfile()).num_ctx
+        for name, profile in profiles.items():
+            if profile.num_ctx is not None and profile.num_ctx != default:
+                raise ValueError(f"Profile {name!r} sets num_ctx {profile.num_ctx}; "
+                                 f"set it in the default profile only")
+        return profiles
 
 
 settings = Settings()
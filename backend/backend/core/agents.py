@@ -1,36 +1,191 @@
+import asyncio
+import json
+import os
+
+from contextlib import aclosing
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langgraph.prebuilt import create_react_agent
+from langchain_core.tools import BaseTool
+
+from config import settings
 
-from utils.logger import logger
+from utils.logger import logger, truncate, SAMPLED
+from utils.metrics import AGENT_EARLY_STOPS, span
+from utils.tracing import trace_run
 from .models import ModelRegistry
+from .registry import LazyRegistry
 from .tools import ToolRegistry
 from .chains import ChainRegistry
+from .symbols import SymbolIndex
+
+
+def create_react_agent(model, tools):
+    # LangGraph is imported on first use, it is costly to import at startup
+    from langgraph.prebuilt import create_react_agent
+    return create_react_agent(model, tools)
+
+
+def _tool_key(tool_call):
+    return tool_call["name"], json.dumps(tool_call["args"], sort_keys=True, default=str)
+
+
+# Results of the tool calls made during the current agent run
+_tool_results: ContextVar[Optional[Dict[tuple, ToolMessage]]] = ContextVar(
+    "tool_results", default=None)
+
+
+class MemoizingTool(BaseTool):
+    """
+    Wraps a tool so that identical calls within an agent run are run once.
+    The agent graph calls it through the public `ainvoke` with tool calls,
+    which it answers from the run's cache (see `_tool_results`). The model
+    is bound to the wrapped tools themselves, whose schemas it keeps.
+    """
+
+    tool: BaseTool
+
+    def __init__(self, tool: BaseTool):
+        super().__init__(name=tool.name, description=tool.description,
+                         args_schema=tool.args_schema, tool=tool)
+
+    def get_input_schema(self, config=None):
+        return self.tool.get_input_schema(config)
+
+    def _run(self, *args, **kwargs):
+        raise NotImplementedError("Calls are passed on to the wrapped tool")
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.tool.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        results = _tool_results.get()
+        if results is None or not (isinstance(input, dict) and input.get("type") == "tool_call"):
+            return await self.tool.ainvoke(input, config, **kwargs)
+        key = _tool_key(input)
+        if key in results:
+            logger.info("AgentRuntime: Reusing result of repeated %s call", self.name)
+            cached = results[key]
+            return ToolMessage(cached.content, name=self.name,
+                               tool_call_id=input["id"], artifact=cached.artifact)
+        message = await self.tool.ainvoke(input, config, **kwargs)
+        if isinstance(message, ToolMessage) and message.status != "error":
+            results[key] = message
+        return message
+
+
+class AgentRuntime(object):
+    """
+    Runs a ReAct agent within bounds.
+
+    A run stops after `max_steps` LLM turns, after `timeout` seconds, or
+    when the model repeats an identical tool call more than `max_repeats`
+    times. Identical tool calls within a run are served from a per-run
+    cache. A run that is stopped early gets one last LLM turn without
+    tools, which answers the request as well as it can from the tool
+    results gathered so far. That turn has `final_answer_timeout` seconds,
+    kept out of `timeout`, so a run takes at most `timeout` seconds.
+    """
+
+    FINAL_ANSWER_PROMPT = (
+        "Stop calling tools. Answer the original request now, as well as you "
+        "can, using only the information gathered so far."
+    )
+
+    def __init__(self, name, model, tools, max_steps=None, timeout=None,
+                 max_repeats=None, final_answer_timeout=None):
+        self.name = name
+        self.model = model
+        self.graph = create_react_agent(model.bind_tools(tools),
+                                        [MemoizingTool(tool) for tool in tools])
+        self.max_steps = max_steps or settings.AGENT_MAX_STEPS
+        self.timeout = timeout or settings.AGENT_TIMEOUT
+        self.max_repeats = max_repeats or settings.AGENT_MAX_REPEATED_CALLS
+        self.final_answer_timeout = min(
+            final_answer_timeout or settings.AGENT_FINAL_ANSWER_TIMEOUT, self.timeout / 2)
+
+    async def ainvoke(self, messages: List[BaseMessage]):
+        """Run the agent on `messages`; returns the state with all messages."""
+        messages = list(messages)
+        reason = await self._run(messages)
+        if reason is not None:
+            logger.warning("AgentRuntime: Stopped %s early (%s) after %d messages",
+                           self.name, reason, len(messages))
+            AGENT_EARLY_STOPS.labels(self.name, reason).inc()
+            if messages and getattr(messages[-1], "tool_calls", None):
+                # Drop the tool calls that will not be answered
+                messages.pop()
+            messages.append(HumanMessage(self.FINAL_ANSWER_PROMPT))
+            messages.append(await asyncio.wait_for(self.model.ainvoke(messages),
+                                                   self.final_answer_timeout))
+        return {"messages": messages}
+
+    async def _run(self, messages) -> Optional[str]:
+        """
+        Stream the agent graph, appending to `messages`. Returns None when
+        the agent finished, or why it was stopped: "steps", "timeout" or "loop".
+        """
+        token = _tool_results.set({})
+        calls: Dict[tuple, int] = {}
+        steps = 0
+        config = {"recursion_limit": 2 * self.max_steps + 1}
+        try:
+            async with asyncio.timeout(self.timeout - self.final_answer_timeout):
+                async with aclosing(self.graph.astream(
+                    {"messages": messages}, config=config, stream_mode="updates"
+                )) as updates:
+                    async for update in updates:
+                        for node, state in update.items():
+                            messages.extend(state["messages"])
+                            if node != "agent":
+                                continue
+                            steps += 1
+                            tool_calls = getattr(messages[-1], "tool_calls", None)
+                            if not tool_calls:
+                                continue
+                            if steps >= self.max_steps:
+                                return "steps"
+                            for tool_call in tool_calls:
+                                key = _tool_key(tool_call)
+                                calls[key] = calls.get(key, 0) + 1
+                                if calls[key] > self.max_repeats:
+                                    logger.info("AgentRuntime: %s repeats a %s call",
+                                                self.name, tool_call["name"])
+                                    return "loop"
+        except TimeoutError:
+            return "timeout"
+        finally:
+            _tool_results.reset(token)
+        return None
 
 
 class EventsAgent(object):
     def __init__(self, model, search_tool):
         super().__init__()
-        prompt = ChatPromptTemplate.from_template(
+        self.prompt = ChatPromptTemplate.from_template(
             "Generate a list of events and short descriptions happening in {location} on {date}"
         )
-        agent = create_react_agent(model, [search_tool])
-        self.chain = prompt | agent
+        self.runtime = AgentRuntime("EventsAgent", model, [search_tool])
 
     async def ainvoke(self, location, date):
-        logger.info(
-            f"EventsAgent: Getting events for location: {
-                location} and date: {date}"
-        )
-        data = {"location": location, "date": date}
-        result = await self.chain.ainvoke(data)
-        logger.info(f"EventsAgent: Events response: {result}")
+        logger.info("EventsAgent: Getting events for location: %s and date: %s",
+                    location, date)
+        with span("agent", "EventsAgent"), \
+                trace_run("agent", "EventsAgent", location=location, date=date):
+            result = await self.runtime.ainvoke(
+                self.prompt.format_messages(location=location, date=date))
+        logger.debug("EventsAgent: %d messages, response: %s",
+                     len(result["messages"]), truncate(result["messages"][-1].content),
+                     extra=SAMPLED)
         return result["messages"][-1].content
 
 
 class PythonAgent(object):
     def __init__(self, model, python_tool):
         super().__init__()
-        prompt = ChatPromptTemplate.from_template(
+        self.prompt = ChatPromptTemplate.from_template(
             """
 Answer the user's query, using the python_repl tool if needed.
 Don't include python code in your answer.
@@ -39,20 +194,22 @@ Make sure to include the result in your final answer.
 The user query is: {query}
             """
         )
-        agent = create_react_agent(model, [python_tool])
-        self.chain = prompt | agent
+        self.runtime = AgentRuntime("PythonAgent", model, [python_tool])
 
     async def ainvoke(self, query):
-        logger.info(f"PythonAgent: Answering query: {query}")
-        result = await self.chain.ainvoke(query)
-        logger.info(f"PythonAgent: Query response: {result}")
+        logger.info("PythonAgent: Answering query: %s", truncate(query))
+        with span("agent", "PythonAgent"), trace_run("agent", "PythonAgent", query=query):
+            result = await self.runtime.ainvoke(self.prompt.format_messages(query=query))
+        logger.debug("PythonAgent: %d messages, response: %s",
+                     len(result["messages"]), truncate(result["messages"][-1].content),
+                     extra=SAMPLED)
         return result["messages"][-1].content
 
 
 class GitHubCommentAgent(object):
     def __init__(self, model, github_tool):
         super().__init__()
-        prompt = ChatPromptTemplate.from_template(
+        self.prompt = ChatPromptTemplate.from_template(
             """
 Add a comment to the GitHub pull request.
 The repository is: {repo}
@@ -63,56 +220,96 @@ Use the github_comment tool to add the comment.
 Formulate the comment text based on the request.
             """
         )
-        agent = create_react_agent(model, [github_tool])
-        self.chain = prompt | agent
+        self.runtime = AgentRuntime("GitHubCommentAgent", model, [github_tool])
 
     async def ainvoke(self, repo, pr_number, request):
-        logger.info(
-            f"GitHubCommentAgent: Adding comment to PR #{
-                pr_number} in repo {repo}"
-        )
-        data = {"repo": repo, "pr_number": pr_number, "request": request}
-        result = await self.chain.ainvoke(data)
-        logger.info(f"GitHubCommentAgent: Comment added to PR #{pr_number}")
+        logger.info("GitHubCommentAgent: Adding comment to PR #%s in repo %s",
+                    pr_number, repo)
+        with span("agent", "GitHubCommentAgent"), \
+                trace_run("agent", "GitHubCommentAgent", repo=repo, pr_number=pr_number,
+                          request=request):
+            result = await self.runtime.ainvoke(self.prompt.format_messages(
+                repo=repo, pr_number=pr_number, request=request))
+        logger.info("GitHubCommentAgent: Comment added to PR #%s", pr_number)
         return result["messages"][-1].content
 
 
 class GitHubPullRequestReviewAgent(object):
-    def __init__(self, model, get_files_tool, patch_review_chain, patch_comment_tool):
+    def __init__(self, model, get_files_tool, patch_review_chain, patch_comment_tool,
+                 symbol_index=None):
         super().__init__()
         self.get_files_tool = get_files_tool
         self.patch_review_chain = patch_review_chain
         self.patch_comment_tool = patch_comment_tool
+        self.symbol_index = symbol_index
         self.model = model
 
+    async def _symbols(self, repo, ref, changed):
+        if self.symbol_index is None or not changed:
+            return None
+        try:
+            tree = await asyncio.to_thread(self.get_files_tool.get_tree, repo, ref)
+            return await self.symbol_index.snapshot(
+                tree, changed, lambda sha: self.get_files_tool.get_blob(repo, sha))
+        except Exception as e:
+            # Definitions only add context, the review can go on without them
+            logger.warning("GitHubPullRequestReviewAgent: Symbol index failed: %r", e)
+            return None
+
+    def _list_files(self, repo, pr_number):
+        """The (path, blob SHA, status, head) of the files, without their contents."""
+        return [(file["filename"], file["sha"], file["status"], file["ref"])
+                for file in self.get_files_tool.iter_pr_files(repo, pr_number, contents=False)]
+
     async def ainvoke(self, repo, pr_number):
-        logger.info(
-            f"GitHubPullRequestReviewAgent: Reviewing code for PR #{
-                pr_number} in repo {repo}"
-        )
+        logger.info("GitHubPullRequestReviewAgent: Reviewing code for PR #%s in repo %s",
+                    pr_number, repo)
 
-        # Fetch the pull request files
-        pr_files = self.get_files_tool.get_pr_files(repo, pr_number)
-
-        results = []
-        for file in pr_files:
-            contents = file["contents"]
-            path = file["filename"]
-            for start, end, header, content in file["hunks"]:
-                patch = header + content
-                comments = await self.patch_review_chain.ainvoke(
-                    contents, start, end, patch
-                )
-
-                for comment in comments.comments if comments else []:
-                    result = self.patch_comment_tool.add_patch_comment(
-                        repo, pr_number, comment.content, path, comment.line)
-                    results.append(result)
-
-        logger.info(
-            f"GitHubPullRequestReviewAgent: Code review completed for PR #{
-                pr_number}"
-        )
+        with span("agent", "GitHubPullRequestReviewAgent"):
+            listing = await asyncio.to_thread(self._list_files, repo, pr_number)
+            changed = {path: sha for path, sha, status, _ in listing if status != "removed"}
+            symbols = await self._symbols(repo, listing[0][3], changed) if listing else None
+            # Comments of earlier reviews of the pull request are not posted again
+            posted = await asyncio.to_thread(self.patch_comment_tool.posted_comments,
+                                             repo, pr_number)
+
+            # The files are fetched and reviewed one at a time, the next one
+            # being fetched during the review, so at most two files' contents
+            # are in memory whatever the size of the pull request. The file
+            # list was revalidated just now.
+            files = self.get_files_tool.iter_pr_files(repo, pr_number, revalidate=False)
+            upcoming = asyncio.create_task(asyncio.to_thread(next, files, None))
+            results = []
+            try:
+                while (file := await upcoming) is not None:
+                    upcoming = asyncio.create_task(asyncio.to_thread(next, files, None))
+                    contents = file["contents"]
+                    path = file["filename"]
+                    for start, end, header, content in file["hunks"]:
+                        patch = header + content
+                        definitions = await asyncio.to_thread(
+                            symbols.definitions, path, start, end, patch,
+                            settings.SYMBOL_CONTEXT_MAX_LINES
+                        ) if symbols else ""
+                        comments = await self.patch_review_chain.ainvoke(
+                            contents, start, end, patch, definitions
+                        )
+
+                        for comment in comments.comments if comments else []:
+                            result = await asyncio.to_thread(
+                                self.patch_comment_tool.add_patch_comment,
+                                repo, pr_number, comment.content, path, comment.line, posted,
+                                # Lines refer to the reviewed commit, not to a later push
+                                file["ref"])
+                            results.append(result)
+            finally:
+                # A fetch running in a thread cannot be cancelled; it is waited
+                # for, so that the generator is not running when it is closed
+                await asyncio.gather(upcoming, return_exceptions=True)
+                await asyncio.to_thread(files.close)
+
+        logger.info("GitHubPullRequestReviewAgent: Code review completed for PR #%s",
+                    pr_number)
         return results
 
 
@@ -121,24 +318,29 @@ class AgentRegistry(object):
         self, models: ModelRegistry, tools: ToolRegistry, chains: ChainRegistry
     ):
         logger.info("Initializing agents...")
-        self.agents = {}
-        self.agents["events_agent"] = EventsAgent(
-            models.get_chat_model(), tools.get_search_tool()
-        )
-        self.agents["python_agent"] = PythonAgent(
-            models.get_chat_model(), tools.get_python_tool()
-        )
-        self.agents["github_comment_agent"] = GitHubCommentAgent(
-            models.get_chat_model(), tools.get_github_comment_tool()
-        )
-        self.agents["github_pullrequest_patch_review_agent"] = (
-            GitHubPullRequestReviewAgent(
-                models.get_chat_model(),
+        self.agents = LazyRegistry({
+            "events_agent": lambda: EventsAgent(
+                models.get_chat_model(profile="events"), tools.get_search_tool()
+            ),
+            "python_agent": lambda: PythonAgent(
+                models.get_chat_model(profile="python"), tools.get_python_tool()
+            ),
+            "github_comment_agent": lambda: GitHubCommentAgent(
+                models.get_chat_model(profile="github_comment"),
+                tools.get_github_comment_tool()
+            ),
+            "github_pullrequest_patch_review_agent": lambda: GitHubPullRequestReviewAgent(
+                models.get_chat_model(profile="review"),
                 tools.get_github_pr_files_tool(),
                 chains.get_chains()["patch_review_chain"],
                 tools.get_github_pr_patch_comment_tool(),
-            )
-        )
+                SymbolIndex(
+                    os.path.join(settings.STATE_DIR, "symbols"),
+                    max_fetch=settings.SYMBOL_INDEX_MAX_FETCH,
+                    max_file_size=settings.SYMBOL_INDEX_MAX_FILE_SIZE,
+                ) if settings.SYMBOL_INDEX_ENABLED else None,
+            ),
+        })
 
     def get_agents(self):
         return self.agents
@@ -1,9 +1,14 @@
-from langchain_core.output_parsers import PydanticOutputParser
+import asyncio
+
+from langchain_core.output_parsers import JsonOutputParser, PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from utils.logger import logger
+from utils.logger import logger, truncate, SAMPLED
+from utils.metrics import span
+from utils.tracing import trace_run
 
 from .models import ModelRegistry
+from .registry import LazyRegistry
 from .tools import ToolRegistry
 
 from pydantic import BaseModel, Field, ValidationError
@@ -15,15 +20,29 @@ class JokeChain(object):
         super().__init__()
         prompt = ChatPromptTemplate.from_template(
             "tell me a joke about {subject}")
-        model = models.get_chat_model()
+        model = models.get_chat_model(profile="joke")
         self.chain = prompt | model | StrOutputParser()
 
     async def ainvoke(self, subject):
-        logger.info(f"JokeChain: Getting joke for subject: {subject}")
-        result = await self.chain.ainvoke(subject)
-        logger.info(f"JokeChain: Joke response: {result}")
+        logger.info("JokeChain: Getting joke for subject: %s", subject)
+        with span("chain", "JokeChain"), trace_run("chain", "JokeChain", subject=subject):
+            result = await self.chain.ainvoke(subject)
+        logger.debug("JokeChain: Joke response: %s", truncate(result), extra=SAMPLED)
         return result
 
+    async def abatch_as_completed(self, subjects, max_concurrency):
+        """
+        Tell jokes about all `subjects`, at most `max_concurrency` at a time.
+        Yields (index, joke or exception) tuples in completion order.
+        """
+        logger.info("JokeChain: Getting jokes for %d subjects", len(subjects))
+        with span("chain", "JokeChain"):
+            async for index, result in self.chain.abatch_as_completed(
+                subjects, config={"max_concurrency": max_concurrency},
+                return_exceptions=True,
+            ):
+                yield index, result
+
     def get_chain(self):
         return self.chain
 
@@ -59,19 +78,69 @@ The existing knowledge is given below:
             """
         )
         model = models.get_chat_model_json(
-            format=self.SearchQueryList.model_json_schema()
+            format=self.SearchQueryList.model_json_schema(), profile="queries"
         )
         parser = PydanticOutputParser(pydantic_object=self.SearchQueryList)
         self.chain = prompt | model | parser
+        # Parses the partial JSON of the streamed response
+        self.stream_chain = prompt | model | JsonOutputParser()
 
     async def ainvoke(self, query, num_results, knowledge=None):
-        logger.info(f"AdjacentQueriesChain: Getting queries for: {query}")
-        result = await self.chain.ainvoke(
-            {"query": query, "num_results": num_results, "knowledge": knowledge}
-        )
-        logger.info(f"AdjacentQueriesChain: Response: {result}")
+        logger.info("AdjacentQueriesChain: Getting queries for: %s", query)
+        with span("chain", "AdjacentQueriesChain"), \
+                trace_run("chain", "AdjacentQueriesChain", query=query,
+                          num_results=num_results, knowledge=knowledge):
+            result = await self.chain.ainvoke(
+                {"query": query, "num_results": num_results, "knowledge": knowledge}
+            )
+        logger.debug("AdjacentQueriesChain: Response: %s", truncate(result),
+                     extra=SAMPLED)
         return result.queries
 
+    async def astream(self, query, num_results, knowledge=None):
+        """
+        Yield the queries one by one, each as soon as the model has finished
+        generating it, so that work on the first queries can start while the
+        others are still being generated.
+
+        The model is streamed in a task of its own, so that its span and run
+        recording do not leak into the context of the consumer, and of the
+        tasks it starts, between the queries.
+        """
+        logger.info("AdjacentQueriesChain: Streaming queries for: %s", query)
+        queries: asyncio.Queue = asyncio.Queue()
+        producer = asyncio.create_task(
+            self._stream(query, num_results, knowledge, queries.put_nowait))
+        try:
+            while (item := await queries.get()) is not None:
+                yield item
+            await producer
+        finally:
+            producer.cancel()
+
+    async def _stream(self, query, num_results, knowledge, emit):
+        queries, emitted = [], 0
+        try:
+            with span("chain", "AdjacentQueriesChain"), \
+                    trace_run("chain", "AdjacentQueriesChain", "astream", query=query,
+                              num_results=num_results, knowledge=knowledge):
+                async for partial in self.stream_chain.astream(
+                    {"query": query, "num_results": num_results, "knowledge": knowledge}
+                ):
+                    if isinstance(partial, dict) and isinstance(partial.get("queries"), list):
+                        queries = partial["queries"]
+                    # The last query in a partial response may still be incomplete
+                    while emitted < len(queries) - 1:
+                        emit(str(queries[emitted]))
+                        emitted += 1
+                while emitted < len(queries):
+                    emit(str(queries[emitted]))
+                    emitted += 1
+        finally:
+            emit(None)
+        logger.debug("AdjacentQueriesChain: Streamed queries: %s", truncate(queries),
+                     extra=SAMPLED)
+
     def get_chain(self):
         return self.chain
 
@@ -91,13 +160,15 @@ Your existing knowledge on the subject is given below:
 {knowledge}
             """
         )
-        model = models.get_chat_model()
+        model = models.get_chat_model(profile="summary")
         self.chain = prompt | model | StrOutputParser()
 
     async def ainvoke(self, subject, knowledge):
-        logger.info(f"SummaryChain: Creating summary for: {subject}")
-        result = await self.chain.ainvoke({"subject": subject, "knowledge": knowledge})
-        logger.info(f"SummaryChain: Response: {result}")
+        logger.info("SummaryChain: Creating summary for: %s", subject)
+        with span("chain", "SummaryChain"), \
+                trace_run("chain", "SummaryChain", subject=subject, knowledge=knowledge):
+            result = await self.chain.ainvoke({"subject": subject, "knowledge": knowledge})
+        logger.debug("SummaryChain: Response: %s", truncate(result), extra=SAMPLED)
         return result
 
     def get_chain(self):
@@ -140,10 +211,16 @@ For reference, the new code is given below:
 {contents}
 ```
 
+Definitions of functions, classes and types referenced by the patch
+(may be empty):
+```
+{definitions}
+```
+
 {format_instructions}
             """
         )
-        model = models.get_chat_model_json()
+        model = models.get_chat_model_json(profile="review")
         model = model.with_structured_output(self.ReviewCommentList)
         self.chain = prompt | model
 
@@ -176,25 +253,32 @@ For reference, the new code is given below:
             ]
         )
 
-    async def ainvoke(self, file_contents, start, end, patch_content) -> ReviewCommentList:
-        logger.info(
-            f"GitHubPullRequestPatchReviewChain: Reviewing code patch {
-                patch_content} from line {start} to {end}"
-        )
+    async def ainvoke(self, file_contents, start, end, patch_content,
+                      definitions="") -> ReviewCommentList:
+        logger.info("GitHubPullRequestPatchReviewChain: Reviewing code patch "
+                    "from line %d to %d", start, end)
+        logger.debug("GitHubPullRequestPatchReviewChain: Patch: %s",
+                     truncate(patch_content), extra=SAMPLED)
         chunk = self.chunk_with_line_numbers(file_contents, start, end)
         try:
-            result = await self.chain.ainvoke(
-                {
-                    "patch": patch_content,
-                    "contents": chunk,
-                    "format_instructions": self.parser.get_format_instructions(),
-                }
-            )
+            with span("chain", "GitHubPullRequestPatchReviewChain"), \
+                    trace_run("chain", "GitHubPullRequestPatchReviewChain",
+                              file_contents=file_contents, start=start, end=end,
+                              patch_content=patch_content, definitions=definitions):
+                result = await self.chain.ainvoke(
+                    {
+                        "patch": patch_content,
+                        "contents": chunk,
+                        "definitions": definitions,
+                        "format_instructions": self.parser.get_format_instructions(),
+                    }
+                )
         except ValidationError as e:
-            logger.error(f"GitHubPullRequestPatchReviewChain: Error: {e}")
+            logger.error("GitHubPullRequestPatchReviewChain: Error: %s", e)
             return []
 
-        logger.info(f"GitHubPullRequestPatchReviewChain: Response: {result}")
+        logger.debug("GitHubPullRequestPatchReviewChain: Response: %s",
+                     truncate(result), extra=SAMPLED)
         return result
 
     def get_chain(self):
@@ -204,12 +288,12 @@ For reference, the new code is given below:
 class ChainRegistry(object):
     def __init__(self, models: ModelRegistry, tools: ToolRegistry):
         logger.info("Initializing chains...")
-        self.chains = {}
-        self.chains["joke_chain"] = JokeChain(models)
-        self.chains["adjacent_queries_chain"] = AdjacentQueriesChain(models)
-        self.chains["summary_chain"] = SummaryChain(models)
-        self.chains["patch_review_chain"] = GitHubPullRequestPatchReviewChain(
-            models)
+        self.chains = LazyRegistry({
+            "joke_chain": lambda: JokeChain(models),
+            "adjacent_queries_chain": lambda: AdjacentQueriesChain(models),
+            "summary_chain": lambda: SummaryChain(models),
+            "patch_review_chain": lambda: GitHubPullRequestPatchReviewChain(models),
+        })
 
     def get_chains(self):
         return self.chains
@@ -1,7 +1,13 @@
+import os
+
+from config import settings
 from .models import ModelRegistry
 from .tools import ToolRegistry
 from .chains import ChainRegistry
 from .agents import AgentRegistry
+from .retrieval import WebRetriever
+from .semantic_cache import SemanticCache
+from .vectorstore import PersistentVectorIndex
 
 
 class Context(object):
@@ -12,7 +18,27 @@ class Context(object):
         return cls.instance
 
     def __init__(self):
+        # __init__ runs on every Context() call, e.g. per request through
+        # FastAPI's Depends(); only the first call builds the registries
+        if hasattr(self, "agents"):
+            return
         self.models = ModelRegistry()
         self.tools = ToolRegistry()
         self.chains = ChainRegistry(self.models, self.tools)
         self.agents = AgentRegistry(self.models, self.tools, self.chains)
+        self.semantic_cache = SemanticCache(
+            self.models.get_embeddings(),
+            threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+            ttl=settings.SEMANTIC_CACHE_TTL,
+            max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+        ) if settings.SEMANTIC_CACHE_ENABLED else None
+        self.retriever = WebRetriever(
+            self.models.get_embeddings(),
+            PersistentVectorIndex(os.path.join(
+                settings.STATE_DIR, "retrieval",
+                settings.OLLAMA_EMBEDDING_MODEL.replace(":", "-").replace("/", "-")),
+                max_chunks=settings.RETRIEVAL_MAX_CHUNKS),
+            chunk_size=settings.RETRIEVAL_CHUNK_SIZE,
+            chunk_overlap=settings.RETRIEVAL_CHUNK_OVERLAP,
+            batch_size=settings.RETRIEVAL_BATCH_SIZE,
+        ) if settings.RETRIEVAL_ENABLED else None
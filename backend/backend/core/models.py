@@ -7,8 +7,11 @@ class ModelRegistry(object):
         self.models = {}
         self.ollama = OllamaBackend()
 
-    def get_chat_model(self):
-        return self.ollama.get_chat_model()
+    def get_chat_model(self, profile="default"):
+        return self.ollama.get_chat_model(profile)
 
-    def get_chat_model_json(self, format="json"):
-        return self.ollama.get_chat_model_json(format)
+    def get_chat_model_json(self, format="json", profile="default"):
+        return self.ollama.get_chat_model_json(format, profile)
+
+    def get_embeddings(self):
+        return self.ollama.get_embeddings()
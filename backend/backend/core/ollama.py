@@ -1,53 +1,348 @@
+import asyncio
 import httpx
+import math
+import os
+import re
+import threading
+import time
 
+from datetime import datetime
 from pydantic.json_schema import JsonSchemaValue
-from typing import Literal, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
-from langchain_ollama import ChatOllama
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_ollama import ChatOllama, OllamaEmbeddings
 
 from config import settings
 from utils.logger import logger
+from utils.metrics import (OLLAMA_MODEL_ACTIONS, OLLAMA_MODEL_KEEP_ALIVE, OLLAMA_MODEL_LOADED,
+                           metrics_callback)
+from utils.resilience import get_upstream
+from utils.store import SharedStore, get_store
 
 
 class OllamaBackend(object):
     def __init__(self):
-        self._pull_models()
+        self.ensure_model()
 
-    def _pull_models(self):
-        logger.info(
-            f"Pulling Ollama model '{settings.OLLAMA_MODEL}' at endpoint '{
-                    settings.OLLAMA_ENDPOINT}' ..."
-        )
-        with httpx.Client() as client:
-            response = client.post(
-                f"{settings.OLLAMA_ENDPOINT}/api/pull",
-                json={"name": settings.OLLAMA_MODEL},
-            )
-            for chunk in response.iter_lines():
-                logger.info(f"Ollama: {chunk}")
+    @staticmethod
+    def _client_kwargs():
+        upstream = get_upstream("ollama")
+        return {"timeout": upstream.httpx_timeout(), "transport": upstream.transport()}
+
+    @staticmethod
+    def _models():
+        models = [settings.OLLAMA_MODEL]
+        if settings.SEMANTIC_CACHE_ENABLED or settings.RETRIEVAL_ENABLED:
+            models.append(settings.OLLAMA_EMBEDDING_MODEL)
+        return models
+
+    @classmethod
+    def _ready_key(cls):
+        return f"ollama:ready:{settings.OLLAMA_ENDPOINT}:{','.join(cls._models())}"
+
+    @classmethod
+    def model_ready(cls):
+        """
+        Whether the model was pulled recently by any worker on this host,
+        e.g. by the gunicorn master during the preload phase.
+        """
+        return get_store().get(cls._ready_key()) is not None
+
+    @classmethod
+    def ensure_model(cls):
+        if not cls.model_ready():
+            cls._pull_models()
+
+    @classmethod
+    def _pull_models(cls):
+        success = True
+        for model in cls._models():
+            logger.info("Pulling Ollama model '%s' at endpoint '%s' ...",
+                        model, settings.OLLAMA_ENDPOINT)
+            with httpx.Client() as client:
+                response = client.post(
+                    f"{settings.OLLAMA_ENDPOINT}/api/pull",
+                    json={"name": model},
+                )
+                for chunk in response.iter_lines():
+                    logger.debug("Ollama: %s", chunk)
+            success = success and response.is_success
+        if success:
+            get_store().set(cls._ready_key(), time.time(), ttl=settings.MODEL_READY_TTL)
         logger.info("Pulling Ollama model done")
 
-    def get_chat_model(self):
+    @staticmethod
+    def _generation_parameters(profile: str):
+        """Merge the named generation profile over the "default" profile."""
+        profiles = settings.GENERATION_PROFILES
+        if profile not in profiles:
+            logger.warning("Unknown generation profile '%s', using 'default'", profile)
+        parameters = {}
+        for name in ("default", profile):
+            if name in profiles:
+                parameters.update(profiles[name].model_dump(exclude_none=True))
+        return parameters
+
+    def get_chat_model(self, profile: str = "default"):
         return ChatOllama(
-            model=settings.OLLAMA_MODEL, base_url=settings.OLLAMA_ENDPOINT
+            model=settings.OLLAMA_MODEL, base_url=settings.OLLAMA_ENDPOINT,
+            callbacks=[metrics_callback, ModelUsageCallback(settings.OLLAMA_MODEL)],
+            client_kwargs=self._client_kwargs(),
+            **self._generation_parameters(profile),
         )
 
     def get_chat_model_json(
-        self, format: Union[Literal["", "json"], JsonSchemaValue] = "json"
+        self, format: Union[Literal["", "json"], JsonSchemaValue] = "json",
+        profile: str = "default",
     ):
         """
         Get the chat model with the specified format.
 
         Args:
             format Specify the format of the output (options: "json", JSON schema).
+            profile Name of the generation profile in `GENERATION_PROFILES`.
 
         Returns:
             ChatOllama: An instance of the ChatOllama class with the specified format.
         """
         # FIXME: despite the langchain documentation, a JsonSchemaValue is not a valid value for the format parameter
+        parameters = {"temperature": 0.1, **self._generation_parameters(profile)}
         return ChatOllama(
             model=settings.OLLAMA_MODEL,
             base_url=settings.OLLAMA_ENDPOINT,
             format="json",
-            temperature=0.1,
+            callbacks=[metrics_callback, ModelUsageCallback(settings.OLLAMA_MODEL)],
+            client_kwargs=self._client_kwargs(),
+            **parameters,
+        )
+
+    def get_embeddings(self):
+        return TrackedOllamaEmbeddings(
+            model=settings.OLLAMA_EMBEDDING_MODEL, base_url=settings.OLLAMA_ENDPOINT,
+            client_kwargs=self._client_kwargs(),
         )
+
+
+# Model usage is counted per minute over this window
+_USAGE_WINDOW = 3600
+
+
+def _model_name(model: str) -> str:
+    """Ollama lists models with their tag; an untagged name means "latest"."""
+    return model if ":" in model else f"{model}:latest"
+
+
+def _parse_time(value: str) -> float:
+    # Ollama reports nanoseconds, which `fromisoformat` does not accept
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value.replace("Z", "+00:00"))
+    return datetime.fromisoformat(value).timestamp()
+
+
+class ModelUsageCallback(BaseCallbackHandler):
+    """Counts the calls of a chat model for the `ModelKeeper`."""
+
+    run_inline = True
+
+    def __init__(self, model: str):
+        super().__init__()
+        self.model = model
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        get_model_keeper().record_use(self.model)
+
+
+class TrackedOllamaEmbeddings(OllamaEmbeddings):
+    """`OllamaEmbeddings` counting its calls for the `ModelKeeper`."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        get_model_keeper().record_use(self.model)
+        return super().embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        get_model_keeper().record_use(self.model)
+        return await super().aembed_documents(texts)
+
+
+class ModelKeeper(object):
+    """
+    Keeps the configured Ollama models loaded while they are in use.
+
+    Every worker counts the calls of each model and adds them to per-minute
+    usage counts in the `SharedStore`. One worker per host, holding a lease
+    in the store, polls Ollama's `/api/ps` every `OLLAMA_KEEPER_INTERVAL`
+    seconds and:
+    - warms each model with a tiny generation when it starts, which counts
+      as a call;
+    - extends the keep-alive of a loaded model to twice the mean gap between
+      its calls over the past hour, within `OLLAMA_KEEP_ALIVE_MIN` and
+      `OLLAMA_KEEP_ALIVE_MAX`, counted from its last call. Requests only ask
+      for the minimum, so a model nobody uses is unloaded soon;
+    - under memory pressure, when the loaded models take more than
+      `OLLAMA_MEMORY_BUDGET` bytes or one of them spilled over from GPU
+      into system memory, unloads the least used model that has been idle for
+      `OLLAMA_KEEP_ALIVE_MIN` seconds, one per poll.
+    """
+
+    def __init__(self, store: SharedStore, models: List[str], options: dict):
+        self.store = store
+        self.models = models
+        # Loads must use the context size of requests, or Ollama reloads the model
+        self.options = options
+        self.interval = settings.OLLAMA_KEEPER_INTERVAL
+        self.owner = str(os.getpid())
+        self.warmed = False
+        self._counts: Dict[str, int] = {}
+        self._last: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _usage_key(model: str) -> str:
+        return f"ollama:usage:{settings.OLLAMA_ENDPOINT}:{model}"
+
+    def record_use(self, model: str):
+        with self._lock:
+            self._counts[model] = self._counts.get(model, 0) + 1
+            self._last[model] = time.time()
+
+    def flush(self):
+        """Add the calls counted by this worker to the shared usage counts."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            last, self._last = self._last, {}
+        for model, count in counts.items():
+            minute = int(last[model] // 60)
+
+            def add(usage):
+                usage = usage or {"counts": {}, "last": 0.0}
+                recent = {m: n for m, n in usage["counts"].items()
+                          if (minute - int(m)) * 60 < _USAGE_WINDOW}
+                recent[str(minute)] = recent.get(str(minute), 0) + count
+                return {"counts": recent, "last": max(usage["last"], last[model])}
+
+            self.store.update(self._usage_key(model), add, ttl=_USAGE_WINDOW)
+
+    def usage(self, model: str, now: float) -> Tuple[int, float]:
+        """Calls of `model` over the past hour and the time of its last call."""
+        usage = self.store.get(self._usage_key(model)) or {"counts": {}, "last": 0.0}
+        calls = sum(n for m, n in usage["counts"].items()
+                    if now - int(m) * 60 < _USAGE_WINDOW)
+        return calls, usage["last"]
+
+    @staticmethod
+    def keep_alive(calls: int) -> float:
+        if not calls:
+            return settings.OLLAMA_KEEP_ALIVE_MIN
+        return min(max(2 * _USAGE_WINDOW / calls, settings.OLLAMA_KEEP_ALIVE_MIN),
+                   settings.OLLAMA_KEEP_ALIVE_MAX)
+
+    def _lead(self) -> bool:
+        """Take or renew the lease making this worker the host's keeper."""
+        lease = self.store.update(
+            f"ollama:keeper:{settings.OLLAMA_ENDPOINT}",
+            lambda owner: owner if owner and owner != self.owner else self.owner,
+            ttl=3 * self.interval)
+        return lease == self.owner
+
+    async def loaded(self, client: httpx.AsyncClient) -> Dict[str, dict]:
+        """The models Ollama has loaded, by name."""
+        response = await client.get("/api/ps")
+        response.raise_for_status()
+        return {model["name"]: model for model in response.json().get("models", [])}
+
+    async def _load(self, client: httpx.AsyncClient, model: str, keep_alive: float,
+                    action: str) -> bool:
+        """Load `model` with `keep_alive` seconds to live; 0 unloads it."""
+        keep_alive = math.ceil(keep_alive)
+        if keep_alive and model == settings.OLLAMA_EMBEDDING_MODEL:
+            path = "/api/embed"
+            body = {"model": model, "input": "warm-up", "keep_alive": keep_alive}
+        else:
+            # An empty prompt loads the model without generating
+            path = "/api/generate"
+            body = {"model": model, "prompt": "", "stream": False, "keep_alive": keep_alive}
+            if keep_alive:
+                body["options"] = dict(self.options)
+            if action == "warmed":
+                body["prompt"] = "Hi"
+                body["options"]["num_predict"] = 1
+        try:
+            response = await client.post(path, json=body)
+            response.raise_for_status()
+        except Exception as e:
+            OLLAMA_MODEL_ACTIONS.labels(model, "failed").inc()
+            logger.warning("Could not load Ollama model '%s': %r", model, e)
+            return False
+        OLLAMA_MODEL_ACTIONS.labels(model, action).inc()
+        logger.info("Ollama model '%s' %s (keep-alive %ds)", model, action, keep_alive)
+        return True
+
+    async def tick(self, client: httpx.AsyncClient):
+        self.flush()
+        if not self._lead():
+            return
+        if not self.warmed:
+            loaded = await self.loaded(client)
+            for model in self.models:
+                if _model_name(model) not in loaded:
+                    await self._load(client, model, self.keep_alive(1), "warmed")
+                self.record_use(model)
+            self.flush()
+            self.warmed = True
+
+        now = time.time()
+        loaded = await self.loaded(client)
+        usage = {model: self.usage(model, now) for model in self.models}
+
+        budget = settings.OLLAMA_MEMORY_BUDGET
+        # A model partly in GPU memory spilled over; one with none of it
+        # there runs on a CPU-only host, where only the budget applies
+        pressure = ((budget and sum(entry.get("size", 0) for entry in loaded.values()) > budget)
+                    or any(0 < entry.get("size_vram", 0) < entry.get("size", 0)
+                           for entry in loaded.values()))
+        if pressure:
+            idle = [model for model in self.models if _model_name(model) in loaded
+                    and now - usage[model][1] > settings.OLLAMA_KEEP_ALIVE_MIN]
+            if idle:
+                model = min(idle, key=lambda model: usage[model])
+                if await self._load(client, model, 0, "unloaded"):
+                    del loaded[_model_name(model)]
+
+        for model in self.models:
+            entry = loaded.get(_model_name(model))
+            calls, last = usage[model]
+            keep_alive = self.keep_alive(calls)
+            OLLAMA_MODEL_LOADED.labels(model).set(1 if entry else 0)
+            OLLAMA_MODEL_KEEP_ALIVE.labels(model).set(keep_alive)
+            if entry is None or not entry.get("expires_at"):
+                continue
+            target = last + keep_alive
+            expires = _parse_time(entry["expires_at"])
+            if target > now + self.interval and target - expires > self.interval:
+                await self._load(client, model, target - now, "refreshed")
+
+    async def run(self):
+        async with httpx.AsyncClient(base_url=settings.OLLAMA_ENDPOINT,
+                                     **OllamaBackend._client_kwargs()) as client:
+            while True:
+                try:
+                    await self.tick(client)
+                except Exception as e:
+                    logger.warning("Ollama model keeper failed: %r", e)
+                await asyncio.sleep(self.interval)
+
+
+_keeper: Optional[ModelKeeper] = None
+_keeper_lock = threading.Lock()
+
+
+def get_model_keeper() -> ModelKeeper:
+    global _keeper
+    if _keeper is None:
+        with _keeper_lock:
+            if _keeper is None:
+                options = OllamaBackend._generation_parameters("default")
+                _keeper = ModelKeeper(get_store(), OllamaBackend._models(),
+                                      {"num_ctx": options["num_ctx"]}
+                                      if "num_ctx" in options else {})
+    return _keeper
@@ -0,0 +1,42 @@
+import threading
+
+from collections.abc import Mapping
+from typing import Any, Callable, Dict
+
+from utils.logger import logger
+
+
+class LazyRegistry(Mapping):
+    """
+    Read-only mapping whose values are built by a factory on first access.
+
+    Deployments typically use only a few of the registered tools, chains and
+    agents, so nothing is constructed (or imported) until it is requested.
+    """
+
+    def __init__(self, factories: Dict[str, Callable[[], Any]]):
+        self._factories = dict(factories)
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        factory = self._factories[name]
+        with self._lock:
+            if name not in self._instances:
+                logger.info("Building '%s' ...", name)
+                self._instances[name] = factory()
+        return self._instances[name]
+
+    def __iter__(self):
+        return iter(self._factories)
+
+    def __len__(self):
+        return len(self._factories)
+
+    def loaded(self):
+        """Names of the entries that have been built so far."""
+        return list(self._instances)
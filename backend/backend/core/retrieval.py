@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+
+from typing import Dict, List
+
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from utils.logger import logger
+from utils.metrics import span
+from .vectorstore import PersistentVectorIndex
+
+
+class WebRetriever(object):
+    """
+    Retrieval stage for research runs.
+
+    The raw content of web search results is split into chunks, embedded in
+    batches and added to a persistent vector index. Questions then get only
+    the most relevant passages, which keeps the summary prompt bounded while
+    grounding it in the fetched content. The index outlives the run, so
+    research on related topics reuses content indexed earlier. Index reads
+    and writes run in worker threads, off the event loop.
+    """
+
+    def __init__(self, embeddings: Embeddings, index: PersistentVectorIndex,
+                 chunk_size: int, chunk_overlap: int, batch_size: int):
+        self.embeddings = embeddings
+        self.index = index
+        self.batch_size = batch_size
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    async def add_results(self, results: List[Dict]) -> int:
+        """Index the content of Tavily search results; returns the chunks added."""
+        chunks = {}
+        for result in results:
+            content = result.get("raw_content") or result.get("content")
+            if not content:
+                continue
+            for text in self.splitter.split_text(content):
+                digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+                chunks[digest] = (digest, result.get("url", ""), text)
+
+        present = await asyncio.to_thread(self.index.contains, list(chunks))
+        new = [chunk for digest, chunk in chunks.items() if digest not in present]
+
+        added = 0
+        with span("retrieval", "index"):
+            for start in range(0, len(new), self.batch_size):
+                batch = new[start:start + self.batch_size]
+                vectors = await self.embeddings.aembed_documents(
+                    [text for _, _, text in batch])
+                added += await asyncio.to_thread(self.index.add, vectors, batch)
+        logger.info("WebRetriever: Indexed %d new of %d chunks", added, len(chunks))
+        return added
+
+    async def search(self, question: str, k: int) -> List[Dict]:
+        """Return the `k` passages most relevant to `question`."""
+        with span("retrieval", "search"):
+            vector = await self.embeddings.aembed_query(question)
+            matches = await asyncio.to_thread(self.index.search, vector, k)
+        return [{"source": source, "text": text, "score": score}
+                for score, source, text in matches]
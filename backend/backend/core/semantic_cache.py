@@ -0,0 +1,111 @@
+import re
+import time
+
+from typing import Awaitable, Callable, Dict, FrozenSet
+
+from langchain_core.embeddings import Embeddings
+
+from utils.logger import logger
+from utils.metrics import SEMANTIC_CACHE_LOOKUPS, SEMANTIC_CACHE_SIMILARITY
+from .vectorstore import VectorIndex
+
+_NUMBER = re.compile(r"\d+(?:[.,:/-]\d+)*")
+_WORD = re.compile(r"[^\W\d_]+")
+_DATE_WORDS = frozenset(
+    "january february march april may june july august september october november "
+    "december jan feb mar apr jun jul aug sep sept oct nov dec monday tuesday "
+    "wednesday thursday friday saturday sunday today tonight tomorrow yesterday "
+    "weekend".split())
+
+
+def specifics(text: str) -> FrozenSet[str]:
+    """The numbers and date words of a request, which its answer depends on."""
+    text = text.casefold()
+    return frozenset(_NUMBER.findall(text)) | frozenset(
+        word for word in _WORD.findall(text) if word in _DATE_WORDS)
+
+
+class SemanticCache(object):
+    """
+    Answer cache for near-duplicate (paraphrased) requests.
+
+    Requests are embedded and compared against earlier requests of the same
+    namespace (endpoint). A request whose cosine similarity with a cached one
+    reaches `threshold`, within the namespace's freshness window (`ttl`, in
+    seconds), gets the cached answer instead of a new agent or research run.
+    Embeddings barely tell "events in Paris on May 3" from "on May 4", so a
+    cached request only matches if it has the same numbers and date words.
+    The cache lives in process memory; each worker keeps its own.
+    """
+
+    def __init__(self, embeddings: Embeddings, threshold: float,
+                 ttl: Dict[str, int], max_entries: int):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._indexes: Dict[str, VectorIndex] = {}
+
+    async def cached(self, namespace: str, text: str,
+                     compute: Callable[[], Awaitable[str]]) -> str:
+        """Return the cached answer for `text`, or compute and cache it."""
+        try:
+            vector = await self.embeddings.aembed_query(text)
+        except Exception as e:
+            # The cache must never fail a request
+            logger.warning("SemanticCache: Embedding failed: %r", e)
+            SEMANTIC_CACHE_LOOKUPS.labels(namespace, "error").inc()
+            return await compute()
+
+        answer = self._lookup(namespace, text, vector)
+        if answer is not None:
+            return answer
+
+        answer = await compute()
+        if answer:
+            self._store(namespace, text, vector, answer)
+        return answer
+
+    def _lookup(self, namespace, text, vector, candidates=4):
+        index = self._indexes.get(namespace)
+        matches = index.search(vector, k=candidates) if index is not None else []
+        if not matches:
+            SEMANTIC_CACHE_LOOKUPS.labels(namespace, "miss").inc()
+            return None
+
+        SEMANTIC_CACHE_SIMILARITY.labels(namespace).observe(matches[0][0])
+        wanted = specifics(text)
+        similar = [(score, row) for score, row in matches if score >= self.threshold]
+        if not similar:
+            SEMANTIC_CACHE_LOOKUPS.labels(namespace, "miss").inc()
+            return None
+        match = next(((score, row) for score, row in similar
+                      if index.payloads[row]["specifics"] == wanted), None)
+        if match is None:
+            SEMANTIC_CACHE_LOOKUPS.labels(namespace, "mismatch").inc()
+            return None
+
+        score, row = match
+        entry = index.payloads[row]
+        if time.time() - entry["created"] > self.ttl.get(namespace, 0):
+            index.remove(row)
+            SEMANTIC_CACHE_LOOKUPS.labels(namespace, "stale").inc()
+            return None
+
+        logger.info("SemanticCache: Hit in '%s' (similarity %.3f)", namespace, score)
+        SEMANTIC_CACHE_LOOKUPS.labels(namespace, "hit").inc()
+        return entry["answer"]
+
+    def _store(self, namespace, text, vector, answer):
+        index = self._indexes.setdefault(namespace, VectorIndex())
+        if len(index) >= self.max_entries:
+            self._evict(index)
+        index.add(vector, {"text": text, "specifics": specifics(text), "answer": answer,
+                           "created": time.time()})
+
+    def _evict(self, index):
+        # Entries are added in time order, so the oldest live rows come first
+        alive = [row for row, entry in enumerate(index.payloads) if entry is not None]
+        for row in alive[:max(len(alive) // 10, 1)]:
+            index.remove(row)
+        index.compact()
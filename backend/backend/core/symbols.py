@@ -0,0 +1,295 @@
+import ast
+import asyncio
+import json
+import os
+import posixpath
+import re
+
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+from utils.logger import logger
+from utils.metrics import span
+from utils.store import LocalConnection
+
+
+# Definition patterns of the brace-delimited languages, by file extension
+_JS_PATTERNS = [
+    r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(\w+)",
+    r"^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?(?:class|interface|enum)\s+(\w+)",
+    r"^\s*(?:export\s+)?(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s+)?"
+    r"(?:function\b|\([^)]*\)\s*(?::[^=]+)?=>|\w+\s*=>)",
+    r"^\s*(?:export\s+)?type\s+(\w+)\s*(?:<[^>]*>)?\s*=",
+    r"^\s+(?:(?:public|private|protected|static|async|readonly|override)\s+)*"
+    r"(?!(?:if|for|while|switch|catch|return|function)\b)(\w+)\s*\([^)]*\)\s*(?::[^{]+)?\{",
+]
+_BRACE_PATTERNS = {
+    ".js": _JS_PATTERNS, ".jsx": _JS_PATTERNS, ".mjs": _JS_PATTERNS,
+    ".ts": _JS_PATTERNS, ".tsx": _JS_PATTERNS,
+    ".go": [
+        r"^func\s+(?:\([^)]*\)\s*)?(\w+)",
+        r"^type\s+(\w+)",
+    ],
+    ".rs": [
+        r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:const\s+)?(?:async\s+)?(?:unsafe\s+)?fn\s+(\w+)",
+        r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait|type)\s+(\w+)",
+    ],
+}
+_BRACE_PATTERNS = {ext: [re.compile(p) for p in patterns]
+                   for ext, patterns in _BRACE_PATTERNS.items()}
+_LITERALS = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`|//.*$')
+_IDENTIFIER = re.compile(r"\b([A-Za-z_]\w{2,})\b")
+
+SUPPORTED_EXTENSIONS = {".py"} | set(_BRACE_PATTERNS)
+
+
+def _python_definitions(source: str) -> List[dict]:
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+    lines = source.split("\n")
+    definitions = []
+
+    def visit(nodes, scope):
+        for node in nodes:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+                definitions.append({
+                    "name": node.name,
+                    "qualname": f"{scope}.{node.name}" if scope else node.name,
+                    "start": start,
+                    "end": node.end_lineno,
+                    "text": "\n".join(lines[start - 1:node.end_lineno]),
+                })
+                if isinstance(node, ast.ClassDef):
+                    visit(node.body, node.name)
+
+    visit(tree.body, "")
+    return definitions
+
+
+def _brace_definitions(source: str, patterns) -> List[dict]:
+    lines = source.split("\n")
+    definitions = []
+    for number, line in enumerate(lines):
+        for pattern in patterns:
+            match = pattern.match(line)
+            if match:
+                break
+        else:
+            continue
+
+        # The definition ends where its braces balance, or at the first
+        # statement end if it has no body
+        depth, opened, end = 0, False, number
+        for end in range(number, min(number + 500, len(lines))):
+            code = _LITERALS.sub("", lines[end])
+            depth += code.count("{") - code.count("}")
+            opened = opened or "{" in code
+            if (opened and depth <= 0) or (not opened and code.rstrip().endswith(";")):
+                break
+        definitions.append({
+            "name": match.group(1),
+            "qualname": match.group(1),
+            "start": number + 1,
+            "end": end + 1,
+            "text": "\n".join(lines[number:end + 1]),
+        })
+    return definitions
+
+
+def extract_definitions(path: str, source: str) -> List[dict]:
+    """
+    Return the functions, classes and types defined in a source file, as
+    dicts with `name`, `qualname`, `start`/`end` (1-based) and `text`.
+    """
+    extension = posixpath.splitext(path)[1].lower()
+    if extension == ".py":
+        return _python_definitions(source)
+    if extension in _BRACE_PATTERNS:
+        return _brace_definitions(source, _BRACE_PATTERNS[extension])
+    return []
+
+
+class SymbolIndex(object):
+    """
+    Symbol and definition index of the repositories under review.
+
+    Definitions are extracted from file blobs and stored in SQLite keyed by
+    the blob SHA. Blobs are immutable, so an indexed blob is never fetched or
+    parsed again, whichever repository, branch or path it is found in. Each
+    review only fetches the blobs of its head tree that are not indexed yet,
+    at most `max_fetch` of them, nearest to the changed files first; the
+    rest is picked up by later reviews.
+    """
+
+    def __init__(self, directory: str, max_fetch: int, max_file_size: int):
+        self._path = os.path.join(directory, "symbols.sqlite3")
+        self._connection = LocalConnection(self._path)
+        self.max_fetch = max_fetch
+        self.max_file_size = max_file_size
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY)")
+            db.execute("CREATE TABLE IF NOT EXISTS definitions ("
+                       "sha TEXT NOT NULL, name TEXT NOT NULL, data TEXT NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS definitions_name "
+                       "ON definitions (name)")
+
+    def indexed(self, shas: List[str]) -> Set[str]:
+        """Return the subset of `shas` that is already indexed."""
+        found = set()
+        db = self._connection()
+        for start in range(0, len(shas), 500):
+            batch = shas[start:start + 500]
+            found.update(row[0] for row in db.execute(
+                f"SELECT sha FROM blobs WHERE sha IN ({','.join('?' * len(batch))})",
+                batch))
+        return found
+
+    def add(self, sha: str, path: str, source: str):
+        definitions = extract_definitions(path, source)
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if db.execute("SELECT 1 FROM blobs WHERE sha = ?", (sha,)).fetchone() is None:
+                db.execute("INSERT INTO blobs (sha) VALUES (?)", (sha,))
+                db.executemany(
+                    "INSERT INTO definitions (sha, name, data) VALUES (?, ?, ?)",
+                    [(sha, d["name"], json.dumps(d)) for d in definitions])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def lookup(self, names: Iterable[str]) -> List[Tuple[str, dict]]:
+        """Return (blob SHA, definition) pairs of all definitions of `names`."""
+        names = list(names)
+        results = []
+        db = self._connection()
+        for start in range(0, len(names), 500):
+            batch = names[start:start + 500]
+            results.extend((sha, json.loads(data)) for sha, data in db.execute(
+                f"SELECT sha, data FROM definitions WHERE name IN ({','.join('?' * len(batch))})",
+                batch))
+        return results
+
+    async def snapshot(self, tree: List[Tuple[str, str, int]],
+                       changed: Dict[str, str],
+                       fetch: Callable[[str], str],
+                       concurrency: int = 4) -> "RepositorySymbols":
+        """
+        Index one commit of a repository.
+
+        `tree` lists the (path, blob SHA, size) of the files in the commit,
+        `changed` maps the paths of the changed files to their blob SHA, and
+        `fetch` returns the contents of a blob by SHA. Changed files are
+        always indexed. Sources are fetched at most `concurrency` at a time
+        and dropped once parsed. Fetching, parsing and the index queries run
+        in worker threads, off the event loop.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def index(sha, path):
+            async with semaphore:
+                try:
+                    source = await asyncio.to_thread(fetch, sha)
+                except Exception as e:
+                    logger.warning("SymbolIndex: Could not fetch %s: %r", path, e)
+                    return
+                await asyncio.to_thread(self.add, sha, path, source)
+
+        shas = {sha: path for path, sha in changed.items() if sha}
+        present = await asyncio.to_thread(self.indexed, list(shas))
+        changed_missing = [(sha, path) for sha, path in shas.items() if sha not in present]
+
+        files = [(path, sha) for path, sha, size in tree
+                 if posixpath.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS
+                 and size <= self.max_file_size]
+        present = await asyncio.to_thread(self.indexed, [sha for _, sha in files])
+        present |= set(shas)
+        directories = {posixpath.dirname(path) for path in changed}
+        missing = sorted(
+            ((path, sha) for path, sha in files if sha not in present),
+            key=lambda item: min(_distance(posixpath.dirname(item[0]), directory)
+                                 for directory in directories or {""}))
+        missing = list(dict((sha, path) for path, sha in missing).items())
+
+        with span("symbols", "index"):
+            await asyncio.gather(*(index(sha, path) for sha, path
+                                   in changed_missing + missing[:self.max_fetch]))
+        logger.info("SymbolIndex: %d files in tree, %d indexed before, %d fetched",
+                    len(files), len(present), min(len(missing), self.max_fetch))
+
+        paths: Dict[str, List[str]] = {}
+        for path, sha in files:
+            paths.setdefault(sha, []).append(path)
+        for path, sha in changed.items():
+            if sha:
+                paths.setdefault(sha, []).append(path)
+        return RepositorySymbols(self, paths)
+
+
+def _distance(a: str, b: str) -> int:
+    """Number of directory steps between two directories."""
+    a_parts = a.split("/") if a else []
+    b_parts = b.split("/") if b else []
+    common = 0
+    for x, y in zip(a_parts, b_parts):
+        if x != y:
+            break
+        common += 1
+    return len(a_parts) + len(b_parts) - 2 * common
+
+
+class RepositorySymbols(object):
+    """The definitions of one indexed commit of a repository."""
+
+    def __init__(self, index: SymbolIndex, paths: Dict[str, List[str]]):
+        self.index = index
+        self.paths = paths
+
+    def definitions(self, path: str, start: int, end: int, patch: str,
+                    max_lines: int, max_definition_lines: int = 40,
+                    window: int = 30) -> str:
+        """
+        Return the definitions of the symbols referenced by a hunk, formatted
+        for a prompt and limited to `max_lines` lines in total.
+
+        Changed lines are searched before context lines. Definitions in the
+        reviewed file within `window` lines of the hunk are left out, the
+        reviewer sees them already. Of several definitions of one name, the
+        ones nearest to the reviewed file are preferred.
+        """
+        names: Dict[str, None] = {}
+        for prefix in ("+", " "):
+            for line in patch.split("\n"):
+                if line.startswith(prefix) and not line.startswith("+++"):
+                    code = _LITERALS.sub("", line[1:])
+                    names.update((name, None) for name in _IDENTIFIER.findall(code))
+        if not names:
+            return ""
+
+        candidates: Dict[str, List[Tuple[int, str, dict]]] = {}
+        for sha, definition in self.index.lookup(names):
+            for candidate in self.paths.get(sha, []):
+                if (candidate == path and definition["end"] >= start - window
+                        and definition["start"] <= end + window):
+                    continue
+                distance = -1 if candidate == path else _distance(
+                    posixpath.dirname(candidate), posixpath.dirname(path))
+                candidates.setdefault(definition["name"], []).append(
+                    (distance, candidate, definition))
+
+        sections, total = [], 0
+        for name in names:
+            for _, candidate, definition in sorted(
+                candidates.get(name, []), key=lambda c: (c[0], c[1]))[:2]:
+                lines = definition["text"].split("\n")
+                if len(lines) > max_definition_lines:
+                    lines = lines[:max_definition_lines] + ["    ..."]
+                if total + len(lines) > max_lines:
+                    return "\n\n".join(sections)
+                total += len(lines)
+                sections.append(f"# {candidate}:{definition['start']}-{definition['end']}"
+                                f" ({definition['qualname']})\n" + "\n".join(lines))
+        return "\n\n".join(sections)
@@ -1,16 +1,98 @@
+import asyncio
+import base64
+import concurrent.futures
+import difflib
+import httpx
+import json
 import os
 import re
+import threading
+import time
+import zlib
 
 from pydantic import BaseModel, Field
-from typing import Optional, Type
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Type
 
-from langchain.callbacks.manager import CallbackManagerForToolRun
+from langchain.callbacks.manager import (AsyncCallbackManagerForToolRun,
+                                        CallbackManagerForToolRun)
 from langchain_core.tools import Tool, BaseTool
-from langchain_experimental.utilities import PythonREPL
 from langchain_community.tools import TavilySearchResults
-from github import Github, GithubException
+from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper
 
-from utils.logger import logger
+from config import settings
+from utils.logger import logger, truncate
+from utils.metrics import metrics_callback, span
+from utils.resilience import get_upstream
+from utils.store import LocalConnection
+from .registry import LazyRegistry
+
+
+def _tavily_client_kwargs():
+    upstream = get_upstream("tavily")
+    return {"timeout": upstream.httpx_timeout(), "transport": upstream.transport()}
+
+
+class TavilyEndpointAPIWrapper(TavilySearchAPIWrapper):
+    """
+    Tavily API wrapper that posts to the configured `TAVILY_ENDPOINT`
+    instead of the hard-coded public API URL.
+    """
+
+    def _params(self, query, max_results, search_depth, include_domains,
+                exclude_domains, include_answer, include_raw_content,
+                include_images) -> Dict:
+        return {
+            "api_key": self.tavily_api_key.get_secret_value(),
+            "query": query,
+            "max_results": max_results,
+            "search_depth": search_depth,
+            "include_domains": include_domains,
+            "exclude_domains": exclude_domains,
+            "include_answer": include_answer,
+            "include_raw_content": include_raw_content,
+            "include_images": include_images,
+        }
+
+    def raw_results(
+        self,
+        query: str,
+        max_results: Optional[int] = 5,
+        search_depth: Optional[str] = "advanced",
+        include_domains: Optional[List[str]] = [],
+        exclude_domains: Optional[List[str]] = [],
+        include_answer: Optional[bool] = False,
+        include_raw_content: Optional[bool] = False,
+        include_images: Optional[bool] = False,
+    ) -> Dict:
+        params = self._params(query, max_results, search_depth, include_domains,
+                              exclude_domains, include_answer,
+                              include_raw_content, include_images)
+        with span("upstream", "tavily.search"), \
+                httpx.Client(**_tavily_client_kwargs()) as client:
+            response = client.post(f"{settings.TAVILY_ENDPOINT}/search", json=params)
+            response.raise_for_status()
+            return response.json()
+
+    async def raw_results_async(
+        self,
+        query: str,
+        max_results: Optional[int] = 5,
+        search_depth: Optional[str] = "advanced",
+        include_domains: Optional[List[str]] = [],
+        exclude_domains: Optional[List[str]] = [],
+        include_answer: Optional[bool] = False,
+        include_raw_content: Optional[bool] = False,
+        include_images: Optional[bool] = False,
+    ) -> Dict:
+        params = self._params(query, max_results, search_depth, include_domains,
+                              exclude_domains, include_answer,
+                              include_raw_content, include_images)
+        with span("upstream", "tavily.search"):
+            async with httpx.AsyncClient(**_tavily_client_kwargs()) as client:
+                response = await client.post(f"{settings.TAVILY_ENDPOINT}/search",
+                                             json=params)
+                response.raise_for_status()
+                return response.json()
 
 
 class TavilySearchTool(TavilySearchResults):
@@ -19,6 +101,7 @@ class TavilySearchTool(TavilySearchResults):
             raise ValueError("TAVILY_API_KEY environment variable not set")
 
         super().__init__(
+            api_wrapper=TavilyEndpointAPIWrapper(),
             max_results=5,
             search_depth="advanced",
             include_answer=True,
@@ -45,6 +128,8 @@ class TavilySearchTool(TavilySearchResults):
 
 class PythonREPLTool(Tool):
     def __init__(self):
+        from langchain_experimental.utilities import PythonREPL
+
         super().__init__(
             name="python_repl",
             description="""
@@ -60,9 +145,184 @@ you should print it out with `print(...)`.
         )
 
 
+def _github_client_kwargs(token):
+    upstream = get_upstream("github")
+    return {
+        "base_url": settings.GITHUB_ENDPOINT,
+        "headers": {"Authorization": f"Bearer {token}",
+                    "Accept": "application/vnd.github+json"},
+        "timeout": upstream.httpx_timeout(),
+        "transport": upstream.transport(),
+    }
+
+
+class GitHubCache(object):
+    """
+    On-disk cache of GitHub API responses.
+
+    Responses are stored with their ETag and revalidated with `If-None-Match`;
+    a 304 response costs no API quota. Blobs are immutable and stored by
+    SHA, they are never requested twice. Bodies are compressed, and the
+    least recently used entries are evicted beyond `max_size` bytes.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self._connection = LocalConnection(path)
+        self._writes = 0
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, "
+                       "etag TEXT NOT NULL, body BLOB NOT NULL, next TEXT, "
+                       "used REAL NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, "
+                       "body BLOB NOT NULL, used REAL NOT NULL)")
+
+    def response(self, url: str) -> Optional[Tuple[str, bytes, Optional[str]]]:
+        """The cached (ETag, body, next page URL) of `url`, if any."""
+        db = self._connection()
+        row = db.execute("SELECT etag, body, next FROM responses WHERE url = ?",
+                         (url,)).fetchone()
+        if row is None:
+            return None
+        db.execute("UPDATE responses SET used = ? WHERE url = ?", (time.time(), url))
+        return row[0], zlib.decompress(row[1]), row[2]
+
+    def store_response(self, url: str, etag: str, body: bytes, next_url: Optional[str]):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO responses (url, etag, body, next, used) "
+            "VALUES (?, ?, ?, ?, ?)", (url, etag, zlib.compress(body), next_url, time.time()))
+        self._wrote()
+
+    def blob(self, sha: str) -> Optional[bytes]:
+        db = self._connection()
+        row = db.execute("SELECT body FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        if row is None:
+            return None
+        db.execute("UPDATE blobs SET used = ? WHERE sha = ?", (time.time(), sha))
+        return zlib.decompress(row[0])
+
+    def store_blob(self, sha: str, body: bytes):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO blobs (sha, body, used) VALUES (?, ?, ?)",
+            (sha, zlib.compress(body), time.time()))
+        self._wrote()
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used entries beyond `max_size` bytes."""
+        db = self._connection()
+        size = db.execute("SELECT (SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses) "
+                          "+ (SELECT COALESCE(SUM(LENGTH(body)), 0) FROM blobs)").fetchone()[0]
+        if size <= self.max_size:
+            return
+        # Evict down to 80%, so eviction does not run on every write
+        excess = size - int(self.max_size * 0.8)
+        rows = db.execute("SELECT 'responses', url, LENGTH(body), used FROM responses "
+                          "UNION ALL SELECT 'blobs', sha, LENGTH(body), used FROM blobs "
+                          "ORDER BY used").fetchall()
+        evicted = {"responses": [], "blobs": []}
+        for table, key, length, _ in rows:
+            if excess <= 0:
+                break
+            evicted[table].append((key,))
+            excess -= length
+        db.executemany("DELETE FROM responses WHERE url = ?", evicted["responses"])
+        db.executemany("DELETE FROM blobs WHERE sha = ?", evicted["blobs"])
+        logger.info("GitHubCache: Evicted %d entries",
+                    len(evicted["responses"]) + len(evicted["blobs"]))
+
+
+_github_cache = None
+_github_cache_lock = threading.Lock()
+
+
+def get_github_cache() -> GitHubCache:
+    global _github_cache
+    if _github_cache is None:
+        with _github_cache_lock:
+            if _github_cache is None:
+                _github_cache = GitHubCache(
+                    os.path.join(settings.STATE_DIR, "github", "cache.sqlite3"),
+                    max_size=settings.GITHUB_CACHE_MAX_SIZE)
+    return _github_cache
+
+
+class GitHubAPI(object):
+    """GitHub REST API client making conditional requests through `GitHubCache`."""
+
+    def __init__(self, token, cache: GitHubCache):
+        self.cache = cache
+        self.client = httpx.Client(**_github_client_kwargs(token))
+
+    def get(self, url: str, name: str, revalidate: bool = True) -> Tuple[Any, Optional[str]]:
+        """
+        GET `url`; returns the JSON body and the URL of the next page. Without
+        `revalidate`, a cached response is used as it is.
+        """
+        cached = self.cache.response(url)
+        if cached and not revalidate:
+            return json.loads(cached[1]), cached[2]
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        with span("upstream", f"github.{name}"):
+            response = self.client.get(url, headers=headers)
+        if response.status_code == 304:
+            _, body, next_url = cached
+        else:
+            response.raise_for_status()
+            body = response.content
+            next_url = response.links.get("next", {}).get("url")
+            if response.headers.get("etag"):
+                self.cache.store_response(url, response.headers["etag"], body, next_url)
+        return json.loads(body), next_url
+
+    def get_all(self, url: str, name: str) -> List[Any]:
+        """GET all pages of a list."""
+        return list(self.iter_all(url, name))
+
+    def iter_all(self, url: str, name: str, revalidate: bool = True) -> Iterator[Any]:
+        """GET the pages of a list one at a time, yielding their items."""
+        while url:
+            page, url = self.get(url, name, revalidate)
+            yield from page
+
+    def get_blob(self, repo: str, sha: str) -> bytes:
+        body = self.cache.blob(sha)
+        if body is None:
+            with span("upstream", "github.get_git_blob"):
+                response = self.client.get(f"/repos/{repo}/git/blobs/{sha}")
+            response.raise_for_status()
+            body = base64.b64decode(response.json()["content"])
+            self.cache.store_blob(sha, body)
+        return body
+
+    def post(self, url: str, name: str, payload: dict) -> httpx.Response:
+        with span("upstream", f"github.{name}"):
+            return self.client.post(url, json=payload)
+
+
+def _normalize_comment(text):
+    """Comment text without case, markup and punctuation, for comparison."""
+    return " ".join(re.findall(r"\w+", text.lower().replace("_", " ")))
+
+
+# Pull requests share this many comment locks, so the locks do not pile up
+_COMMENT_LOCK_STRIPES = 64
+
+
 class GitHubCommentTool(BaseTool):
     """
     A tool to add comments to GitHub pull requests.
+
+    Before posting, the comments on the pull request are checked for one by
+    the same account that is identical or nearly identical (see
+    `GITHUB_COMMENT_SIMILARITY`), in which case nothing is posted; retries
+    and looping agents thus post a comment once. The comment pages are kept
+    in the `GitHubCache` and revalidated with ETag conditional requests.
     """
 
     class Comment(BaseModel):
@@ -76,7 +336,9 @@ class GitHubCommentTool(BaseTool):
 
     def __init__(self, token, **kwargs):
         super().__init__(**kwargs)
-        self._github = Github(token)
+        self._token = token
+        self._login = None
+        self._locks = [asyncio.Lock() for _ in range(_COMMENT_LOCK_STRIPES)]
 
     def _run(
         self,
@@ -86,14 +348,107 @@ class GitHubCommentTool(BaseTool):
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> dict:
         """Add a comment to a GitHub pull request."""
-        logger.info(
-            f"GitHubCommentTool: Adding comment to PR #{pr_number} in repo {
-                repo}; comment: {comment}"
-        )
-        repository = self._github.get_repo(repo)
-        pull_request = repository.get_pull(pr_number)
-        result = pull_request.create_issue_comment(comment)
-        return {"status": "success", "result": str(result)}
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._add_comment(repo, pr_number, comment))
+        # Called synchronously from within an event loop: run in a thread
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            return executor.submit(asyncio.run, self._add_comment(
+                repo, pr_number, comment)).result()
+
+    async def _arun(
+        self,
+        repo: str,
+        pr_number: int,
+        comment: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> dict:
+        """Add a comment to a GitHub pull request."""
+        # Concurrent calls for one pull request must see each other's comments
+        lock = self._locks[hash((repo, int(pr_number))) % _COMMENT_LOCK_STRIPES]
+        async with lock:
+            return await self._add_comment(repo, pr_number, comment)
+
+    async def _add_comment(self, repo, pr_number, comment):
+        logger.info("GitHubCommentTool: Adding comment to PR #%s in repo %s; comment: %s",
+                    pr_number, repo, truncate(comment))
+        async with httpx.AsyncClient(**_github_client_kwargs(self._token)) as client:
+            duplicate = self._find_duplicate(
+                comment, await self._comments(client, repo, pr_number),
+                await self._user(client))
+            if duplicate is not None:
+                logger.info("GitHubCommentTool: Skipping duplicate of %s", duplicate["url"])
+                return {"status": "duplicate", "result": duplicate["url"],
+                        "message": "The same comment was posted before"}
+            with span("upstream", "github.create_issue_comment"):
+                response = await client.post(f"/repos/{repo}/issues/{pr_number}/comments",
+                                             json={"body": comment})
+                response.raise_for_status()
+        return {"status": "success", "result": response.json().get("html_url")}
+
+    async def _user(self, client):
+        """The login of the token's account, or None if it cannot be told."""
+        if self._login is None:
+            with span("upstream", "github.get_user"):
+                response = await client.get("/user")
+            # App installation tokens have no user; all comments are compared then
+            self._login = response.json().get("login", "") if response.is_success else ""
+        return self._login or None
+
+    async def _comments(self, client, repo, pr_number) -> List[dict]:
+        cache = await asyncio.to_thread(get_github_cache)
+        comments = []
+        url = f"/repos/{repo}/issues/{pr_number}/comments?per_page=100"
+        while url:
+            # The cache is SQLite, kept off the event loop
+            cached = await asyncio.to_thread(cache.response, url)
+            headers = {"If-None-Match": cached[0]} if cached else {}
+            with span("upstream", "github.list_issue_comments"):
+                response = await client.get(url, headers=headers)
+            if response.status_code == 304:
+                _, body, next_url = cached
+            else:
+                response.raise_for_status()
+                body = response.content
+                next_url = response.links.get("next", {}).get("url")
+                if response.headers.get("etag"):
+                    await asyncio.to_thread(cache.store_response, url,
+                                            response.headers["etag"], body, next_url)
+            comments.extend({"body": c.get("body") or "", "url": c.get("html_url"),
+                             "user": (c.get("user") or {}).get("login")}
+                            for c in json.loads(body))
+            url = next_url
+        return comments
+
+    @staticmethod
+    def _find_duplicate(comment, comments, login) -> Optional[dict]:
+        words = _normalize_comment(comment).split()
+        numbers = {word for word in words if word.isdigit()}
+        for existing in comments:
+            if login is not None and existing["user"] != login:
+                continue
+            other = _normalize_comment(existing["body"]).split()
+            if other == words:
+                return existing
+            # Comments on different lines, issues or cases are not duplicates
+            if numbers != {word for word in other if word.isdigit()}:
+                continue
+            matcher = difflib.SequenceMatcher(None, words, other, autojunk=False)
+            if (matcher.real_quick_ratio() >= settings.GITHUB_COMMENT_SIMILARITY
+                    and matcher.quick_ratio() >= settings.GITHUB_COMMENT_SIMILARITY
+                    and matcher.ratio() >= settings.GITHUB_COMMENT_SIMILARITY):
+                return existing
+        return None
+
+
+# Hunk headers and their content, up to the next hunk or the end of the patch
+_HUNK_PATTERN = re.compile(
+    r"(^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@(?:.+?)\n)"
+    r"(.+?)"
+    r"(?=\n@@|\Z)",
+    re.DOTALL | re.MULTILINE,
+)
 
 
 class GitHubPullRequestFilesTool(BaseTool):
@@ -111,76 +466,81 @@ class GitHubPullRequestFilesTool(BaseTool):
 
     def __init__(self, token, **kwargs):
         super().__init__(**kwargs)
-        self._github = Github(token)
+        self._api = GitHubAPI(token, get_github_cache())
 
     def _run(self, repo: str, pr_number: int):
         return self.get_pr_files(repo, pr_number)
 
     def get_pr_files(self, repo, pr_number):
-        repo = self._github.get_repo(repo)
-        pr = repo.get_pull(pr_number)
-        commit = pr.get_commits().reversed[0]
-        files = []
-        for file in pr.get_files():
-            contents = self.get_file_contents(repo, commit, file.filename)
-            print(file.patch)
-            hunks = self.extract_hunks(file.patch)
-            print(hunks)
-            files.append(
-                {
-                    "filename": file.filename,
-                    "additions": file.additions,
-                    "deletions": file.deletions,
-                    "changes": file.changes,
-                    "status": file.status,
-                    "hunks": hunks,
-                    "contents": contents,
-                }
-            )
-        return files
-
-    def get_file_contents(self, repo, commit, file_path):
-        file_content = repo.get_contents(file_path, ref=commit.sha)
-        return file_content.decoded_content.decode("utf-8")
+        return [dict(file, hunks=list(file["hunks"]))
+                for file in self.iter_pr_files(repo, pr_number)]
+
+    def iter_pr_files(self, repo, pr_number, contents=True, revalidate=True):
+        """
+        Yield the files of a pull request one at a time, so a large pull
+        request is never held in memory as a whole. The hunks of a file are
+        parsed as they are consumed. Contents come from the blob cache, and
+        are left out without `contents`. Without `revalidate`, the pull
+        request and its file list are taken from the cache as they are, e.g.
+        when it was revalidated moments ago.
+        """
+        pr, _ = self._api.get(f"/repos/{repo}/pulls/{pr_number}", "get_pull", revalidate)
+        head = pr["head"]["sha"]
+        for file in self._api.iter_all(f"/repos/{repo}/pulls/{pr_number}/files?per_page=100",
+                                       "get_files", revalidate):
+            # The file's blob SHA is that of its contents at the head commit
+            yield {
+                "filename": file["filename"],
+                "sha": file["sha"],
+                "ref": head,
+                "additions": file["additions"],
+                "deletions": file["deletions"],
+                "changes": file["changes"],
+                "status": file["status"],
+                "hunks": self.iter_hunks(file.get("patch") or ""),
+                "contents": (self.get_blob(repo, file["sha"])
+                             if contents and file["status"] != "removed" else ""),
+            }
+
+    def get_tree(self, repo, ref):
+        """Return the (path, blob SHA, size) of every file in a commit."""
+        tree, _ = self._api.get(f"/repos/{repo}/git/trees/{ref}?recursive=1", "get_git_tree")
+        return [(element["path"], element["sha"], element.get("size") or 0)
+                for element in tree["tree"] if element["type"] == "blob"]
+
+    def get_blob(self, repo, sha):
+        return self._api.get_blob(repo, sha).decode("utf-8", errors="replace")
 
     def extract_hunks(self, patch):
         """
         Return a list of hunks from a patch.
-        A hunk is a tuple of (start, end, content), where 'content' includes
-        the full hunk with the header and markers.
+        A hunk is a tuple of (start, end, header, content), where 'header'
+        and 'content' make up the full hunk with its markers.
         """
-        # Regular expression to match hunk headers and their content
-        hunk_pattern = re.compile(
-            r"(^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@(?:.+?)\n)"  # Hunk header
-            r"(.+?)"  # Hunk content
-            r"(?=\n@@|\Z)",  # Lookahead for next hunk or end of patch
-            re.DOTALL | re.MULTILINE,
-        )
+        return list(self.iter_hunks(patch))
 
-        # Find all hunks in the patch
-        matches = hunk_pattern.findall(patch)
-        print(patch)
-        print(matches)
-
-        extracted_hunks = []
-        for header, content in matches:
+    def iter_hunks(self, patch):
+        """Yield the hunks of a patch, see `extract_hunks`, as they are parsed."""
+        for match in _HUNK_PATTERN.finditer(patch):
+            header, content = match.groups()
             # Extract the starting line number from the header
-            match = re.search(r"\+(\d+)", header)
-            if match:
-                start = int(match.group(1))
+            start = re.search(r"\+(\d+)", header)
+            if start:
+                start = int(start.group(1))
                 # Calculate the end line number based on the content
                 end = start + sum(
                     1 for line in content.splitlines() if line.startswith(("+", " "))
                 )
-                # Combine header and content for the full hunk
-                extracted_hunks.append((start, end, header, content))
-
-        return extracted_hunks
+                yield start, end, header, content
 
 
 class GitHubPullRequestPatchCommentTool(BaseTool):
     """
     A tool to add code comments to GitHub pull requests patches.
+
+    A comment with the same path, line and text as one already on the pull
+    request is not posted again, so reviewing a pull request again after a
+    push only adds the comments that are new.
     """
 
     class Comment(BaseModel):
@@ -196,22 +556,50 @@ class GitHubPullRequestPatchCommentTool(BaseTool):
 
     def __init__(self, token, **kwargs):
         super().__init__(**kwargs)
-        self._github = Github(token)
+        self._api = GitHubAPI(token, get_github_cache())
 
     def _run(self, repo, pr_number, comment, path, line):
         return self.add_patch_comment(repo, pr_number, comment, path, line)
 
-    def add_patch_comment(self, repo, pr_number, comment, path, line):
-        repo = self._github.get_repo(repo)
-        pr = repo.get_pull(pr_number)
-        commit = pr.get_commits().reversed[0]
-        try:
-            result = pr.create_review_comment(
-                body=comment, commit=commit, path=path, line=line
-            )
-            return {"status": "success", "result": str(result)}
-        except GithubException as e:
-            return {"status": "error", "message": str(e)}
+    def posted_comments(self, repo, pr_number) -> Set[Tuple[str, int, str]]:
+        """
+        The (path, line, text) of the review comments on a pull request, by
+        their line both at the commit commented on and at the head.
+        """
+        posted = set()
+        for comment in self._api.iter_all(f"/repos/{repo}/pulls/{pr_number}/comments"
+                                          f"?per_page=100", "list_review_comments"):
+            for line in {comment.get("line"), comment.get("original_line")} - {None}:
+                posted.add((comment.get("path"), line, (comment.get("body") or "").strip()))
+        return posted
+
+    def add_patch_comment(self, repo, pr_number, comment, path, line,
+                          posted: Optional[Set[Tuple[str, int, str]]] = None,
+                          commit_id: Optional[str] = None):
+        """
+        Post a review comment on `commit_id`, the commit that was reviewed,
+        by default the head of the pull request. Comments in `posted`, by
+        default the comments on the pull request, are not posted again;
+        `posted` is updated with the comment.
+        """
+        if posted is None:
+            posted = self.posted_comments(repo, pr_number)
+        key = (path, line, comment.strip())
+        if key in posted:
+            logger.info("GitHubPullRequestPatchCommentTool: Skipping duplicate on %s:%s",
+                        path, line)
+            return {"status": "duplicate", "message": "The same comment was posted before"}
+        if commit_id is None:
+            # Revalidating the pull request is free while its head is unchanged
+            pr, _ = self._api.get(f"/repos/{repo}/pulls/{pr_number}", "get_pull")
+            commit_id = pr["head"]["sha"]
+        response = self._api.post(
+            f"/repos/{repo}/pulls/{pr_number}/comments", "create_review_comment",
+            {"body": comment, "commit_id": commit_id, "path": path, "line": line})
+        if response.is_success:
+            posted.add(key)
+            return {"status": "success", "result": response.json().get("html_url")}
+        return {"status": "error", "message": f"{response.status_code} {response.text}"}
 
 
 class ToolRegistry(object):
@@ -220,18 +608,22 @@ class ToolRegistry(object):
 
         github_token = os.getenv("GITHUB_TOKEN", None)
 
-        self.tools = {}
-        self.tools["tavily_search"] = TavilySearchTool()
-        self.tools["python_repl"] = PythonREPLTool()
-        self.tools["github_comment"] = (
-            GitHubCommentTool(github_token) if github_token else None
-        )
-        self.tools["github_pr_files"] = (
-            GitHubPullRequestFilesTool(github_token) if github_token else None
-        )
-        self.tools["github_pr_patch_comment"] = (
-            GitHubPullRequestPatchCommentTool(github_token) if github_token else None
-        )
+        def github_tool(cls):
+            return lambda: self._instrument(cls(github_token) if github_token else None)
+
+        self.tools = LazyRegistry({
+            "tavily_search": lambda: self._instrument(TavilySearchTool()),
+            "python_repl": lambda: self._instrument(PythonREPLTool()),
+            "github_comment": github_tool(GitHubCommentTool),
+            "github_pr_files": github_tool(GitHubPullRequestFilesTool),
+            "github_pr_patch_comment": github_tool(GitHubPullRequestPatchCommentTool),
+        })
+
+    @staticmethod
+    def _instrument(tool):
+        if tool is not None:
+            tool.callbacks = [metrics_callback]
+        return tool
 
     def get_tools(self):
         return self.tools
@@ -0,0 +1,237 @@
+import numpy as np
+import os
+
+from typing import Any, List, Optional, Set, Tuple
+
+from utils.logger import logger
+from utils.store import LocalConnection
+
+
+class VectorIndex(object):
+    """
+    Compact in-memory vector index for cosine similarity search.
+
+    Vectors are normalized and stored as rows of one contiguous float32
+    matrix that grows by doubling, so a search is a single matrix-vector
+    product. Removed rows are masked out and reclaimed by `compact`.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self._capacity = capacity
+        self._vectors: Optional[np.ndarray] = None
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self.payloads: List[Any] = []
+
+    def __len__(self):
+        return int(self._alive[:self._size].sum())
+
+    @staticmethod
+    def normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _grow(self, dim):
+        if self._vectors is None:
+            self._vectors = np.zeros((self._capacity, dim), dtype=np.float32)
+        elif self._size == self._capacity:
+            self._capacity *= 2
+            vectors = np.zeros((self._capacity, dim), dtype=np.float32)
+            vectors[:self._size] = self._vectors[:self._size]
+            alive = np.zeros(self._capacity, dtype=bool)
+            alive[:self._size] = self._alive[:self._size]
+            self._vectors, self._alive = vectors, alive
+
+    def add(self, vector, payload: Any) -> int:
+        """Add a vector with an arbitrary payload; returns its row id."""
+        vector = self.normalize(vector)
+        self._grow(vector.shape[0])
+        row = self._size
+        self._vectors[row] = vector
+        self._alive[row] = True
+        self.payloads.append(payload)
+        self._size += 1
+        return row
+
+    def remove(self, row: int):
+        self._alive[row] = False
+        self.payloads[row] = None
+
+    def search(self, vector, k: int = 1) -> List[Tuple[float, int]]:
+        """Return up to `k` (cosine similarity, row id) pairs, best first."""
+        if not len(self):
+            return []
+        scores = self._vectors[:self._size] @ self.normalize(vector)
+        scores[~self._alive[:self._size]] = -np.inf
+        k = min(k, len(self))
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return [(float(scores[row]), int(row)) for row in rows]
+
+    def compact(self):
+        """Drop removed rows; row ids change."""
+        keep = np.flatnonzero(self._alive[:self._size])
+        self._vectors[:len(keep)] = self._vectors[keep]
+        self._alive[:] = False
+        self._alive[:len(keep)] = True
+        self.payloads = [self.payloads[row] for row in keep]
+        self._size = len(keep)
+
+
+class PersistentVectorIndex(object):
+    """
+    On-disk vector index shared by all worker processes on a host.
+
+    Normalized float32 vectors are appended to a flat file that is searched
+    through a read-only memory map; chunk texts and sources live in SQLite.
+    Chunks are keyed by a content hash, so content that is already indexed
+    is never embedded again. Appends are serialized by a SQLite write
+    transaction; vectors are written before their rows are committed, so
+    readers never see a row without its vector.
+
+    The index holds at most `max_chunks` chunks. When an append would exceed
+    that, the oldest chunks are evicted down to three quarters of it: the
+    kept vectors are copied to a new file of the next generation, so that
+    readers still searching the previous generation are not disturbed.
+    """
+
+    def __init__(self, directory: str, max_chunks: int):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_chunks = max_chunks
+        self._connection = LocalConnection(os.path.join(directory, "chunks.sqlite3"))
+        # (generation, rows, matrix) of the last search
+        self._matrix: Optional[Tuple[int, int, np.ndarray]] = None
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                       "id INTEGER PRIMARY KEY, hash TEXT UNIQUE NOT NULL, "
+                       "source TEXT, text TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                       "key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            # The row count is kept up to date by `add`, counting is a scan
+            db.execute("INSERT OR IGNORE INTO meta (key, value) "
+                       "SELECT 'rows', COUNT(*) FROM chunks")
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+
+    def __len__(self):
+        return self._state(self._connection())[1]
+
+    def _state(self, db) -> Tuple[int, int, Optional[int]]:
+        """The (generation, rows, dim) of the index."""
+        meta = dict(db.execute("SELECT key, value FROM meta "
+                               "WHERE key IN ('generation', 'rows', 'dim')"))
+        dim = meta.get("dim")
+        return int(meta["generation"]), int(meta["rows"]), int(dim) if dim else None
+
+    def _vectors_path(self, generation: int) -> str:
+        name = f"vectors.{generation}.f32" if generation else "vectors.f32"
+        return os.path.join(self.directory, name)
+
+    def contains(self, hashes: List[str]) -> Set[str]:
+        """Return the subset of `hashes` that is already indexed."""
+        found = set()
+        db = self._connection()
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start:start + 500]
+            found.update(row[0] for row in db.execute(
+                f"SELECT hash FROM chunks WHERE hash IN ({','.join('?' * len(batch))})",
+                batch))
+        return found
+
+    def add(self, vectors, items: List[Tuple[str, str, str]]) -> int:
+        """
+        Append vectors with their (hash, source, text) items. Items whose
+        hash is already indexed are skipped; returns the number added.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            seen = self.contains([item[0] for item in items])
+            keep = []
+            for i, item in enumerate(items):
+                if item[0] not in seen:
+                    seen.add(item[0])
+                    keep.append(i)
+            keep = keep[-self.max_chunks:]
+            if not keep:
+                db.execute("COMMIT")
+                return 0
+
+            generation, rows, dim = self._state(db)
+            if dim is None:
+                dim = vectors.shape[1]
+                db.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (str(dim),))
+            elif dim != vectors.shape[1]:
+                raise ValueError(f"Vector size {vectors.shape[1]} does not match index size {dim}")
+
+            if rows + len(keep) > self.max_chunks:
+                generation, rows = self._evict(db, generation, rows, dim,
+                                               self.max_chunks * 3 // 4 - len(keep))
+            with open(self._vectors_path(generation), "ab") as f:
+                # Drop any tail left behind by an interrupted append
+                f.truncate(rows * dim * 4)
+                f.write(vectors[keep].tobytes())
+            db.executemany(
+                "INSERT INTO chunks (id, hash, source, text) VALUES (?, ?, ?, ?)",
+                [(rows + n, *items[i]) for n, i in enumerate(keep)])
+            db.execute("UPDATE meta SET value = ? WHERE key = 'rows'", (rows + len(keep),))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return len(keep)
+
+    def _evict(self, db, generation: int, rows: int, dim: int,
+               keep: int) -> Tuple[int, int]:
+        """Keep the newest `keep` rows in a new generation; returns it and its rows."""
+        keep = max(keep, 0)
+        cut = rows - keep
+        old = np.memmap(self._vectors_path(generation), dtype=np.float32,
+                        mode="r", shape=(rows, dim))
+        with open(self._vectors_path(generation + 1), "wb") as f:
+            f.write(old[cut:].tobytes())
+        del old
+        db.execute("DELETE FROM chunks WHERE id < ?", (cut,))
+        # Through negative ids, so that no renumbered id collides with another
+        db.execute("UPDATE chunks SET id = -1 - (id - ?)", (cut,))
+        db.execute("UPDATE chunks SET id = -1 - id")
+        db.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (generation + 1,))
+        # Readers may still be searching the previous generation
+        stale = self._vectors_path(generation - 1) if generation else None
+        if stale and os.path.exists(stale):
+            os.remove(stale)
+        logger.info("PersistentVectorIndex: Evicted %d oldest chunks", cut)
+        return generation + 1, keep
+
+    def search(self, vector, k: int = 4) -> List[Tuple[float, str, str]]:
+        """Return up to `k` (cosine similarity, source, text) tuples, best first."""
+        db = self._connection()
+        # One read transaction: the vectors and rows of one generation
+        db.execute("BEGIN")
+        try:
+            generation, rows, dim = self._state(db)
+            if not rows or dim is None:
+                return []
+            cached = self._matrix
+            if cached is None or cached[:2] != (generation, rows):
+                cached = (generation, rows, np.memmap(
+                    self._vectors_path(generation), dtype=np.float32,
+                    mode="r", shape=(rows, dim)))
+                self._matrix = cached
+            scores = cached[2] @ VectorIndex.normalize(vector)
+            k = min(k, rows)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+
+            ids = [int(row) for row in best]
+            texts = dict((row[0], row[1:]) for row in db.execute(
+                f"SELECT id, source, text FROM chunks WHERE id IN ({','.join('?' * len(ids))})",
+                ids))
+        finally:
+            db.execute("COMMIT")
+        return [(float(scores[row]), *texts[row]) for row in ids if row in texts]
@@ -0,0 +1,38 @@
+"""
+Gunicorn configuration for the production image.
+
+Runs `WORKERS` uvicorn workers. Before the workers are forked, the master
+process performs a preload phase: it checks (pulls) the Ollama model once
+and records the result in the shared store, so the workers skip the pull.
+Prometheus metrics of all workers are aggregated through a shared
+multiprocess directory.
+"""
+import os
+import shutil
+
+from config import settings
+
+bind = "0.0.0.0:8000"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = settings.WORKERS
+
+# Must be set before prometheus_client is imported by any process
+_metrics_dir = os.path.join(settings.STATE_DIR, "metrics")
+shutil.rmtree(_metrics_dir, ignore_errors=True)
+os.makedirs(_metrics_dir, exist_ok=True)
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = _metrics_dir
+
+
+def on_starting(server):
+    from dotenv import load_dotenv
+    from core.ollama import OllamaBackend
+
+    load_dotenv()
+    load_dotenv("secrets/.env")
+    OllamaBackend.ensure_model()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
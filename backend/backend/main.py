@@ -3,13 +3,18 @@ from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 
-from api.routes import api_router, gradio_routes
+from api.frontend import frontend_router
+from api.quotas import QuotaMiddleware
+from api.routes import api_router
+from config import settings
 from core.context import Context
+from core.ollama import get_model_keeper
+from services.review_queue import start_review_workers
 from utils.logger import logger
 
 from uuid import uuid4
 
-import gradio as gr
+import asyncio
 import os
 
 @asynccontextmanager
@@ -23,17 +28,32 @@ async def lifespan(app: FastAPI):
     os.environ["LANGCHAIN_PROJECT"] = f"LLM app - {unique_id}"
 
     logger.info("Initializing context...")
-    _ = Context()
+    context = Context()
+
+    # Automatic reviews are queued by the GitHub webhook
+    workers = start_review_workers(context) if os.getenv("GITHUB_WEBHOOK_SECRET") else []
+    if settings.OLLAMA_KEEPER_ENABLED:
+        workers.append(asyncio.create_task(get_model_keeper().run()))
 
     yield
 
     logger.info("Application shutting down...")
+    for worker in workers:
+        worker.cancel()
 
 
 app = FastAPI(title="Personal Assistant Backend", lifespan=lifespan)
 
+app.add_middleware(QuotaMiddleware)
+
 # Include API routes
 app.include_router(api_router)
+app.include_router(frontend_router)
+
+# Gradio normally runs as a separate service (python -m api.gradio_ui); it
+# is costly to import, so it is only mounted here on request
+if settings.GRADIO_ENABLED:
+    import gradio as gr
+    from api.gradio_ui import gradio_routes
 
-# Mount Gradio routes
-app = gr.mount_gradio_app(app, gradio_routes, path="/gradio")
+    app = gr.mount_gradio_app(app, gradio_routes, path="/gradio")
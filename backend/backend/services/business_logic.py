@@ -1,86 +1,245 @@
-from core.context import Context
+import asyncio
+
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
-from utils.logger import logger
+from config import settings
+from core.context import Context
 
-import json
+from utils.logger import logger, truncate, SAMPLED
+from utils.metrics import SINGLE_FLIGHT_REQUESTS
+
+
+BatchResult = Tuple[int, Any]
+
+# Executions in flight in this process, by operation and normalized parameters,
+# and the number of callers waiting for each
+_in_flight: Dict[tuple, asyncio.Future] = {}
+_waiters: Dict[tuple, int] = {}
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+async def _single_flight(key: tuple, compute: Callable[[], Awaitable]):
+    """
+    Coalesce concurrent identical requests: the first request for `key`
+    runs `compute`, requests for the same key arriving while it runs wait
+    for and share its result (or exception). The execution is shielded,
+    so it carries on for the others when one of the callers goes away, and
+    is cancelled when the last one does.
+    """
+    future = _in_flight.get(key)
+    if future is not None:
+        logger.info("Joining in-flight %s request", key[0])
+        SINGLE_FLIGHT_REQUESTS.labels(key[0], "follower").inc()
+    else:
+        SINGLE_FLIGHT_REQUESTS.labels(key[0], "leader").inc()
+        future = asyncio.ensure_future(compute())
+        _in_flight[key] = future
+        _waiters[key] = 0
+
+        def done(future):
+            if _in_flight.get(key) is future:
+                del _in_flight[key], _waiters[key]
+            if not future.cancelled():
+                # Mark the exception as retrieved when all callers went away
+                future.exception()
+
+        future.add_done_callback(done)
+
+    _waiters[key] += 1
+    try:
+        return await asyncio.shield(future)
+    finally:
+        if _in_flight.get(key) is future:
+            _waiters[key] -= 1
+            if not _waiters[key] and not future.done():
+                # Nobody wants the result any more; later callers start afresh
+                del _in_flight[key], _waiters[key]
+                future.cancel()
+
+
+async def _cached(context: Context, namespace: str, text: str,
+                  compute: Callable[[], Awaitable[str]]) -> str:
+    """Serve near-duplicate requests from the semantic cache, if enabled."""
+    if context.semantic_cache is None:
+        return await compute()
+    return await context.semantic_cache.cached(namespace, text, compute)
+
+
+async def _as_completed(items: Sequence, func: Callable[[Any], Awaitable],
+                        concurrency: int) -> AsyncIterator[BatchResult]:
+    """
+    Run `func` on every item, at most `concurrency` at a time, and yield
+    (index, result or exception) tuples in completion order. Pending work
+    is cancelled when the consumer stops iterating, e.g. when the client
+    of a streaming response disconnects.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index, item):
+        async with semaphore:
+            try:
+                return index, await func(item)
+            except Exception as e:
+                return index, e
+
+    tasks = [asyncio.ensure_future(run(index, item))
+             for index, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 async def get_test_result(context: Context, subject: str):
-    logger.info(f"Getting test result for subject: {subject}")
+    logger.info("Getting test result for subject: %s", subject)
+    return await _single_flight(
+        ("test", _normalize(subject)),
+        lambda: _cached(context, "test", subject, lambda: _research(context, subject)))
+
+
+async def _research(context: Context, subject: str):
 
     adjacent_chain = context.chains.get_chains()['adjacent_queries_chain']
-    search_tool = context.tools.get_search_tool()
     summary_chain = context.chains.get_chains()['summary_chain']
 
     knowledge = []
     for iter in range(1):
-        queries = await adjacent_chain.ainvoke(subject, 4,
-                                               knowledge="\n".join(knowledge))
-        responses = []
-        for query in queries:
-            artifact = await search_tool.ainvoke_tool_call_artifact(query)
-            response = {"query": query, "answer": artifact["answer"]}
-
-            if False:
-                summary = await summary_chain.ainvoke(query,
-                                                      "\n".join(result["raw_content"]
-                                                                for result in artifact["results"]
-                                                                if result["raw_content"]))
-                response["summary"] = summary
-
-            responses.append(response)
-            knowledge.extend([f"Query: {response["query"]}",
-                              f"Answer: {response["answer"]}",
-                              "========"])
-
-        logger.info(f"Responses iter {iter}: {
-                    json.dumps(responses, indent=4)}")
+        # Each search starts as soon as its query has been generated, while
+        # the model is still generating the next queries
+        searches = []
+        try:
+            async for query in adjacent_chain.astream(subject, 4,
+                                                      knowledge="\n".join(knowledge)):
+                searches.append(asyncio.ensure_future(_search(context, query)))
+            responses = [await search for search in searches]
+        finally:
+            for search in searches:
+                search.cancel()
+
+        for response in responses:
+            knowledge.extend([f"Query: {response['query']}",
+                              f"Answer: {response['answer']}"])
+            knowledge.extend(f"Source ({passage['source']}): {passage['text']}"
+                             for passage in response.get("passages", []))
+            knowledge.append("========")
+
+        logger.info("Responses iter %d: %s", iter, truncate(responses),
+                    extra=SAMPLED)
 
     # summarize knowledge into result
     result = await summary_chain.ainvoke(subject, "\n".join(knowledge))
     return result
 
 
+async def _search(context: Context, query: str):
+    search_tool = context.tools.get_search_tool()
+    artifact = await search_tool.ainvoke_tool_call_artifact(query)
+    response = {"query": query, "answer": artifact["answer"]}
+    if context.retriever is not None:
+        response["passages"] = await _retrieve(context, query, artifact["results"])
+    return response
+
+
+async def _retrieve(context: Context, query: str, results: List[dict]):
+    """Index the raw content of search results; return the top passages for `query`."""
+    try:
+        await context.retriever.add_results(results)
+        return await context.retriever.search(query, settings.RETRIEVAL_TOP_K)
+    except Exception as e:
+        # Retrieval only adds grounding, the research can go on without it
+        logger.warning("Retrieval failed for query '%s': %r", query, e)
+        return []
+
+
 async def get_joke(context: Context, subject: str):
-    logger.info(f"Getting joke for subject: {subject}")
+    logger.info("Getting joke for subject: %s", subject)
     chain = context.chains.get_chains()['joke_chain']
     response = await chain.ainvoke(subject)
-    logger.info(f"Joke response: {response}")
+    logger.info("Joke response: %s", truncate(response), extra=SAMPLED)
 
     return response
 
 
+async def get_jokes(context: Context, subjects: List[str],
+                    concurrency: int) -> AsyncIterator[BatchResult]:
+    logger.info("Getting jokes for %d subjects", len(subjects))
+    chain = context.chains.get_chains()['joke_chain']
+    async for index, response in chain.abatch_as_completed(subjects, concurrency):
+        yield index, response
+
+
 async def get_events(context: Context, location: str, date: str):
-    logger.info(f"Getting events for location: {location} and date: {date}")
+    logger.info("Getting events for location: %s and date: %s", location, date)
     agent = context.agents.get_agents()['events_agent']
-    response = await agent.ainvoke(location, date)
-    logger.info(f"Events response: {response}")
+    response = await _single_flight(
+        ("events", _normalize(location), _normalize(date)),
+        lambda: _cached(context, "events", f"{location} | {date}",
+                        lambda: agent.ainvoke(location, date)))
+    logger.info("Events response: %s", truncate(response), extra=SAMPLED)
 
     return response
 
 
+async def get_events_batch(context: Context, requests: List[Tuple[str, str]],
+                           concurrency: int) -> AsyncIterator[BatchResult]:
+    logger.info("Getting events for %d location/date pairs", len(requests))
+    async for result in _as_completed(
+        requests, lambda request: get_events(context, *request), concurrency
+    ):
+        yield result
+
+
 async def get_query_result(context: Context, query: str):
-    logger.info(f"Answering the query: {query}")
+    logger.info("Answering the query: %s", truncate(query))
     agent = context.agents.get_agents()['python_agent']
-    response = await agent.ainvoke(query)
-    logger.info(f"Query response: {response}")
+    response = await _single_flight(
+        ("query", _normalize(query)),
+        lambda: _cached(context, "query", query, lambda: agent.ainvoke(query)))
+    logger.info("Query response: %s", truncate(response), extra=SAMPLED)
 
     return response
 
 
+async def get_query_results(context: Context, queries: List[str],
+                            concurrency: int) -> AsyncIterator[BatchResult]:
+    logger.info("Answering %d queries", len(queries))
+    async for result in _as_completed(
+        queries, lambda query: get_query_result(context, query), concurrency
+    ):
+        yield result
+
+
 async def add_github_comment(context: Context, repo: str, pr_number: int,
                              request: str):
-    logger.info(f"Adding comment to PR #{pr_number} in repo {
-                repo}; request: {request}")
+    logger.info("Adding comment to PR #%s in repo %s; request: %s",
+                pr_number, repo, truncate(request))
     agent = context.agents.get_agents()['github_comment_agent']
-    response = await agent.ainvoke(repo, pr_number, request)
-    logger.info(f"GitHub comment response: {response}")
+    response = await _single_flight(
+        ("github_comment", repo.lower(), int(pr_number), _normalize(request)),
+        lambda: agent.ainvoke(repo, pr_number, request))
+    logger.info("GitHub comment response: %s", truncate(response),
+                extra=SAMPLED)
     return response
 
 
-async def review_github_pr(context: Context, repo: str, pr_number: int):
-    logger.info(f"Reviewing PR #{pr_number} in repo {repo}")
+async def review_github_pr(context: Context, repo: str, pr_number: int,
+                           timeout: Optional[float] = None, head: Optional[str] = None):
+    """
+    Review a pull request. Reviews queued for a `head` SHA only join other
+    reviews of that head, which have the same timeout: the queue marks the
+    head as reviewed once the review is done.
+    """
+    logger.info("Reviewing PR #%s in repo %s", pr_number, repo)
     agent = context.agents.get_agents()['github_pullrequest_patch_review_agent']
-    response = await agent.ainvoke(repo, pr_number)
+    # The timeout applies within the shared execution, so a review that
+    # times out is cancelled rather than left running without its caller
+    response = await _single_flight(("review", repo.lower(), int(pr_number), head),
+                                    lambda: asyncio.wait_for(agent.ainvoke(repo, pr_number),
+                                                             timeout))
     logger.info("GitHub PR review completed")
     return response
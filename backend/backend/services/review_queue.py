@@ -0,0 +1,214 @@
+"""
+Persistent, debounced queue of automatic pull request reviews.
+
+Pull request webhook events are recorded in a SQLite table in `STATE_DIR`,
+one row per pull request. A new push to a pull request that is already
+queued replaces the queued head and restarts the debounce period, so a
+burst of pushes results in one review of the latest head. A push during a
+review queues one follow-up review. Reviews are claimed by workers in every
+process, while at most `REVIEW_CONCURRENCY` reviews run on the host.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from typing import List, Optional, Tuple
+
+from config import settings
+from core.context import Context
+from utils.logger import logger
+from utils.metrics import REVIEW_QUEUE_EVENTS
+from utils.store import LocalConnection
+from .business_logic import review_github_pr
+
+
+REVIEW_ACTIONS = {"opened", "synchronize", "reopened", "ready_for_review"}
+
+
+class ReviewQueue(object):
+
+    def __init__(self, path: str, debounce: float, concurrency: int,
+                 lease: float, max_attempts: int):
+        self.path = path
+        self.debounce = debounce
+        self.concurrency = concurrency
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._connection = LocalConnection(path)
+        with self._connection() as db:
+            # `head` is the latest head SHA to review, `reviewing` the SHA
+            # under review, or NULL while the review waits for a worker
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS reviews ("
+                "repo TEXT NOT NULL, pr_number INTEGER NOT NULL, head TEXT NOT NULL, "
+                "due REAL NOT NULL, reviewing TEXT, lease REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (repo, pr_number))"
+            )
+
+    def _transaction(self, func):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return result
+
+    def enqueue(self, repo: str, pr_number: int, head: str) -> str:
+        """Queue a review of `head`; returns "queued" or "coalesced"."""
+        due = time.time() + self.debounce
+
+        def enqueue(db):
+            row = db.execute("SELECT head FROM reviews WHERE repo = ? AND pr_number = ?",
+                             (repo, pr_number)).fetchone()
+            if row is None:
+                db.execute("INSERT INTO reviews (repo, pr_number, head, due) "
+                           "VALUES (?, ?, ?, ?)", (repo, pr_number, head, due))
+                return "queued"
+            db.execute("UPDATE reviews SET head = ?, due = ?, attempts = 0 "
+                       "WHERE repo = ? AND pr_number = ?", (head, due, repo, pr_number))
+            return "coalesced"
+
+        result = self._transaction(enqueue)
+        REVIEW_QUEUE_EVENTS.labels(result).inc()
+        logger.info("ReviewQueue: %s review of %s#%s at %s", result.capitalize(),
+                    repo, pr_number, head[:12])
+        return result
+
+    def cancel(self, repo: str, pr_number: int):
+        """Drop a queued review, e.g. when the pull request is closed."""
+        self._connection().execute(
+            "DELETE FROM reviews WHERE repo = ? AND pr_number = ? AND reviewing IS NULL",
+            (repo, pr_number))
+
+    def claim(self) -> Optional[Tuple[str, int, str]]:
+        """Claim the next due review; returns (repo, pr_number, head) or None."""
+        now = time.time()
+
+        def claim(db):
+            running = db.execute("SELECT COUNT(*) FROM reviews WHERE reviewing IS NOT NULL "
+                                 "AND lease >= ?", (now,)).fetchone()[0]
+            if running >= self.concurrency:
+                return None
+            # Reviews whose lease expired were abandoned by a crashed worker
+            row = db.execute(
+                "SELECT repo, pr_number, head FROM reviews WHERE due <= ? "
+                "AND (reviewing IS NULL OR lease < ?) ORDER BY due LIMIT 1",
+                (now, now)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE reviews SET reviewing = head, lease = ?, "
+                       "attempts = attempts + 1 WHERE repo = ? AND pr_number = ?",
+                       (now + self.lease, row[0], row[1]))
+            return row
+
+        return self._transaction(claim)
+
+    def complete(self, repo: str, pr_number: int, head: str):
+        """Finish a review; keeps the row if a newer head was queued meanwhile."""
+        def complete(db):
+            db.execute("DELETE FROM reviews WHERE repo = ? AND pr_number = ? AND head = ?",
+                       (repo, pr_number, head))
+            db.execute("UPDATE reviews SET reviewing = NULL, lease = NULL, attempts = 0 "
+                       "WHERE repo = ? AND pr_number = ?", (repo, pr_number))
+
+        self._transaction(complete)
+        REVIEW_QUEUE_EVENTS.labels("completed").inc()
+
+    def fail(self, repo: str, pr_number: int, head: str):
+        """Retry a failed review with backoff, or drop it after `max_attempts`."""
+        def fail(db):
+            row = db.execute("SELECT head, attempts FROM reviews "
+                             "WHERE repo = ? AND pr_number = ?", (repo, pr_number)).fetchone()
+            if row is None:
+                return "failed"
+            if row[0] == head and row[1] >= self.max_attempts:
+                db.execute("DELETE FROM reviews WHERE repo = ? AND pr_number = ?",
+                           (repo, pr_number))
+                return "dropped"
+            db.execute("UPDATE reviews SET reviewing = NULL, lease = NULL, due = ? "
+                       "WHERE repo = ? AND pr_number = ?",
+                       (time.time() + self.debounce * 2 ** row[1], repo, pr_number))
+            return "failed"
+
+        result = self._transaction(fail)
+        REVIEW_QUEUE_EVENTS.labels(result).inc()
+        return result
+
+    async def work(self, context: Context, poll_interval: float = 1.0):
+        """
+        Worker loop: claim due reviews and run them, until cancelled. The
+        queue is updated in worker threads, off the event loop.
+        """
+        while True:
+            job = await asyncio.to_thread(self.claim)
+            if job is None:
+                await asyncio.sleep(poll_interval)
+                continue
+            repo, pr_number, head = job
+            logger.info("ReviewQueue: Reviewing %s#%s at %s", repo, pr_number, head[:12])
+            try:
+                # A review outliving its lease could be claimed a second time
+                await review_github_pr(context, repo, pr_number, timeout=self.lease,
+                                       head=head)
+            except Exception as e:
+                result = await asyncio.to_thread(self.fail, repo, pr_number, head)
+                logger.error("ReviewQueue: Review of %s#%s %s: %r",
+                             repo, pr_number, result, e)
+            else:
+                await asyncio.to_thread(self.complete, repo, pr_number, head)
+
+
+def handle_pull_request_event(queue: ReviewQueue, payload: dict) -> str:
+    """
+    Queue or cancel a review for a `pull_request` webhook payload. Raises
+    `ValueError` for a payload that is not a pull request event.
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get("pull_request"), dict):
+        raise ValueError("Payload has no pull request")
+    action = payload.get("action")
+    pull_request = payload.get("pull_request") or {}
+    repo = (payload.get("repository") or {}).get("full_name")
+    pr_number = pull_request.get("number")
+    if not repo or not pr_number:
+        return "ignored"
+    if action == "closed":
+        queue.cancel(repo, pr_number)
+        return "cancelled"
+    if action not in REVIEW_ACTIONS or pull_request.get("draft"):
+        return "ignored"
+    head = (pull_request.get("head") or {}).get("sha")
+    if not isinstance(head, str) or not head:
+        raise ValueError("Pull request has no head SHA")
+    return queue.enqueue(repo, pr_number, head)
+
+
+def start_review_workers(context: Context) -> List[asyncio.Task]:
+    """Start this process's review workers; cancel the tasks to stop them."""
+    queue = get_review_queue()
+    logger.info("Starting %d review workers", settings.REVIEW_CONCURRENCY)
+    return [asyncio.create_task(queue.work(context))
+            for _ in range(settings.REVIEW_CONCURRENCY)]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_review_queue() -> ReviewQueue:
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = ReviewQueue(
+                    os.path.join(settings.STATE_DIR, "reviews.sqlite3"),
+                    debounce=settings.REVIEW_DEBOUNCE,
+                    concurrency=settings.REVIEW_CONCURRENCY,
+                    lease=settings.REVIEW_TIMEOUT,
+                    max_attempts=settings.REVIEW_MAX_ATTEMPTS,
+                )
+    return _queue
@@ -0,0 +1,128 @@
+function showResponse(text) {
+    document.getElementById('responseText').innerText = text;
+}
+
+function toggleWordWrap() {
+    const responseText = document.getElementById('responseText');
+    if (responseText.style.whiteSpace === 'pre-wrap') {
+        responseText.style.whiteSpace = 'pre';
+        responseText.style.wordWrap = 'normal';
+    } else {
+        responseText.style.whiteSpace = 'pre-wrap';
+        responseText.style.wordWrap = 'break-word';
+    }
+}
+
+function copyToClipboard() {
+    const responseText = document.getElementById('responseText').innerText;
+    navigator.clipboard.writeText(responseText)
+        .then(() => alert("Copied to clipboard!"))
+        .catch(() => alert("Failed to copy."));
+}
+
+// The API key is asked for once, when the backend requires one, and kept
+// in the browser's local storage
+async function post(path, body, retried = false) {
+    showResponse('Working...');
+    const headers = { 'Content-Type': 'application/json' };
+    const apiKey = localStorage.getItem('apiKey');
+    if (apiKey) {
+        headers['X-API-Key'] = apiKey;
+    }
+    const response = await fetch(path, {
+        method: 'POST',
+        headers: headers,
+        body: JSON.stringify(body)
+    });
+    if (response.status === 401 && !retried) {
+        const key = prompt('API key:');
+        if (key) {
+            localStorage.setItem('apiKey', key);
+            return post(path, body, true);
+        }
+    }
+    if (response.status === 429) {
+        const retryAfter = response.headers.get('Retry-After');
+        showResponse(`Rate limit exceeded, try again in ${retryAfter} seconds.`);
+        return null;
+    }
+    if (!response.ok) {
+        showResponse(`Request failed: ${response.status} ${await response.text()}`);
+        return null;
+    }
+    return response;
+}
+
+async function postText(path, body) {
+    const response = await post(path, body);
+    if (response) {
+        const data = await response.json();
+        showResponse(data.text);
+    }
+}
+
+// Post the non-empty lines of a textarea to a batch endpoint and show the
+// NDJSON results as they stream in, in input order
+async function postBatch(path, elementId) {
+    const lines = document.getElementById(elementId).value
+        .split('\n').map(line => line.trim()).filter(line => line);
+    if (!lines.length) {
+        return;
+    }
+    const response = await post(path, { items: lines.map(text => ({ text })) });
+    if (!response) {
+        return;
+    }
+
+    const results = lines.map(() => '...');
+    const render = () => showResponse(lines.length === 1 ? results[0] :
+        lines.map((line, i) => `${line}\n${results[i]}`).join('\n\n'));
+    render();
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += value;
+        const parts = buffer.split('\n');
+        buffer = parts.pop();
+        for (const part of parts.filter(part => part)) {
+            const item = JSON.parse(part);
+            results[item.index] = item.error ? `Error: ${item.error}` : item.text;
+        }
+        render();
+    }
+}
+
+async function getTestOutput() {
+    const testInputText = document.getElementById('testInputText').value;
+    await postText('/test', { text: testInputText });
+}
+
+async function tellJokes() {
+    await postBatch('/joke/batch', 'jokeInputText');
+}
+
+async function query() {
+    await postBatch('/query/batch', 'queryText');
+}
+
+async function getEvents() {
+    const locationInputText = document.getElementById('locationInputText').value;
+    const dateInputText = document.getElementById('dateInputText').value;
+    await postText('/events', { location: locationInputText, date: dateInputText });
+}
+
+async function addGitHubComment() {
+    const repoInputText = document.getElementById('repoInputText').value;
+    const prNumberInputText = document.getElementById('prNumberInputText').value;
+    const commentInputText = document.getElementById('commentInputText').value;
+    await postText('/github_comment', {
+        repo: repoInputText,
+        pr_number: parseInt(prNumberInputText, 10),
+        comment: commentInputText
+    });
+}
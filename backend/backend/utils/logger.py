@@ -1,4 +1,162 @@
+"""
+Application logging.
+
+Records are put on an in-memory queue by the calling thread and formatted
+and written by a background `QueueListener`, so a request never blocks on
+log I/O. Messages use lazy %-style arguments; large payloads (LLM output,
+patches, agent messages) are wrapped in `truncate()` so they are cut to
+`LOG_PAYLOAD_LIMIT` characters, and strings are only converted to text
+when a record is actually written; other payloads, which could change in
+the meantime, are rendered when the record is queued. Payload records passed `extra=SAMPLED` are
+kept for a `LOG_SAMPLE_RATE` fraction of calls only.
+"""
+import atexit
+import copy
+import datetime
+import decimal
+import enum
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import reprlib
+
+from collections.abc import Mapping
+
+from config import settings
+
+
+class Truncated(object):
+    """
+    Lazily render a value as text, cut to at most `limit` characters.
+    Strings are cut before they are copied; other values are rendered with
+    `reprlib`, which shortens long strings and containers as it goes, so a
+    large value is never converted in full.
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        if not self.limit:
+            return str(self.value)
+        if isinstance(self.value, str):
+            text = self.value
+            if len(text) > self.limit:
+                return f"{text[:self.limit]}... [{len(text) - self.limit} chars truncated]"
+            return text
+        text = _limited_repr(self.limit).repr(self.value)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}... [truncated]"
+        return text
+
+
+def _limited_repr(limit):
+    limited = reprlib.Repr()
+    limited.maxstring = limited.maxother = limit
+    # Enough items to fill the limit, without rendering all of a long container
+    limited.maxlist = limited.maxtuple = limited.maxset = limited.maxfrozenset = \
+        limited.maxdict = limited.maxdeque = limited.maxarray = max(limit // 4, 6)
+    return limited
+
+
+def truncate(value, limit=None):
+    return Truncated(value, settings.LOG_PAYLOAD_LIMIT if limit is None else limit)
+
+
+SAMPLED = {"sampled": True}
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records marked with `extra=SAMPLED`."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and self.rate < 1.0:
+            return random.random() < self.rate
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as single-line JSON objects."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves message formatting to the listener thread.
+
+    The stock `QueueHandler.prepare` formats the message in the calling
+    thread, which is exactly the work we want off the request path. That
+    is only safe for arguments that cannot change before the listener
+    formats them: a record with other arguments, such as a list the caller
+    goes on appending to, is formatted here. `truncate()` keeps that cheap.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        args = record.args.values() if isinstance(record.args, Mapping) else record.args or ()
+        if not isinstance(record.msg, str) or not all(map(_immutable, args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+_SCALARS = (str, bytes, int, float, complex, type(None), datetime.date, datetime.timedelta,
+            decimal.Decimal, enum.Enum)
+
+
+def _immutable(value):
+    if isinstance(value, Truncated):
+        value = value.value
+    if isinstance(value, (tuple, frozenset)):
+        return all(map(_immutable, value))
+    return isinstance(value, _SCALARS)
+
+
+def _setup():
+    if settings.LOG_FORMAT == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+
+    output = logging.StreamHandler()
+    output.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(settings.LOG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(settings.LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, output,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
 
-logging.basicConfig(level=logging.INFO)
+_setup()
+# The listener thread does not survive a fork (gunicorn workers), so every
+# child process gets its own queue and listener
+os.register_at_fork(after_in_child=_setup)
 logger = logging.getLogger("app_logger")
@@ -0,0 +1,311 @@
+"""
+Per-stage latency and token instrumentation.
+
+Stages (chains, agents, tools and upstream HTTP requests) are wrapped in
+`span(kind, name)`, which records the duration in Prometheus and, when the
+OpenTelemetry API is installed, as a trace span. LLM calls and tool calls
+made through LangChain are recorded by `MetricsCallbackHandler`, which
+attributes prompt/completion tokens, tokens/sec and queue wait to the
+enclosing stage. The metrics are exposed on the `/metrics` endpoint. The
+same handler feeds the event log of recorded runs (see `utils.tracing`).
+"""
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import (BaseMessageChunk, message_chunk_to_message,
+                                     message_to_dict)
+from langchain_core.outputs import LLMResult
+from prometheus_client import Counter, Gauge, Histogram
+
+from config import settings
+from .tracing import compact_values, prompt_hash, record_event, tracing
+
+try:
+    from opentelemetry import trace
+    _tracer = trace.get_tracer("llm-assistant")
+except ImportError:
+    _tracer = None
+
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30, 60, 120, 300)
+
+STAGE_DURATION = Histogram(
+    "llm_stage_duration_seconds",
+    "Duration of a pipeline stage (chain, agent, tool, llm, upstream).",
+    ["kind", "name"],
+    buckets=_LATENCY_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "llm_stage_errors_total",
+    "Number of pipeline stages that raised an exception.",
+    ["kind", "name"],
+)
+LLM_QUEUE_WAIT = Histogram(
+    "llm_queue_wait_seconds",
+    "Time an LLM call spent waiting before Ollama started processing it.",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Number of prompt and completion tokens processed by the LLM.",
+    ["stage", "type"],
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "llm_tokens_per_second",
+    "Completion generation speed of an LLM call.",
+    ["stage"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500),
+)
+AGENT_STEPS = Histogram(
+    "llm_agent_steps",
+    "Number of LLM calls made during one agent run.",
+    ["name"],
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50),
+)
+AGENT_EARLY_STOPS = Counter(
+    "llm_agent_early_stops_total",
+    "Agent runs stopped early by a step or time budget or a tool call loop.",
+    ["name", "reason"],
+)
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "single_flight_requests_total",
+    "Requests that started an execution (leader) or joined one in flight (follower).",
+    ["operation", "role"],
+)
+REVIEW_QUEUE_EVENTS = Counter(
+    "review_queue_events_total",
+    "Automatic review queue events (queued, coalesced, completed, failed, dropped).",
+    ["event"],
+)
+RATE_LIMIT_DECISIONS = Counter(
+    "rate_limit_decisions_total",
+    "Rate limited requests by endpoint and result (admitted, limited, unauthorized).",
+    ["endpoint", "result"],
+)
+UPSTREAM_REQUESTS = Counter(
+    "upstream_requests_total",
+    "Upstream requests by outcome (success, failure, rejected by an open circuit).",
+    ["upstream", "outcome"],
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total",
+    "Upstream requests retried after a failure.",
+    ["upstream"],
+)
+CIRCUIT_STATE = Gauge(
+    "upstream_circuit_state",
+    "Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open.",
+    ["upstream"],
+    multiprocess_mode="livemax",
+)
+SEMANTIC_CACHE_LOOKUPS = Counter(
+    "semantic_cache_lookups_total",
+    "Semantic cache lookups by result (hit, miss, mismatch, stale, error).",
+    ["namespace", "result"],
+)
+SEMANTIC_CACHE_SIMILARITY = Histogram(
+    "semantic_cache_similarity",
+    "Cosine similarity of the nearest cached request.",
+    ["namespace"],
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1.0),
+)
+OLLAMA_MODEL_LOADED = Gauge(
+    "ollama_model_loaded",
+    "Whether a configured model is loaded by Ollama: 0 or 1.",
+    ["model"],
+    multiprocess_mode="livemax",
+)
+OLLAMA_MODEL_KEEP_ALIVE = Gauge(
+    "ollama_model_keep_alive_seconds",
+    "Keep-alive the model keeper currently targets per model.",
+    ["model"],
+    multiprocess_mode="livemax",
+)
+OLLAMA_MODEL_ACTIONS = Counter(
+    "ollama_model_actions_total",
+    "Model keeper actions (warmed, refreshed, unloaded, failed).",
+    ["model", "action"],
+)
+
+
+class Span(object):
+    """A running stage; collects counters that are reported when it ends."""
+
+    def __init__(self, kind: str, name: str, parent: Optional["Span"]):
+        self.kind = kind
+        self.name = name
+        self.parent = parent
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.start = time.perf_counter()
+
+    @property
+    def stage(self):
+        return f"{self.kind}:{self.name}"
+
+    def add_llm_call(self, prompt_tokens: int, completion_tokens: int):
+        span = self
+        while span is not None:
+            span.llm_calls += 1
+            span.prompt_tokens += prompt_tokens
+            span.completion_tokens += completion_tokens
+            span = span.parent
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(kind: str, name: str, **attributes):
+    """
+    Time a pipeline stage.
+
+    Works in both synchronous and asynchronous code:
+
+        with span("chain", "JokeChain"):
+            result = await self.chain.ainvoke(subject)
+    """
+    record = Span(kind, name, _current_span.get())
+    token = _current_span.set(record)
+    otel = None
+    if _tracer is not None:
+        otel = _tracer.start_as_current_span(f"{kind}:{name}", attributes=attributes)
+        otel_span = otel.__enter__()
+    try:
+        yield record
+    except BaseException as e:
+        STAGE_ERRORS.labels(kind, name).inc()
+        if otel is not None:
+            otel.__exit__(type(e), e, e.__traceback__)
+            otel = None
+        raise
+    finally:
+        STAGE_DURATION.labels(kind, name).observe(time.perf_counter() - record.start)
+        if kind == "agent":
+            AGENT_STEPS.labels(name).observe(record.llm_calls)
+        if otel is not None:
+            otel_span.set_attribute("llm.calls", record.llm_calls)
+            otel_span.set_attribute("llm.prompt_tokens", record.prompt_tokens)
+            otel_span.set_attribute("llm.completion_tokens", record.completion_tokens)
+            otel.__exit__(None, None, None)
+        _current_span.reset(token)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain callback recording LLM and tool calls.
+
+    Token counts and durations come from the statistics Ollama returns with
+    the final chunk of every response. Queue wait is the part of the wall
+    clock time not covered by Ollama's own `total_duration`: time spent in
+    the client, on the network and waiting for a free model slot.
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        super().__init__()
+        self._starts: Dict[UUID, tuple] = {}
+
+    def _stage(self):
+        span = _current_span.get()
+        return span.stage if span else "unscoped"
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages, *,
+                            run_id: UUID, **kwargs: Any):
+        # A replay compares prompts by hash, to notice diverging runs
+        prompt = prompt_hash(messages[0]) if tracing() else None
+        self._starts[run_id] = (time.perf_counter(), self._stage(), prompt)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts, *,
+                     run_id: UUID, **kwargs: Any):
+        self._starts[run_id] = (time.perf_counter(), self._stage(), None)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        start, stage, prompt = self._starts.pop(run_id, (None, self._stage(), None))
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.labels("llm", stage).observe(elapsed)
+
+        info = {}
+        message = None
+        if response.generations and response.generations[0]:
+            generation = response.generations[0][0]
+            info = generation.generation_info or {}
+            message = getattr(generation, "message", None)
+        prompt_tokens = info.get("prompt_eval_count") or 0
+        completion_tokens = info.get("eval_count") or 0
+        LLM_TOKENS.labels(stage, "prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(stage, "completion").inc(completion_tokens)
+
+        eval_duration = (info.get("eval_duration") or 0) / 1e9
+        if completion_tokens and eval_duration:
+            LLM_TOKENS_PER_SECOND.labels(stage).observe(completion_tokens / eval_duration)
+        total_duration = (info.get("total_duration") or 0) / 1e9
+        queue_wait = max(elapsed - total_duration, 0.0) if total_duration else None
+        if queue_wait is not None:
+            LLM_QUEUE_WAIT.labels(stage).observe(queue_wait)
+
+        span = _current_span.get()
+        if span is not None:
+            span.add_llm_call(prompt_tokens, completion_tokens)
+
+        if tracing():
+            if isinstance(message, BaseMessageChunk):
+                message = message_chunk_to_message(message)
+            record_event("llm", stage=stage, duration=elapsed, queue_wait=queue_wait,
+                         prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                         prompt=prompt,
+                         message=message_to_dict(message) if message is not None else None)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        start, stage, _ = self._starts.pop(run_id, (None, self._stage(), None))
+        STAGE_ERRORS.labels("llm", stage).inc()
+        if start is not None:
+            record_event("llm", stage=stage, duration=time.perf_counter() - start,
+                         error=repr(error))
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *,
+                      run_id: UUID, inputs: Optional[Dict[str, Any]] = None,
+                      **kwargs: Any):
+        name = (serialized or {}).get("name") or kwargs.get("name") or "tool"
+        self._starts[run_id] = (time.perf_counter(), name,
+                                inputs if inputs is not None else input_str)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any):
+        start, name, inputs = self._starts.pop(run_id, (None, None, None))
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.labels("tool", name).observe(elapsed)
+        if tracing():
+            # Search results carry whole web pages: recorded in full on request
+            outputs, truncated = {"output": getattr(output, "content", output),
+                                  "artifact": getattr(output, "artifact", None)}, {}
+            if not settings.TRACE_TOOL_OUTPUTS:
+                outputs, truncated = compact_values(outputs)
+            record_event("tool", name=name, input=inputs, duration=elapsed,
+                         truncated=truncated, **outputs)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        start, name, inputs = self._starts.pop(run_id, (None, "tool", None))
+        STAGE_ERRORS.labels("tool", name).inc()
+        if start is not None:
+            record_event("tool", name=name, input=inputs,
+                         duration=time.perf_counter() - start, error=repr(error))
+
+
+metrics_callback = MetricsCallbackHandler()
@@ -0,0 +1,107 @@
+"""
+Per-user token buckets, shared by all worker processes on a host.
+
+Every user has two buckets in the `SharedStore`: one of request units and
+one of LLM tokens. Request units are taken up front, by the cost of the
+endpoint called. A request is admitted once the bucket holds its cost, or
+the whole burst for a request costing more (a large batch), and is then
+charged its full cost, which may leave the bucket in debt. LLM tokens are
+only known once a request has run, so they are charged afterwards and may
+drive the bucket into debt too. Debt is not capped; a user in debt is
+refused until the bucket has refilled. Buckets refill continuously at their
+per-minute rate up to their burst size.
+"""
+import threading
+import time
+
+from typing import Optional
+
+from config import settings
+from .store import SharedStore, get_store
+
+
+class RateLimiter(object):
+
+    def __init__(self, store: SharedStore, request_rate: float, request_burst: float,
+                 token_rate: float, token_burst: float):
+        self.store = store
+        self.request_rate = request_rate / 60
+        self.request_burst = request_burst
+        self.token_rate = token_rate / 60
+        self.token_burst = token_burst
+        # A bucket left alone this long is full again, so its row may expire
+        self.ttl = max(request_burst / self.request_rate, token_burst / self.token_rate)
+
+    @staticmethod
+    def _key(user: str) -> str:
+        return f"ratelimit:{user}"
+
+    def _refill(self, state: Optional[dict], now: float) -> dict:
+        if state is None:
+            return {"requests": self.request_burst, "tokens": self.token_burst, "updated": now}
+        elapsed = max(now - state["updated"], 0.0)
+        return {
+            "requests": min(self.request_burst, state["requests"] + elapsed * self.request_rate),
+            "tokens": min(self.token_burst, state["tokens"] + elapsed * self.token_rate),
+            "updated": now,
+        }
+
+    def _ttl(self, state: dict) -> float:
+        """Time until the buckets are full again, including any debt."""
+        return max(self.ttl, (self.request_burst - state["requests"]) / self.request_rate,
+                   (self.token_burst - state["tokens"]) / self.token_rate)
+
+    def acquire(self, user: str, cost: float) -> float:
+        """
+        Take `cost` request units from the bucket of `user`. Returns 0 when
+        the request is admitted, or else the seconds to wait before retrying.
+        """
+        now = time.time()
+        wait = 0.0
+        needed = min(cost, self.request_burst)
+
+        def take(state):
+            nonlocal wait
+            state = self._refill(state, now)
+            if state["requests"] < needed:
+                wait = (needed - state["requests"]) / self.request_rate
+            if state["tokens"] < 0:
+                wait = max(wait, -state["tokens"] / self.token_rate)
+            if not wait:
+                state["requests"] -= cost
+            return state
+
+        self.store.update(self._key(user), take, ttl=self._ttl)
+        return wait
+
+    def charge(self, user: str, tokens: int):
+        """Take the LLM tokens used by an admitted request."""
+        if tokens <= 0:
+            return
+        now = time.time()
+
+        def charge(state):
+            state = self._refill(state, now)
+            state["tokens"] -= tokens
+            return state
+
+        self.store.update(self._key(user), charge, ttl=self._ttl)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(
+                    get_store(),
+                    request_rate=settings.RATE_LIMIT_REQUESTS_PER_MINUTE,
+                    request_burst=settings.RATE_LIMIT_REQUEST_BURST,
+                    token_rate=settings.RATE_LIMIT_TOKENS_PER_MINUTE,
+                    token_burst=settings.RATE_LIMIT_TOKEN_BURST,
+                )
+    return _limiter
@@ -0,0 +1,253 @@
+"""
+Timeouts, retries and circuit breaking for upstream services.
+
+Every upstream (Ollama, Tavily, GitHub) has an `Upstream` policy with a
+request deadline, jittered exponential retries and a circuit breaker.
+HTTP clients built on httpx get the policy through `Upstream.transport()`,
+which retries and records every request below the client.
+
+Retries are limited to failures that are safe and worthwhile to retry:
+connection failures, where the request never reached the upstream, and
+429/502/503/504 responses. Read timeouts are only retried for idempotent
+requests, and not at all for POST requests, so a slow model is not given
+the same generation twice. A retry budget, refilled by successful
+requests, stops retries from multiplying the load on an upstream that
+fails most requests; the circuit breaker then fails fast until it has
+recovered.
+"""
+import asyncio
+import random
+import threading
+import time
+
+from typing import Dict
+
+import httpx
+
+from config import settings
+from .logger import logger
+from .metrics import CIRCUIT_STATE, UPSTREAM_REQUESTS, UPSTREAM_RETRIES
+
+
+RETRY_STATUSES = {429, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failures. While open, calls
+    fail fast; after `reset_timeout` seconds one trial call is let through
+    (half-open), and its outcome closes or reopens the circuit. A trial
+    that ends without an outcome, e.g. because it was cancelled, or that
+    takes longer than `reset_timeout`, makes way for another one.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.trial = 0.0
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.labels(name).set(self.state)
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("CircuitBreaker: %s circuit %s", self.name,
+                           ("closed", "half-open", "open")[state])
+            self.state = state
+            CIRCUIT_STATE.labels(self.name).set(state)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if (self.state == self.OPEN and now - self.opened >= self.reset_timeout
+                    or self.state == self.HALF_OPEN and now - self.trial >= self.reset_timeout):
+                self._set_state(self.HALF_OPEN)
+                self.trial = now
+                return True
+            return False
+
+    def release(self):
+        """End a call without an outcome; a pending trial is given up."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.trial = 0.0
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened = time.monotonic()
+                self._set_state(self.OPEN)
+
+
+class Upstream(object):
+
+    def __init__(self, name: str, timeout: float, retries: int = None,
+                 retry_post: bool = False):
+        self.name = name
+        self.timeout = timeout
+        self.retries = settings.UPSTREAM_RETRIES if retries is None else retries
+        self.retry_post = retry_post
+        self.breaker = CircuitBreaker(name, settings.CIRCUIT_FAILURE_THRESHOLD,
+                                      settings.CIRCUIT_RESET_TIMEOUT)
+        self._retry_tokens = float(settings.UPSTREAM_RETRY_BUDGET)
+        self._lock = threading.Lock()
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=settings.UPSTREAM_CONNECT_TIMEOUT)
+
+    def transport(self) -> "ResilientTransport":
+        return ResilientTransport(self)
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (0-based)."""
+        return random.uniform(0, min(settings.UPSTREAM_BACKOFF_MAX,
+                                     settings.UPSTREAM_BACKOFF * 2 ** attempt))
+
+    def before_request(self):
+        if not self.breaker.allow():
+            UPSTREAM_REQUESTS.labels(self.name, "rejected").inc()
+            raise CircuitOpenError(f"Circuit breaker for {self.name} is open")
+
+    def record(self, success: bool):
+        if success:
+            with self._lock:
+                # Every successful request earns a fraction of a retry
+                self._retry_tokens = min(self._retry_tokens + 0.1,
+                                         settings.UPSTREAM_RETRY_BUDGET)
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        UPSTREAM_REQUESTS.labels(self.name, "success" if success else "failure").inc()
+
+    def release(self):
+        """A request ended without an outcome, e.g. because it was cancelled."""
+        self.breaker.release()
+
+    def may_retry(self, attempt: int, request: httpx.Request, error=None) -> bool:
+        if attempt >= self.retries:
+            return False
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            pass
+        elif request.method == "POST" and not self.retry_post:
+            return False
+        elif isinstance(error, httpx.TimeoutException) and request.method not in IDEMPOTENT_METHODS:
+            return False
+        with self._lock:
+            if self._retry_tokens < 1:
+                return False
+            self._retry_tokens -= 1
+        UPSTREAM_RETRIES.labels(self.name).inc()
+        return True
+
+    @staticmethod
+    def failed(response: httpx.Response) -> bool:
+        return response.status_code >= 500 or response.status_code == 429
+
+
+class ResilientTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    httpx transport applying an `Upstream` policy; usable by both sync and
+    async clients, as the Ollama client builds one of each from the same
+    arguments. Retries happen before the response body is read, so a
+    streamed response is never restarted halfway. A sync request made on
+    the thread of a running event loop is not retried, as its backoff would
+    block the loop.
+    """
+
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+        self._sync = httpx.HTTPTransport()
+        self._async = httpx.AsyncHTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        try:
+            asyncio.get_running_loop()
+            may_retry = lambda *args: False  # noqa: E731
+        except RuntimeError:
+            may_retry = self.upstream.may_retry
+        while True:
+            self.upstream.before_request()
+            try:
+                response = self._sync.handle_request(request)
+            except httpx.TransportError as e:
+                self.upstream.record(False)
+                if not may_retry(attempt, request, e):
+                    raise
+            except BaseException:
+                self.upstream.release()
+                raise
+            else:
+                failed = self.upstream.failed(response)
+                self.upstream.record(not failed)
+                if not failed or response.status_code not in RETRY_STATUSES \
+                        or not may_retry(attempt, request):
+                    return response
+                response.close()
+            time.sleep(self.upstream.backoff(attempt))
+            attempt += 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            self.upstream.before_request()
+            try:
+                response = await self._async.handle_async_request(request)
+            except httpx.TransportError as e:
+                self.upstream.record(False)
+                if not self.upstream.may_retry(attempt, request, e):
+                    raise
+            except BaseException:
+                # Cancelled: neither a success nor a failure of the upstream
+                self.upstream.release()
+                raise
+            else:
+                failed = self.upstream.failed(response)
+                self.upstream.record(not failed)
+                if not failed or response.status_code not in RETRY_STATUSES \
+                        or not self.upstream.may_retry(attempt, request):
+                    return response
+                await response.aclose()
+            await asyncio.sleep(self.upstream.backoff(attempt))
+            attempt += 1
+
+    def close(self):
+        self._sync.close()
+
+    async def aclose(self):
+        await self._async.aclose()
+
+
+_upstreams: Dict[str, Upstream] = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name: str) -> Upstream:
+    """The shared policy of the "ollama", "tavily" or "github" upstream."""
+    with _upstreams_lock:
+        if name not in _upstreams:
+            _upstreams[name] = {
+                # Generation and search requests have no side effects
+                "ollama": lambda: Upstream("ollama", settings.OLLAMA_TIMEOUT, retry_post=True),
+                "tavily": lambda: Upstream("tavily", settings.TAVILY_TIMEOUT, retry_post=True),
+                "github": lambda: Upstream("github", settings.GITHUB_TIMEOUT),
+            }[name]()
+        return _upstreams[name]
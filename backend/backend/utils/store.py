@@ -0,0 +1,120 @@
+"""
+Key-value store shared by all worker processes on a host.
+
+Backed by a SQLite database in `STATE_DIR`, so gunicorn workers can share
+readiness flags, caches and rate-limit state without an external service.
+Values are JSON encoded and may expire after a time-to-live.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Any, Callable, Optional, Union
+
+from config import settings
+
+
+class LocalConnection(object):
+    """
+    Callable returning the SQLite connection for the current thread.
+
+    Connections must not cross a fork or be shared between threads, so one is
+    opened per thread and per process, in autocommit mode with WAL journaling.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def __call__(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+
+class SharedStore(object):
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = LocalConnection(path)
+        with self._connection() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)"
+            )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        row = self._connection().execute(
+            "SELECT value, expires FROM kv WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires = time.time() + ttl if ttl else None
+        self._connection().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires),
+        )
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def update(self, key: str, func: Callable[[Any], Any],
+               ttl: Union[float, Callable[[Any], float], None] = None) -> Any:
+        """
+        Atomically replace the value of `key` by `func(value)`.
+
+        `func` receives None when the key is missing or expired. The write
+        lock is held for the duration of the call, so keep `func` cheap.
+        `ttl` may be a function of the new value.
+        """
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT value, expires FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+            current = None
+            if row is not None and (row[1] is None or row[1] >= time.time()):
+                current = json.loads(row[0])
+            value = func(current)
+            if callable(ttl):
+                ttl = ttl(value)
+            expires = time.time() + ttl if ttl else None
+            db.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return value
+
+    def purge_expired(self):
+        self._connection().execute(
+            "DELETE FROM kv WHERE expires IS NOT NULL AND expires < ?", (time.time(),)
+        )
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SharedStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SharedStore(os.path.join(settings.STATE_DIR, "state.sqlite3"))
+    return _store
@@ -0,0 +1,249 @@
+"""
+Event log of agent and chain runs, for performance debugging.
+
+Every top-level agent or chain run wrapped in `trace_run` is recorded as a
+sequence of events: the run's inputs, each LLM call (timings, token counts,
+a hash of the prompt and the model's reply), each tool call (input, output
+and timing) and the outcome. LLM and tool events come from
+`MetricsCallbackHandler`. Inputs and tool outputs longer than
+`TRACE_MAX_INPUT_CHARS` (file contents, fetched web pages) are recorded cut
+short, with their length and hash; `TRACE_TOOL_OUTPUTS` records tool
+outputs in full, as faithful replays need. When a run ends its events are
+queued and appended to a SQLite log in `STATE_DIR` by a background thread,
+so recording never blocks the event loop. The thread prunes runs older
+than `TRACE_RETENTION_DAYS` every hour.
+
+Recorded runs can be replayed against fake model and tool backends with
+`python -m benchmarks.replay`, which separates orchestration overhead from
+model and tool time.
+"""
+import atexit
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+from langchain_core.messages import BaseMessage, messages_to_dict
+
+from config import settings
+from .logger import logger
+from .store import LocalConnection
+
+
+class RunRecorder(object):
+    """The events of one run, collected in memory until it ends."""
+
+    def __init__(self, kind: str, name: str, method: str, inputs: dict):
+        self.id = uuid4().hex
+        self.name = name
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.events: List[dict] = []
+        inputs, truncated = compact_values(inputs)
+        self.add("start", kind=kind, name=name, method=method, inputs=inputs,
+                 truncated=truncated)
+
+    def add(self, type: str, **data):
+        data["type"] = type
+        data["offset"] = time.perf_counter() - self.start
+        self.events.append(data)
+
+
+class RunLog(object):
+
+    # Runs waiting for the writer thread; more are dropped, not waited for
+    MAX_PENDING = 1000
+    # Seconds between prunings of old runs by the writer thread
+    PRUNE_INTERVAL = 3600.0
+
+    def __init__(self, path: str, max_age: Optional[float] = None):
+        self.path = path
+        self.max_age = max_age
+        self._connection = LocalConnection(path)
+        self._pending: Optional[queue.Queue] = None
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        with self._connection() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "run_id TEXT NOT NULL, seq INTEGER NOT NULL, started REAL NOT NULL, "
+                "name TEXT NOT NULL, type TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (run_id, seq))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS events_started ON events (started)")
+
+    def append(self, run: RunRecorder):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT INTO events (run_id, seq, started, name, type, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(run.id, seq, run.started, run.name, event["type"],
+                  json.dumps(event, default=str)) for seq, event in enumerate(run.events)])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def submit(self, run: RunRecorder):
+        """Queue a finished run to be appended by the writer thread."""
+        if self._writer_pid != os.getpid():
+            self._start_writer()
+        try:
+            self._pending.put_nowait(run)
+        except queue.Full:
+            logger.warning("Run log writer is behind, dropping %s run", run.name)
+
+    def flush(self):
+        """Wait until the queued runs are written."""
+        if self._writer_pid == os.getpid():
+            self._pending.join()
+
+    def _start_writer(self):
+        # The writer thread does not survive a fork (gunicorn workers), so
+        # every process starts its own
+        with self._writer_lock:
+            if self._writer_pid != os.getpid():
+                self._pending = queue.Queue(self.MAX_PENDING)
+                threading.Thread(target=self._write, args=(self._pending,),
+                                 name="run-log-writer", daemon=True).start()
+                self._writer_pid = os.getpid()
+                atexit.register(self.flush)
+
+    def _write(self, pending: queue.Queue):
+        pruned = 0.0
+        while True:
+            if self.max_age is not None and time.monotonic() - pruned >= self.PRUNE_INTERVAL:
+                try:
+                    self.prune(self.max_age)
+                except Exception as e:
+                    logger.warning("Could not prune the run log: %r", e)
+                pruned = time.monotonic()
+            try:
+                run = pending.get(timeout=self.PRUNE_INTERVAL)
+            except queue.Empty:
+                continue
+            try:
+                self.append(run)
+            except Exception as e:
+                logger.warning("Could not record %s run: %r", run.name, e)
+            finally:
+                pending.task_done()
+
+    def runs(self, name: Optional[str] = None, limit: int = 20) -> List[dict]:
+        """The most recent runs, newest first, with their outcome."""
+        rows = self._connection().execute(
+            "SELECT s.run_id, s.started, s.name, e.data FROM events s "
+            "LEFT JOIN events e ON e.run_id = s.run_id AND e.type = 'end' "
+            "WHERE s.type = 'start' AND (? IS NULL OR s.name = ?) "
+            "ORDER BY s.started DESC LIMIT ?", (name, name, limit)).fetchall()
+        return [dict(json.loads(end) if end else {}, run_id=run_id, started=started, name=name)
+                for run_id, started, name, end in rows]
+
+    def events(self, run_id: str) -> List[dict]:
+        """The events of a run; `run_id` may be abbreviated."""
+        rows = self._connection().execute(
+            "SELECT run_id, data FROM events WHERE run_id LIKE ? ORDER BY run_id, seq",
+            (run_id + "%",)).fetchall()
+        if len({row[0] for row in rows}) > 1:
+            raise ValueError(f"Ambiguous run id {run_id}")
+        return [json.loads(data) for _, data in rows]
+
+    def prune(self, max_age: float):
+        self._connection().execute("DELETE FROM events WHERE started < ?",
+                                   (time.time() - max_age,))
+
+
+def prompt_hash(messages: List[BaseMessage]) -> str:
+    """Hash of a prompt, leaving out the random message ids."""
+    prompt = [{"type": message["type"],
+               "data": {k: v for k, v in message["data"].items() if k != "id"}}
+              for message in messages_to_dict(messages)]
+    return hashlib.sha256(json.dumps(prompt, sort_keys=True, default=str)
+                          .encode("utf-8")).hexdigest()[:16]
+
+
+def compact_values(values: dict) -> Tuple[dict, dict]:
+    """
+    Run inputs or tool outputs as recorded: values longer than
+    `TRACE_MAX_INPUT_CHARS` (as text, if they are not strings) are cut short.
+    Also returns the length and hash of every value that was cut.
+    """
+    limit = settings.TRACE_MAX_INPUT_CHARS
+    compact, truncated = {}, {}
+    for key, value in values.items():
+        if limit and not isinstance(value, (bool, int, float, type(None))):
+            text = value if isinstance(value, str) else json.dumps(value, default=str)
+            if len(text) > limit:
+                truncated[key] = {
+                    "length": len(text),
+                    "sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+                }
+                value = text[:limit]
+        compact[key] = value
+    return compact, truncated
+
+
+_current_run: ContextVar[Optional[RunRecorder]] = ContextVar("current_run", default=None)
+
+
+def tracing() -> bool:
+    """Whether a run is being recorded in the current context."""
+    return _current_run.get() is not None
+
+
+def record_event(type: str, **data):
+    """Add an event to the run being recorded, if any."""
+    run = _current_run.get()
+    if run is not None:
+        run.add(type, **data)
+
+
+@contextmanager
+def trace_run(kind: str, name: str, method: str = "ainvoke", **inputs):
+    """
+    Record a run of the agent or chain `name`, called as `method(**inputs)`.
+    Runs within a recorded run are part of that run's events.
+    """
+    if not settings.TRACE_ENABLED or _current_run.get() is not None:
+        yield
+        return
+    run = RunRecorder(kind, name, method, inputs)
+    token = _current_run.set(run)
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _current_run.reset(token)
+        run.add("end", duration=time.perf_counter() - run.start, error=error,
+                llm_calls=sum(1 for event in run.events if event["type"] == "llm"),
+                tool_calls=sum(1 for event in run.events if event["type"] == "tool"))
+        try:
+            get_run_log().submit(run)
+        except Exception as e:
+            logger.warning("Could not record %s run: %r", name, e)
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_run_log() -> RunLog:
+    global _log
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                _log = RunLog(os.path.join(settings.STATE_DIR, "runs.sqlite3"),
+                              max_age=settings.TRACE_RETENTION_DAYS * 86400)
+    return _log
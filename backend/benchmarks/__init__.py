@@ -0,0 +1,16 @@
+"""
+Offline performance tooling for the backend.
+
+The application modules use top-level imports (`config`, `core`, ...)
+relative to the `backend/backend` directory, so that directory is put on
+the import path here. Run the tools from the `backend` directory, e.g.
+`python -m benchmarks.run --help`.
+"""
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "backend")
+
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
@@ -0,0 +1,618 @@
+"""
+Local stand-ins for the Ollama, Tavily and GitHub HTTP APIs.
+
+Each fake is a small Starlette app that implements just enough of the real
+API for the backend code paths in `core/` to run unmodified. Latency, token
+throughput and failure rate are configurable through an `UpstreamProfile`,
+so the benchmarks can emulate a fast local GPU as well as a slow, flaky
+upstream. The servers run on their own event loop in a background thread,
+so the simulated upstream work never shows up as event-loop lag of the
+application under test.
+"""
+import asyncio
+import base64
+import contextlib
+import hashlib
+import json
+import random
+import threading
+import time
+
+import uvicorn
+
+from pydantic import BaseModel
+from typing import Dict, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+class UpstreamProfile(BaseModel):
+    """Performance characteristics of a fake upstream."""
+
+    latency: float = 0.05
+    """Seconds before the first byte of a response."""
+
+    jitter: float = 0.0
+    """Uniform random extra latency, in seconds."""
+
+    tokens_per_sec: float = 100.0
+    """Generation speed of the fake model."""
+
+    completion_tokens: int = 64
+    """Number of tokens in a generated text reply."""
+
+    failure_rate: float = 0.0
+    """Fraction of requests answered with an HTTP 503."""
+
+    parallel: int = 0
+    """Replies generated at once, like `OLLAMA_NUM_PARALLEL`; 0 for no limit."""
+
+    seed: Optional[int] = None
+
+
+class FakeUpstream(object):
+    """Base class of the fake upstream apps."""
+
+    def __init__(self, profile: UpstreamProfile):
+        self.profile = profile
+        self.requests = 0
+        self.failures = 0
+        self._random = random.Random(profile.seed)
+
+    async def delay(self):
+        latency = self.profile.latency
+        if self.profile.jitter:
+            latency += self._random.uniform(0, self.profile.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def should_fail(self):
+        self.requests += 1
+        if self._random.random() < self.profile.failure_rate:
+            self.failures += 1
+            return True
+        return False
+
+    def failure(self):
+        return JSONResponse({"error": "injected failure"}, status_code=503)
+
+    def build_app(self) -> Starlette:
+        raise NotImplementedError
+
+
+def _example_value(schema: dict, defs: dict):
+    """Build a minimal value that satisfies a JSON schema."""
+    if "$ref" in schema:
+        schema = defs.get(schema["$ref"].split("/")[-1], {})
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return _example_value(schema[key][0], defs)
+    kind = schema.get("type", "string")
+    if kind == "object":
+        return {
+            name: _example_value(value, defs)
+            for name, value in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return [_example_value(schema.get("items", {}), defs)]
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return True
+    return "benchmark"
+
+
+class FakeOllama(FakeUpstream):
+    """
+    Fake Ollama server.
+
+    Chat requests with bound tools get a tool call for the first tool until
+    the conversation contains a tool result, so ReAct agents run exactly one
+    tool round-trip. JSON-mode requests get `json_reply`. Everything else
+    gets a streamed text reply of `completion_tokens` tokens. Models count
+    as loaded, each taking `model_size` bytes, `vram_size` of them in GPU
+    memory (all by default, 0 for a CPU-only host), until their keep-alive
+    runs out, as reported by `/api/ps`.
+    """
+
+    def __init__(self, profile: UpstreamProfile, json_reply: Optional[dict] = None,
+                 embedding_size: int = 256, model_size: int = 1 << 30,
+                 vram_size: Optional[int] = None):
+        super().__init__(profile)
+        self.embedding_size = embedding_size
+        self.model_size = model_size
+        self.vram_size = model_size if vram_size is None else vram_size
+        self.loaded: Dict[str, float] = {}
+        self._slots = asyncio.Semaphore(profile.parallel) if profile.parallel else None
+        self.json_reply = json_reply or {
+            "queries": [f"benchmark question {i}?" for i in range(4)]
+        }
+
+    def slot(self):
+        """Held while generating; further replies wait for a free slot."""
+        return self._slots or contextlib.nullcontext()
+
+    def _load(self, body):
+        """Load the requested model until its keep-alive runs out, like Ollama."""
+        name = body.get("model", "fake")
+        name = name if ":" in name else f"{name}:latest"
+        keep_alive = body.get("keep_alive")
+        keep_alive = "5m" if keep_alive is None else keep_alive
+        if isinstance(keep_alive, str):
+            units = {"s": 1, "m": 60, "h": 3600}
+            keep_alive = (float(keep_alive[:-1]) * units[keep_alive[-1]]
+                          if keep_alive[-1] in units else float(keep_alive))
+        if keep_alive:
+            self.loaded[name] = time.time() + keep_alive
+        else:
+            self.loaded.pop(name, None)
+
+    def _tool_call(self, tools):
+        function = tools[0]["function"]
+        parameters = function.get("parameters", {})
+        arguments = _example_value(parameters, parameters.get("$defs", {}))
+        return {"function": {"name": function["name"], "arguments": arguments}}
+
+    def _reply(self, body):
+        messages = body.get("messages", [])
+        tools = body.get("tools")
+        if tools and (not messages or messages[-1].get("role") != "tool"):
+            return {"role": "assistant", "content": "", "tool_calls": [self._tool_call(tools)]}
+        if body.get("format"):
+            return {"role": "assistant", "content": json.dumps(self.json_reply)}
+        words = ["token"] * self.profile.completion_tokens
+        return {"role": "assistant", "content": " ".join(words)}
+
+    def _final(self, body, started, prompt_tokens, completion_tokens):
+        elapsed = int((time.perf_counter() - started) * 1e9)
+        return {
+            "model": body.get("model", "fake"),
+            "created_at": "1970-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": elapsed,
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": 0,
+            "eval_count": completion_tokens,
+            "eval_duration": elapsed,
+        }
+
+    async def chat(self, request: Request):
+        body = await request.json()
+        started = time.perf_counter()
+        await self.delay()
+        if self.should_fail():
+            return self.failure()
+        self._load(body)
+
+        message = self._reply(body)
+        prompt_tokens = sum(len(str(m.get("content", "")).split())
+                            for m in body.get("messages", []))
+        words = message["content"].split(" ") if message["content"] else []
+        completion_tokens = max(len(words), 1)
+        interval = 1.0 / self.profile.tokens_per_sec if self.profile.tokens_per_sec else 0
+
+        if not body.get("stream", True):
+            async with self.slot():
+                await asyncio.sleep(interval * completion_tokens)
+            final = self._final(body, started, prompt_tokens, completion_tokens)
+            final["message"] = message
+            return JSONResponse(final)
+
+        async def stream():
+            async with self.slot():
+                for i, word in enumerate(words):
+                    await asyncio.sleep(interval)
+                    chunk = {
+                        "model": body.get("model", "fake"),
+                        "created_at": "1970-01-01T00:00:00Z",
+                        "message": {"role": "assistant",
+                                    "content": word if i == 0 else " " + word},
+                        "done": False,
+                    }
+                    yield json.dumps(chunk) + "\n"
+            final = self._final(body, started, prompt_tokens, completion_tokens)
+            if "tool_calls" in message:
+                final["message"] = message
+            yield json.dumps(final) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    async def pull(self, request: Request):
+        if self.should_fail():
+            return self.failure()
+
+        async def stream():
+            yield json.dumps({"status": "pulling manifest"}) + "\n"
+            yield json.dumps({"status": "success"}) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    async def embed(self, request: Request):
+        """
+        Deterministic bag-of-words embeddings: texts sharing most of their
+        words get similar vectors, like paraphrases with a real model.
+        """
+        body = await request.json()
+        await self.delay()
+        if self.should_fail():
+            return self.failure()
+        self._load(body)
+
+        inputs = body.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        embeddings = []
+        for text in inputs:
+            vector = [0.0] * self.embedding_size
+            for word in text.lower().split():
+                word = word.strip(".,;:!?'\"()")
+                digest = hashlib.sha1(word.encode("utf-8")).digest()
+                vector[int.from_bytes(digest[:4], "little") % self.embedding_size] += 1.0
+            norm = sum(v * v for v in vector) ** 0.5 or 1.0
+            embeddings.append([v / norm for v in vector])
+        return JSONResponse({"model": body.get("model", "fake"), "embeddings": embeddings})
+
+    async def generate(self, request: Request):
+        """Only loading and unloading models, and one-token generations."""
+        body = await request.json()
+        started = time.perf_counter()
+        await self.delay()
+        if self.should_fail():
+            return self.failure()
+        self._load(body)
+        final = self._final(body, started, len(body.get("prompt", "").split()),
+                            1 if body.get("prompt") else 0)
+        del final["message"]
+        final["response"] = "token" if body.get("prompt") else ""
+        return JSONResponse(final)
+
+    async def ps(self, request: Request):
+        now = time.time()
+        models = []
+        for name, expires in list(self.loaded.items()):
+            if expires <= now:
+                del self.loaded[name]
+                continue
+            expires_at = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(expires))
+            models.append({"name": name, "model": name, "size": self.model_size,
+                           "size_vram": self.vram_size,
+                           "expires_at": f"{expires_at}.{int(expires % 1 * 1e9):09d}Z"})
+        return JSONResponse({"models": models})
+
+    async def tags(self, request: Request):
+        return JSONResponse({"models": [{"name": "fake", "model": "fake"}]})
+
+    def build_app(self):
+        return Starlette(routes=[
+            Route("/api/chat", self.chat, methods=["POST"]),
+            Route("/api/pull", self.pull, methods=["POST"]),
+            Route("/api/embed", self.embed, methods=["POST"]),
+            Route("/api/generate", self.generate, methods=["POST"]),
+            Route("/api/ps", self.ps, methods=["GET"]),
+            Route("/api/tags", self.tags, methods=["GET"]),
+        ])
+
+
+class FakeTavily(FakeUpstream):
+    """Fake Tavily search API returning `max_results` synthetic documents."""
+
+    def __init__(self, profile: UpstreamProfile, raw_content_bytes: int = 4000):
+        super().__init__(profile)
+        self.raw_content_bytes = raw_content_bytes
+
+    async def search(self, request: Request):
+        body = await request.json()
+        await self.delay()
+        if self.should_fail():
+            return self.failure()
+
+        query = body.get("query", "")
+        sentence = f"This is synthetic content about {query}. "
+        raw_content = (sentence * (self.raw_content_bytes // len(sentence) + 1))
+        results = [
+            {
+                "title": f"Result {i} for {query}",
+                "url": f"https://example.com/{i}",
+                "content": sentence,
+                "score": 1.0 - i / 10,
+                "raw_content": raw_content[:self.raw_content_bytes]
+                if body.get("include_raw_content") else None,
+            }
+            for i in range(body.get("max_results", 5))
+        ]
+        return JSONResponse({
+            "query": query,
+            "answer": f"A synthetic answer about {query}."
+            if body.get("include_answer") else None,
+            "images": [],
+            "follow_up_questions": None,
+            "results": results,
+            "response_time": self.profile.latency,
+        })
+
+    def build_app(self):
+        return Starlette(routes=[Route("/search", self.search, methods=["POST"])])
+
+
+class FakeGitHub(FakeUpstream):
+    """
+    Fake GitHub REST API serving a synthetic pull request.
+
+    Every pull request has `num_files` Python files of `file_lines` lines,
+    each with `hunks_per_file` hunks that add a few lines calling helpers
+    defined in `num_helpers` other files of the repository tree.
+    """
+
+    def __init__(self, profile: UpstreamProfile, num_files: int = 5,
+                 file_lines: int = 300, hunks_per_file: int = 3,
+                 num_helpers: int = 20):
+        super().__init__(profile)
+        self.num_files = num_files
+        self.num_helpers = num_helpers
+        self.file_lines = file_lines
+        self.hunks_per_file = hunks_per_file
+        self.comments = []
+        self.base_url = ""
+
+    def _contents(self, index):
+        return "\n".join(
+            f"def function_{index}_{line}(value):  # line {line + 1}"
+            if line % 10 == 0 else f"    value = value + {line}"
+            for line in range(self.file_lines)
+        )
+
+    def _patch(self):
+        step = max(self.file_lines // (self.hunks_per_file + 1), 8)
+        hunks = []
+        for hunk in range(self.hunks_per_file):
+            start = 1 + (hunk + 1) * step
+            hunks.append(
+                f"@@ -{start},4 +{start},6 @@ def function():\n"
+                f"     value = value + {start}\n"
+                f"+    value = helper_{hunk}(value) * 2\n"
+                f"+    value = value - 1\n"
+                f"     value = value + {start + 1}\n"
+            )
+        return "".join(hunks).rstrip("\n")
+
+    def _helper(self, index):
+        return (f"def helper_{index}(value):\n"
+                f"    \"\"\"Benchmark helper {index}.\"\"\"\n"
+                f"    return value + {index}\n")
+
+    def _sha(self, *parts):
+        return hashlib.sha1("/".join(str(p) for p in parts).encode()).hexdigest()
+
+    def _repo_url(self, request):
+        return (f"{self.base_url}/repos/{request.path_params['owner']}/"
+                f"{request.path_params['repo']}")
+
+    async def _guard(self):
+        await self.delay()
+        return self.failure() if self.should_fail() else None
+
+    @staticmethod
+    def _conditional(request, payload, headers=None):
+        """JSON response with an ETag; 304 if the client has it already."""
+        content = json.dumps(payload).encode("utf-8")
+        headers = dict(headers or {}, ETag=f'"{hashlib.sha1(content).hexdigest()}"')
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        return Response(content, media_type="application/json", headers=headers)
+
+    async def repo(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        owner, name = request.path_params["owner"], request.path_params["repo"]
+        return self._conditional(request, {
+            "id": 1,
+            "name": name,
+            "full_name": f"{owner}/{name}",
+            "url": self._repo_url(request),
+            "owner": {"login": owner},
+        })
+
+    async def pull(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        number = int(request.path_params["number"])
+        url = f"{self._repo_url(request)}/pulls/{number}"
+        head_sha = self._sha("head", number)
+        return self._conditional(request, {
+            "id": number,
+            "number": number,
+            "url": url,
+            "state": "open",
+            "title": f"Benchmark PR {number}",
+            "head": {"sha": head_sha, "ref": "feature"},
+            "base": {"sha": self._sha("base", number), "ref": "main"},
+            "issue_url": f"{self._repo_url(request)}/issues/{number}",
+        })
+
+    async def commits(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        number = int(request.path_params["number"])
+        sha = self._sha("head", number)
+        return JSONResponse([{"sha": sha, "url": f"{self._repo_url(request)}/commits/{sha}"}])
+
+    async def files(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        per_page = int(request.query_params.get("per_page", 30))
+        page = int(request.query_params.get("page", 1))
+        indexes = range((page - 1) * per_page, min(page * per_page, self.num_files))
+        headers = {}
+        if page * per_page < self.num_files:
+            headers["Link"] = (f'<{self.base_url}{request.url.path}?per_page={per_page}'
+                               f'&page={page + 1}>; rel="next"')
+        return self._conditional(request, [
+            {
+                "sha": self._sha("blob", index),
+                "filename": f"src/module_{index}.py",
+                "status": "modified",
+                "additions": 2 * self.hunks_per_file,
+                "deletions": 0,
+                "changes": 2 * self.hunks_per_file,
+                "patch": self._patch(),
+            }
+            for index in indexes
+        ], headers)
+
+    async def contents(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        path = request.path_params["path"]
+        index = int(path.rsplit("_", 1)[-1].split(".")[0]) if "_" in path else 0
+        data = self._contents(index).encode("utf-8")
+        return JSONResponse({
+            "type": "file",
+            "encoding": "base64",
+            "name": path.rsplit("/", 1)[-1],
+            "path": path,
+            "sha": self._sha("blob", index),
+            "size": len(data),
+            "url": f"{self._repo_url(request)}/contents/{path}",
+            "content": base64.b64encode(data).decode("ascii"),
+        })
+
+    async def tree(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        entries = [(f"src/module_{index}.py", self._sha("blob", index),
+                    len(self._contents(index))) for index in range(self.num_files)]
+        entries += [(f"lib/helpers_{index}.py", self._sha("helper", index),
+                     len(self._helper(index))) for index in range(self.num_helpers)]
+        return self._conditional(request, {
+            "sha": request.path_params["sha"],
+            "url": f"{self._repo_url(request)}/git/trees/{request.path_params['sha']}",
+            "truncated": False,
+            "tree": [{"path": path, "mode": "100644", "type": "blob", "sha": sha,
+                      "size": size, "url": f"{self._repo_url(request)}/git/blobs/{sha}"}
+                     for path, sha, size in entries],
+        })
+
+    async def blob(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        sha = request.path_params["sha"]
+        data = next((self._helper(index) for index in range(self.num_helpers)
+                     if self._sha("helper", index) == sha), None)
+        if data is None:
+            data = next((self._contents(index) for index in range(self.num_files)
+                         if self._sha("blob", index) == sha), "")
+        data = data.encode("utf-8")
+        return JSONResponse({
+            "sha": sha,
+            "size": len(data),
+            "url": f"{self._repo_url(request)}/git/blobs/{sha}",
+            "encoding": "base64",
+            "content": base64.b64encode(data).decode("ascii"),
+        })
+
+    async def create_comment(self, request: Request):
+        if (failure := await self._guard()):
+            return failure
+        body = await request.json()
+        comment_id = len(self.comments) + 1
+        comment = {
+            "id": comment_id,
+            "number": int(request.path_params["number"]),
+            "kind": request.url.path.split("/")[-3],
+            "body": body.get("body", ""),
+            "path": body.get("path"),
+            "line": body.get("line"),
+            "original_line": body.get("line"),
+            "commit_id": body.get("commit_id"),
+            "url": f"{self._repo_url(request)}/comments/{comment_id}",
+            "html_url": f"https://github.com/{request.path_params['owner']}/"
+                        f"{request.path_params['repo']}/pull/{request.path_params['number']}"
+                        f"#issuecomment-{comment_id}",
+            "user": {"login": "benchmark"},
+        }
+        self.comments.append(comment)
+        return JSONResponse(comment, status_code=201)
+
+    async def list_comments(self, request: Request):
+        """
+        Issue or review comments of a pull request, paginated, with ETags
+        like GitHub.
+        """
+        if (failure := await self._guard()):
+            return failure
+        number = int(request.path_params["number"])
+        kind = request.url.path.split("/")[-3]
+        per_page = int(request.query_params.get("per_page", 30))
+        page = int(request.query_params.get("page", 1))
+        comments = [c for c in self.comments if c["kind"] == kind and c["number"] == number]
+        headers = {}
+        if page * per_page < len(comments):
+            headers["Link"] = (f'<{self.base_url}{request.url.path}?per_page={per_page}'
+                               f'&page={page + 1}>; rel="next"')
+        return self._conditional(request, comments[(page - 1) * per_page:page * per_page],
+                                 headers)
+
+    async def user(self, request: Request):
+        return JSONResponse({"login": "benchmark"})
+
+    def build_app(self):
+        prefix = "/repos/{owner}/{repo}"
+        return Starlette(routes=[
+            Route(prefix, self.repo, methods=["GET"]),
+            Route(prefix + "/pulls/{number:int}", self.pull, methods=["GET"]),
+            Route(prefix + "/pulls/{number:int}/commits", self.commits, methods=["GET"]),
+            Route(prefix + "/pulls/{number:int}/files", self.files, methods=["GET"]),
+            Route(prefix + "/pulls/{number:int}/comments", self.create_comment,
+                  methods=["POST"]),
+            Route(prefix + "/pulls/{number:int}/comments", self.list_comments,
+                  methods=["GET"]),
+            Route(prefix + "/issues/{number:int}/comments", self.create_comment,
+                  methods=["POST"]),
+            Route(prefix + "/issues/{number:int}/comments", self.list_comments,
+                  methods=["GET"]),
+            Route("/user", self.user, methods=["GET"]),
+            Route(prefix + "/contents/{path:path}", self.contents, methods=["GET"]),
+            Route(prefix + "/git/trees/{sha}", self.tree, methods=["GET"]),
+            Route(prefix + "/git/blobs/{sha}", self.blob, methods=["GET"]),
+        ])
+
+
+class FakeServer(object):
+    """Serve a fake upstream with uvicorn on a free local port in a thread."""
+
+    def __init__(self, upstream: FakeUpstream):
+        self.upstream = upstream
+        self._server = uvicorn.Server(uvicorn.Config(
+            upstream.build_app(), host="127.0.0.1", port=0,
+            log_level="warning", lifespan="off",
+        ))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self.url = None
+
+    def start(self):
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("Fake upstream server failed to start")
+            time.sleep(0.01)
+        port = self._server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.upstream.base_url = self.url
+        return self
+
+    def stop(self):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,194 @@
+"""
+Benchmark harness: drives the backend against the fake upstreams.
+
+`FakeEnvironment` starts the fake Ollama, Tavily and GitHub servers and points
+the application settings at them. `run_scenario` then calls a coroutine
+factory at a fixed concurrency and collects latency, throughput and
+event-loop lag into a `BenchmarkResult`.
+"""
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+
+from pydantic import BaseModel
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .fakes import (FakeGitHub, FakeOllama, FakeServer, FakeTavily,
+                    UpstreamProfile)
+
+
+class LoopLagMonitor(object):
+    """
+    Measure event-loop lag: how late a periodic `asyncio.sleep` wakes up.
+
+    A request handler that blocks the loop (synchronous I/O, heavy
+    formatting) shows up as lag for every other in-flight request.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - start - self.interval, 0.0))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class BenchmarkResult(BaseModel):
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    duration: float
+    throughput: float
+    latency: Dict[str, float]
+    loop_lag: Dict[str, float]
+    profile: Dict[str, float]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Percentile summary of a list of durations, in milliseconds."""
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0, "max": 0.0}
+    data = np.asarray(values) * 1000.0
+    p50, p95, p99 = np.percentile(data, [50, 95, 99])
+    return {
+        "p50": round(float(p50), 3),
+        "p95": round(float(p95), 3),
+        "p99": round(float(p99), 3),
+        "mean": round(float(data.mean()), 3),
+        "max": round(float(data.max()), 3),
+    }
+
+
+class FakeEnvironment(object):
+    """
+    Start the fake upstreams and configure the application to use them.
+
+    Must be entered before the application `Context` is created, since the
+    tools read their API keys from the environment when they are built.
+    """
+
+    def __init__(self, ollama: UpstreamProfile, tavily: UpstreamProfile,
+                 github: UpstreamProfile, **github_options):
+        self.ollama = FakeServer(FakeOllama(ollama))
+        self.tavily = FakeServer(FakeTavily(tavily))
+        self.github = FakeServer(FakeGitHub(github, **github_options))
+
+    def __enter__(self):
+        for server in (self.ollama, self.tavily, self.github):
+            server.start()
+
+        os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+        os.environ.setdefault("GITHUB_TOKEN", "benchmark")
+        os.environ.setdefault("LANGCHAIN_TRACING_V2", "false")
+
+        from config import settings
+        settings.OLLAMA_ENDPOINT = self.ollama.url
+        settings.TAVILY_ENDPOINT = self.tavily.url
+        settings.GITHUB_ENDPOINT = self.github.url
+        return self
+
+    def __exit__(self, *exc_info):
+        for server in (self.ollama, self.tavily, self.github):
+            server.stop()
+
+
+Scenario = Callable[[int], Awaitable[object]]
+
+
+async def run_scenario(name: str, scenario: Scenario, concurrency: int,
+                       requests: int, profile: Optional[Dict[str, float]] = None
+                       ) -> BenchmarkResult:
+    """Run `requests` calls of `scenario`, at most `concurrency` at a time."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(index):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await scenario(index)
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    duration = time.perf_counter() - start
+    await monitor.stop()
+
+    return BenchmarkResult(
+        scenario=name,
+        concurrency=concurrency,
+        requests=requests,
+        errors=errors,
+        duration=round(duration, 3),
+        throughput=round(len(latencies) / duration, 3) if duration else 0.0,
+        latency=summarize(latencies),
+        loop_lag=summarize(monitor.samples),
+        profile=profile or {},
+    )
+
+
+def save_results(path: str, results: List[BenchmarkResult]):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump([result.model_dump() for result in results], f, indent=2)
+
+
+def load_results(path: str) -> List[BenchmarkResult]:
+    with open(path) as f:
+        return [BenchmarkResult(**result) for result in json.load(f)]
+
+
+def compare_results(results: List[BenchmarkResult],
+                    baseline: List[BenchmarkResult],
+                    tolerance: float = 0.10) -> List[str]:
+    """
+    Compare results against a baseline run.
+
+    Returns a list of regressions: scenarios whose p95 latency grew, or
+    whose throughput dropped, by more than `tolerance` (a fraction).
+    """
+    reference = {(r.scenario, r.concurrency): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get((result.scenario, result.concurrency))
+        if base is None:
+            continue
+        if result.latency["p95"] > base.latency["p95"] * (1 + tolerance):
+            regressions.append(
+                f"{result.scenario}@{result.concurrency}: p95 latency "
+                f"{base.latency['p95']:.1f}ms -> {result.latency['p95']:.1f}ms"
+            )
+        if result.throughput < base.throughput * (1 - tolerance):
+            regressions.append(
+                f"{result.scenario}@{result.concurrency}: throughput "
+                f"{base.throughput:.2f}/s -> {result.throughput:.2f}/s"
+            )
+    return regressions
@@ -0,0 +1,428 @@
+"""
+Load-test the backend with a mixed workload against fake upstreams.
+
+The application runs as in production, under gunicorn with
+`gunicorn.conf.py`, pointed at the fake Ollama, Tavily and GitHub servers
+(see `fakes.py`). Requests arrive in an open loop, at exponentially
+distributed intervals, so a server that falls behind builds up a queue as
+it would under real traffic instead of slowing the load down. A workload
+profile sets the mix of endpoints, their payload sizes and latency SLOs.
+
+Every combination of `--workers` and `--set` values is started in turn, and
+the offered rate is stepped up through `--rates`. For every step the report
+shows per-endpoint latency percentiles and histograms, and the goodput:
+requests answered successfully within their endpoint's SLO, per second.
+The saturation point of a setting is the highest rate whose goodput is at
+least `--keep-up` of the rate actually offered; the setting with the
+highest goodput is reported last.
+Examples, from the `backend` directory:
+
+    python -m benchmarks.load --workload mixed --workers 1 2 4 --rates 1 2 4 8
+    python -m benchmarks.load --workload my-workload.json --set BATCH_CONCURRENCY=2,8
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from pydantic import BaseModel
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import APP_DIR
+from .fakes import UpstreamProfile
+from .harness import FakeEnvironment, summarize
+
+
+class EndpointLoad(BaseModel):
+    """Share and payload of one endpoint in a workload."""
+
+    weight: float
+    """Relative share of the requests."""
+
+    slo: float
+    """Latency within which a successful response counts as goodput, in seconds."""
+
+    words: Tuple[int, int] = (3, 12)
+    """Range of the number of words of the request text."""
+
+    items: int = 10
+    """Items per request, for the batch endpoints."""
+
+    pull_requests: int = 20
+    """Distinct pull requests reviewed; repeated reviews hit the GitHub cache."""
+
+
+class Workload(BaseModel):
+    endpoints: Dict[str, EndpointLoad]
+    rate: float = 2.0
+    """Requests per second, when no `--rates` are given."""
+
+    duration: float = 30.0
+    """Seconds of load per rate."""
+
+    pr_files: int = 5
+    """Files changed in the fake pull requests."""
+
+
+WORKLOADS = {
+    "mixed": Workload(endpoints={
+        "joke": EndpointLoad(weight=0.5, slo=5),
+        "query": EndpointLoad(weight=0.25, slo=30, words=(5, 20)),
+        "test": EndpointLoad(weight=0.15, slo=60),
+        "review": EndpointLoad(weight=0.1, slo=120),
+    }),
+    "interactive": Workload(endpoints={
+        "joke": EndpointLoad(weight=0.6, slo=5),
+        "query": EndpointLoad(weight=0.3, slo=30, words=(5, 20)),
+        "events": EndpointLoad(weight=0.1, slo=30),
+    }),
+    "reviews": Workload(rate=0.5, pr_files=20, endpoints={
+        "review": EndpointLoad(weight=0.8, slo=300, pull_requests=50),
+        "joke": EndpointLoad(weight=0.2, slo=5),
+    }),
+    "batch": Workload(rate=0.5, endpoints={
+        "joke_batch": EndpointLoad(weight=0.7, slo=60, items=20),
+        "joke": EndpointLoad(weight=0.3, slo=5),
+    }),
+}
+
+_WORDS = ("python", "cloud", "robot", "coffee", "river", "market", "music", "garden",
+          "engine", "winter", "planet", "library", "bridge", "signal", "forest")
+
+
+def _text(rng: random.Random, load: EndpointLoad) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(*load.words)))
+
+
+# POST request (path and JSON body) of each endpoint
+Request = Callable[[random.Random, EndpointLoad], Tuple[str, dict]]
+
+ENDPOINTS: Dict[str, Request] = {
+    "joke": lambda rng, load: ("/joke", {"text": _text(rng, load)}),
+    "query": lambda rng, load: ("/query", {"text": _text(rng, load) + "?"}),
+    "test": lambda rng, load: ("/test", {"text": _text(rng, load)}),
+    "events": lambda rng, load: ("/events", {"location": _text(rng, load),
+                                             "date": "tomorrow"}),
+    "review": lambda rng, load: ("/github_review", {
+        "repo": "benchmark/repo", "pr_number": rng.randint(1, load.pull_requests)}),
+    "joke_batch": lambda rng, load: ("/joke/batch", {
+        "items": [{"text": _text(rng, load)} for _ in range(load.items)]}),
+    "query_batch": lambda rng, load: ("/query/batch", {
+        "items": [{"text": _text(rng, load) + "?"} for _ in range(load.items)]}),
+}
+
+# Upper bounds of the latency histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, float("inf"))
+
+
+class EndpointResult(BaseModel):
+    requests: int
+    errors: int
+    slo_misses: int
+    latency: Dict[str, float]
+    histogram: List[int]
+
+
+class LoadStep(BaseModel):
+    setting: Dict[str, str]
+    rate: float
+    requests: int
+    errors: int
+    duration: float
+    offered: float
+    throughput: float
+    goodput: float
+    endpoints: Dict[str, EndpointResult]
+
+
+def load_workload(name: str) -> Workload:
+    if name in WORKLOADS:
+        return WORKLOADS[name]
+    with open(name) as f:
+        workload = Workload(**json.load(f))
+    unknown = set(workload.endpoints) - set(ENDPOINTS)
+    if unknown:
+        raise ValueError(f"Unknown endpoints {sorted(unknown)}, known: {sorted(ENDPOINTS)}")
+    return workload
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class AppServer(object):
+    """The application under gunicorn, configured through its environment."""
+
+    def __init__(self, env: FakeEnvironment, setting: Dict[str, str]):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.state_dir = tempfile.TemporaryDirectory(prefix="llm-assistant-load-")
+        self.env = dict(
+            os.environ,
+            OLLAMA_ENDPOINT=env.ollama.url,
+            TAVILY_ENDPOINT=env.tavily.url,
+            GITHUB_ENDPOINT=env.github.url,
+            STATE_DIR=self.state_dir.name,
+            # Quotas would turn the load into 429s
+            RATE_LIMIT_ENABLED="false",
+            **setting,
+        )
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 60.0):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+             "--bind", f"127.0.0.1:{self.port}", "main:app"],
+            cwd=APP_DIR, env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with status {self.process.returncode}")
+            try:
+                if httpx.get(f"{self.url}/metrics", timeout=1).is_success:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("The application did not start in time")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.state_dir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+async def run_step(client: httpx.AsyncClient, workload: Workload, rate: float,
+                   rng: random.Random, drain: float) -> Tuple[float, Dict[str, list]]:
+    """
+    Offer `rate` requests per second for the workload's duration, then wait
+    up to `drain` seconds for the requests in flight. Returns the elapsed
+    time and, per endpoint, the (latency, success) of every request;
+    requests still running after the drain count as failed.
+    """
+    names = list(workload.endpoints)
+    weights = [workload.endpoints[name].weight for name in names]
+    outcomes: Dict[str, list] = {name: [] for name in names}
+
+    async def call(name):
+        load = workload.endpoints[name]
+        path, body = ENDPOINTS[name](rng, load)
+        start = time.perf_counter()
+        try:
+            async with client.stream("POST", path, json=body) as response:
+                # Batch responses stream; the request ends with the last item
+                async for _ in response.aiter_bytes():
+                    pass
+            success = response.is_success
+        except httpx.HTTPError:
+            success = False
+        outcomes[name].append((time.perf_counter() - start, success))
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = []
+    arrival = start
+    while True:
+        arrival += rng.expovariate(rate)
+        if arrival - start > workload.duration:
+            break
+        await asyncio.sleep(max(arrival - loop.time(), 0))
+        name = rng.choices(names, weights)[0]
+        tasks.append((name, asyncio.create_task(call(name))))
+
+    pending = set()
+    if tasks:
+        _, pending = await asyncio.wait([task for _, task in tasks], timeout=drain)
+    for name, task in tasks:
+        if task in pending:
+            task.cancel()
+            outcomes[name].append((float("inf"), False))
+    return loop.time() - start, outcomes
+
+
+def step_result(setting: Dict[str, str], rate: float, workload: Workload,
+                elapsed: float, outcomes: Dict[str, list]) -> LoadStep:
+    endpoints = {}
+    for name, results in outcomes.items():
+        slo = workload.endpoints[name].slo
+        histogram = [0] * len(HISTOGRAM_BUCKETS)
+        for latency, _ in results:
+            histogram[bisect.bisect_left(HISTOGRAM_BUCKETS, latency)] += 1
+        latencies = [latency for latency, success in results if success]
+        endpoints[name] = EndpointResult(
+            requests=len(results),
+            errors=sum(1 for _, success in results if not success),
+            slo_misses=sum(1 for latency in latencies if latency > slo),
+            latency=summarize(latencies),
+            histogram=histogram,
+        )
+    requests = sum(result.requests for result in endpoints.values())
+    errors = sum(result.errors for result in endpoints.values())
+    good = sum(result.requests - result.errors - result.slo_misses
+               for result in endpoints.values())
+    return LoadStep(
+        setting=setting, rate=rate, requests=requests, errors=errors,
+        duration=round(elapsed, 3),
+        offered=round(requests / workload.duration, 3),
+        throughput=round((requests - errors) / workload.duration, 3),
+        goodput=round(good / workload.duration, 3),
+        endpoints=endpoints,
+    )
+
+
+def print_step(step: LoadStep):
+    print(f"  rate={step.rate:<6g} requests={step.requests:<5d} errors={step.errors:<4d} "
+          f"offered={step.offered:7.2f}/s throughput={step.throughput:7.2f}/s "
+          f"goodput={step.goodput:7.2f}/s")
+    for name, result in step.endpoints.items():
+        histogram = " ".join(f"{count:>4d}" for count in result.histogram)
+        print(f"    {name:<11s} n={result.requests:<5d} err={result.errors:<4d} "
+              f"slo_miss={result.slo_misses:<4d} p50={result.latency['p50']:9.1f}ms "
+              f"p95={result.latency['p95']:9.1f}ms p99={result.latency['p99']:9.1f}ms "
+              f"| {histogram}")
+
+
+def saturation(steps: List[LoadStep], keep_up: float) -> Optional[float]:
+    """The highest rate, below any that fell behind, whose goodput kept up."""
+    sustained = None
+    for step in sorted(steps, key=lambda step: step.rate):
+        if step.goodput < keep_up * step.offered:
+            break
+        sustained = step.rate
+    return sustained
+
+
+def parse_setting(values: List[str]) -> Dict[str, List[str]]:
+    settings = {}
+    for value in values:
+        name, _, choices = value.partition("=")
+        if not name or not choices:
+            raise argparse.ArgumentTypeError(f"Expected NAME=VALUE[,VALUE...], got {value}")
+        settings[name] = choices.split(",")
+    return settings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workload", default="mixed",
+                        help=f"one of {', '.join(WORKLOADS)}, or a JSON file "
+                             f"holding a `Workload`")
+    parser.add_argument("--rates", type=float, nargs="+",
+                        help="offered requests per second, stepped up in turn")
+    parser.add_argument("--duration", type=float, help="seconds of load per rate")
+    parser.add_argument("--drain", type=float,
+                        help="seconds to wait for requests in flight after each "
+                             "rate (default: the largest SLO)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1],
+                        help="gunicorn worker counts to compare")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=V1,V2",
+                        help="application setting values to compare; repeatable")
+    parser.add_argument("--keep-up", type=float, default=0.95,
+                        help="goodput fraction of the offered rate a setting must "
+                             "reach to sustain it (default: 0.95)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="upstream time to first byte, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=100.0)
+    parser.add_argument("--completion-tokens", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--ollama-parallel", type=int, default=4,
+                        help="replies the fake Ollama generates at once (0: no limit)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the steps as JSON to this path")
+    return parser.parse_args(argv)
+
+
+async def run_setting(url: str, workload: Workload, rates: List[float], drain: float,
+                      setting: Dict[str, str], seed: int) -> List[LoadStep]:
+    rng = random.Random(seed)
+    steps = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(base_url=url, timeout=None, limits=limits) as client:
+        for rate in rates:
+            elapsed, outcomes = await run_step(client, workload, rate, rng, drain)
+            step = step_result(setting, rate, workload, elapsed, outcomes)
+            print_step(step)
+            steps.append(step)
+    return steps
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workload = load_workload(args.workload)
+    if args.duration:
+        workload = workload.model_copy(update={"duration": args.duration})
+    rates = sorted(args.rates or [workload.rate])
+    drain = args.drain or max(load.slo for load in workload.endpoints.values())
+    choices = dict(WORKERS=[str(workers) for workers in args.workers],
+                   **parse_setting(args.set))
+    profile = UpstreamProfile(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_sec=args.tokens_per_sec,
+        completion_tokens=args.completion_tokens,
+        failure_rate=args.failure_rate,
+        parallel=args.ollama_parallel,
+        seed=args.seed,
+    )
+
+    def describe(setting):
+        return " ".join(f"{name}={value}" for name, value in setting.items())
+
+    print(f"Histogram buckets (s): {' '.join(f'{b:g}' for b in HISTOGRAM_BUCKETS)}")
+    results: List[LoadStep] = []
+    summary = []
+    with FakeEnvironment(profile, profile, profile, num_files=workload.pr_files) as env:
+        for values in itertools.product(*choices.values()):
+            setting = dict(zip(choices, values))
+            print(describe(setting))
+            with AppServer(env, setting) as server:
+                steps = asyncio.run(run_setting(server.url, workload, rates, drain,
+                                                setting, args.seed))
+            results.extend(steps)
+            summary.append((setting, max(step.goodput for step in steps),
+                            saturation(steps, args.keep_up)))
+
+    print("Summary:")
+    for setting, goodput, sustained in summary:
+        sustained = f"{sustained:g}/s" if sustained is not None else f"below {rates[0]:g}/s"
+        print(f"  {describe(setting):<40s} max goodput={goodput:7.2f}/s "
+              f"saturation={sustained}")
+    best = max(summary, key=lambda entry: entry[1])
+    print(f"Best: {describe(best[0])} ({best[1]:.2f}/s goodput)")
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump([step.model_dump() for step in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Replay recorded agent and chain runs against fake model and tool backends.
+
+Runs are recorded in the event log in `STATE_DIR` (see `utils/tracing.py`).
+A replay builds the recorded agent or chain through the application's own
+registries, with a model that answers every call with the recorded reply
+and tools that return the recorded outputs, and calls it with the recorded
+inputs. With `--latency recorded` the fakes take as long as the recorded
+calls did; with `--latency zero` (the default) they answer at once, so the
+replay time is the orchestration overhead of the run. A replay whose
+prompts or tool calls diverge from the recording exits with status 1;
+prompts are not compared for runs whose inputs or tool outputs were
+recorded cut short (record with `TRACE_TOOL_OUTPUTS=true` to compare them).
+Examples, from the `backend` directory:
+
+    python -m benchmarks.replay --list --name PythonAgent
+    python -m benchmarks.replay 3f2a9c --repeat 20 --profile
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import pstats
+import sys
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import BaseTool
+
+from utils.tracing import prompt_hash
+
+
+# Registry entries of the recorded agents and chains, by run name
+COMPONENTS = {
+    "EventsAgent": ("agents", "events_agent"),
+    "PythonAgent": ("agents", "python_agent"),
+    "GitHubCommentAgent": ("agents", "github_comment_agent"),
+    "JokeChain": ("chains", "joke_chain"),
+    "AdjacentQueriesChain": ("chains", "adjacent_queries_chain"),
+    "SummaryChain": ("chains", "summary_chain"),
+    "GitHubPullRequestPatchReviewChain": ("chains", "patch_review_chain"),
+}
+
+
+def truncated(events: List[dict]) -> List[str]:
+    """The run inputs and tool outputs of a recording that were cut short."""
+    return [f"{event['name']} {key}" if event["type"] == "tool" else key
+            for event in events if event["type"] in ("start", "tool")
+            for key in event.get("truncated") or {}]
+
+
+class Recording(object):
+    """The recorded LLM replies and tool results of a run, consumed in order."""
+
+    def __init__(self, events: List[dict], latency: bool):
+        self.latency = latency
+        # Cut-short inputs or tool outputs give other prompts than recorded
+        self.check_prompts = not truncated(events)
+        self.llm_calls = [e for e in events if e["type"] == "llm" and "message" in e]
+        self.tool_calls: Dict[Tuple[str, str], List[dict]] = {}
+        for event in events:
+            if event["type"] == "tool":
+                self.tool_calls.setdefault(self._tool_key(event["name"], event["input"]),
+                                           []).append(event)
+        self.position = 0
+        self.divergences: List[str] = []
+
+    @staticmethod
+    def _tool_key(name, inputs):
+        return name, json.dumps(inputs, sort_keys=True, default=str)
+
+    def tool_names(self):
+        return sorted({name for name, _ in self.tool_calls})
+
+    def next_llm_call(self, messages) -> dict:
+        if self.position >= len(self.llm_calls):
+            raise RuntimeError("Replay made more LLM calls than were recorded")
+        event = self.llm_calls[self.position]
+        self.position += 1
+        if self.check_prompts and event.get("prompt") and prompt_hash(messages) != event["prompt"]:
+            self.divergences.append(f"prompt of LLM call {self.position} differs")
+        return event
+
+    def tool_call(self, name, inputs) -> dict:
+        calls = self.tool_calls.get(self._tool_key(name, inputs))
+        if not calls:
+            self.divergences.append(f"unrecorded {name} call: {inputs}")
+            return {"output": f"No recorded result for this {name} call", "duration": 0}
+        return calls.pop(0)
+
+
+class ReplayChatModel(BaseChatModel):
+    recording: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def bind_tools(self, tools, **kwargs):
+        # The recorded replies already hold the tool calls
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError("Replays run asynchronously")
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        event = self.recording.next_llm_call(messages)
+        if self.recording.latency:
+            await asyncio.sleep(event["duration"])
+        message = messages_from_dict([event["message"]])[0]
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class ReplayTool(BaseTool):
+    recording: Any
+    description: str = "Replays recorded tool results"
+    response_format: str = "content_and_artifact"
+
+    def _run(self, *args, **kwargs):
+        raise NotImplementedError("Replays run asynchronously")
+
+    async def _arun(self, *args, **kwargs):
+        kwargs.pop("run_manager", None)
+        event = self.recording.tool_call(self.name, kwargs)
+        if self.recording.latency:
+            await asyncio.sleep(event["duration"])
+        if event.get("error"):
+            raise RuntimeError(event["error"])
+        return event["output"], event.get("artifact")
+
+
+class ReplayModels(object):
+    """Stands in for `ModelRegistry`."""
+
+    def __init__(self, recording: Recording):
+        self.model = ReplayChatModel(recording=recording)
+
+    def get_chat_model(self, profile="default"):
+        return self.model
+
+    def get_chat_model_json(self, format="json", profile="default"):
+        return self.model
+
+    def get_embeddings(self):
+        raise NotImplementedError("Embeddings are not recorded")
+
+
+class ReplayTools(object):
+    """
+    Stands in for `ToolRegistry`. The recorded agents use a single tool, so
+    every tool getter returns a replay tool named after the recorded one.
+    """
+
+    def __init__(self, recording: Recording):
+        names = recording.tool_names()
+        if len(names) > 1:
+            raise ValueError(f"Cannot replay a run using several tools: {names}")
+        self.tool = ReplayTool(name=names[0] if names else "tool", recording=recording)
+
+    def __getattr__(self, name):
+        if name.startswith("get_") and name.endswith("_tool"):
+            return lambda: self.tool
+        raise AttributeError(name)
+
+
+async def replay(events: List[dict], latency: bool) -> Tuple[float, Recording]:
+    """Replay a run once; returns the replay time and the consumed recording."""
+    from core.agents import AgentRegistry
+    from core.chains import ChainRegistry
+
+    start_event = events[0]
+    registry, key = COMPONENTS[start_event["name"]]
+    recording = Recording(events, latency)
+    models, tools = ReplayModels(recording), ReplayTools(recording)
+    chains = ChainRegistry(models, tools)
+    component = (AgentRegistry(models, tools, chains).get_agents() if registry == "agents"
+                 else chains.get_chains())[key]
+
+    method = getattr(component, start_event["method"])
+    started = time.perf_counter()
+    if start_event["method"] == "astream":
+        async for _ in method(**start_event["inputs"]):
+            pass
+    else:
+        await method(**start_event["inputs"])
+    elapsed = time.perf_counter() - started
+
+    if recording.position < len(recording.llm_calls):
+        recording.divergences.append(
+            f"{len(recording.llm_calls) - recording.position} recorded LLM calls not made")
+    return elapsed, recording
+
+
+def summarize(events: List[dict]) -> Dict[str, float]:
+    end = events[-1] if events[-1]["type"] == "end" else {}
+    return {
+        "duration": end.get("duration", 0.0),
+        "llm": sum(e.get("duration", 0.0) for e in events if e["type"] == "llm"),
+        "tools": sum(e.get("duration", 0.0) for e in events if e["type"] == "tool"),
+        "llm_calls": sum(1 for e in events if e["type"] == "llm"),
+        "tool_calls": sum(1 for e in events if e["type"] == "tool"),
+        "tokens": sum((e.get("prompt_tokens") or 0) + (e.get("completion_tokens") or 0)
+                      for e in events if e["type"] == "llm"),
+    }
+
+
+def print_runs(runs: List[dict]):
+    print(f"{'run':<12} {'started':<19} {'name':<34} {'duration':>9} {'llm':>4} "
+          f"{'tools':>5}  error")
+    for run in runs:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["started"]))
+        print(f"{run['run_id'][:12]:<12} {started:<19} {run['name']:<34} "
+              f"{run.get('duration', 0.0):>8.2f}s {run.get('llm_calls', 0):>4} "
+              f"{run.get('tool_calls', 0):>5}  {run.get('error') or ''}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("run_id", nargs="?", help="run to replay (a prefix will do)")
+    parser.add_argument("--list", action="store_true", help="list recorded runs")
+    parser.add_argument("--name", help="only list runs of this agent or chain")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--latency", choices=["zero", "recorded"], default="zero")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="replay this many times and report the mean")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the functions taking most time in the replays")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from config import settings
+    from utils.tracing import get_run_log
+
+    log = get_run_log()
+    if args.list or not args.run_id:
+        print_runs(log.runs(args.name, args.limit))
+        return
+
+    events = log.events(args.run_id)
+    if not events:
+        sys.exit(f"No recorded run {args.run_id}")
+    name = events[0]["name"]
+    if name not in COMPONENTS:
+        sys.exit(f"Cannot replay {name} runs")
+
+    # The replays themselves must not be recorded
+    settings.TRACE_ENABLED = False
+    profiler: Optional[cProfile.Profile] = cProfile.Profile() if args.profile else None
+
+    async def run():
+        times, recording = [], None
+        for _ in range(args.repeat):
+            elapsed, recording = await replay(events, args.latency == "recorded")
+            times.append(elapsed)
+        return times, recording
+
+    if profiler is not None:
+        profiler.enable()
+    times, recording = asyncio.run(run())
+    if profiler is not None:
+        profiler.disable()
+
+    recorded = summarize(events)
+    print(f"{name} run {args.run_id}: {recorded['llm_calls']} LLM calls, "
+          f"{recorded['tool_calls']} tool calls, {recorded['tokens']} tokens")
+    print(f"  recorded: {recorded['duration']:.3f}s "
+          f"(LLM {recorded['llm']:.3f}s, tools {recorded['tools']:.3f}s)")
+    print(f"  replayed: {sum(times) / len(times):.4f}s mean, {min(times):.4f}s min "
+          f"over {len(times)} runs at {args.latency} latency")
+    if truncated(events):
+        print(f"  recorded cut short: {', '.join(truncated(events))}; prompts not compared")
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    if recording.divergences:
+        for divergence in recording.divergences:
+            print(f"  diverged: {divergence}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
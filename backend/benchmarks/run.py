@@ -0,0 +1,85 @@
+"""
+Run the offline benchmarks.
+
+Example, from the `backend` directory:
+
+    python -m benchmarks.run joke review --concurrency 1 8 --requests 40 \\
+        --output benchmarks/results/latest.json \\
+        --baseline benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import sys
+
+from .fakes import UpstreamProfile
+from .harness import (FakeEnvironment, compare_results, load_results,
+                      run_scenario, save_results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*",
+                        default=["joke", "research", "review", "events", "query"],
+                        help="scenarios to run (default: all)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=20,
+                        help="requests per scenario and concurrency level")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="upstream time to first byte, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=100.0)
+    parser.add_argument("--completion-tokens", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--pr-files", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", help="compare against a saved result file")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed relative regression (default: 0.10)")
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    profile = UpstreamProfile(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_sec=args.tokens_per_sec,
+        completion_tokens=args.completion_tokens,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    profile_summary = profile.model_dump(exclude={"seed"})
+
+    with FakeEnvironment(profile, profile, profile, num_files=args.pr_files):
+        from .scenarios import app_client, build_scenarios
+
+        results = []
+        async with app_client() as client:
+            scenarios = build_scenarios(client)
+            for name in args.scenarios:
+                for concurrency in args.concurrency:
+                    result = await run_scenario(name, scenarios[name], concurrency,
+                                                args.requests, profile_summary)
+                    print(f"{name:10s} c={concurrency:<3d} "
+                          f"p50={result.latency['p50']:9.1f}ms "
+                          f"p95={result.latency['p95']:9.1f}ms "
+                          f"p99={result.latency['p99']:9.1f}ms "
+                          f"rps={result.throughput:7.2f} "
+                          f"lag_p99={result.loop_lag['p99']:7.1f}ms "
+                          f"errors={result.errors}")
+                    results.append(result)
+
+    if args.output:
+        save_results(args.output, results)
+
+    if args.baseline:
+        regressions = compare_results(results, load_results(args.baseline),
+                                      args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,63 @@
+"""
+Benchmark scenarios.
+
+Each scenario is a coroutine factory taking the request index, so that
+requests can vary their input (and avoid hitting any cache) if needed.
+"""
+import httpx
+
+from typing import Dict
+
+from .harness import Scenario
+
+
+def build_scenarios(client: httpx.AsyncClient) -> Dict[str, Scenario]:
+    """
+    Build the scenarios. `client` must be bound to the FastAPI app, see
+    `app_client`.
+    """
+    from core.context import Context
+    from services.business_logic import (get_events, get_query_result,
+                                         get_test_result, review_github_pr)
+
+    context = Context()
+
+    async def joke(index):
+        response = await client.post("/joke", json={"text": f"benchmarks {index}"})
+        response.raise_for_status()
+
+    async def joke_batch(index):
+        items = [{"text": f"benchmarks {index}.{i}"} for i in range(10)]
+        async with client.stream("POST", "/joke/batch", json={"items": items}) as response:
+            response.raise_for_status()
+            async for _ in response.aiter_lines():
+                pass
+
+    async def research(index):
+        await get_test_result(context, f"benchmark topic {index}")
+
+    async def review(index):
+        await review_github_pr(context, "benchmark/repo", index + 1)
+
+    async def events(index):
+        await get_events(context, f"City {index}", "tomorrow")
+
+    async def query(index):
+        await get_query_result(context, f"What is {index} squared?")
+
+    return {
+        "joke": joke,
+        "joke_batch": joke_batch,
+        "research": research,
+        "review": review,
+        "events": events,
+        "query": query,
+    }
+
+
+def app_client() -> httpx.AsyncClient:
+    """HTTP client that calls the FastAPI app in-process."""
+    from main import app
+
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                             base_url="http://benchmark", timeout=None)
@@ -0,0 +1,102 @@
+"""
+Startup profiling report.
+
+Measures the import cost of `main` (via `python -X importtime` in a fresh
+interpreter), the time to build the application `Context`, and the cost of
+the first use of every registered tool, chain and agent, against the fake
+upstreams. Example, from the `backend` directory:
+
+    python -m benchmarks.startup --top 15 --output benchmarks/results/startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from . import APP_DIR
+from .fakes import UpstreamProfile
+from .harness import FakeEnvironment
+
+
+def profile_imports(module="main"):
+    """
+    Import `module` in a fresh interpreter and return the total import time
+    and the cumulative import time per top-level package, in seconds.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=APP_DIR, env=dict(os.environ), capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    packages = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        cumulative = int(cumulative) / 1e6
+        if name.strip() == module:
+            total = cumulative
+        root = name.strip().split(".")[0]
+        # Importtime lists a package after its submodules, so the largest
+        # entry for a root is the cumulative cost of its first import
+        packages[root] = max(packages.get(root, 0.0), cumulative)
+    packages.pop(module, None)
+    return total, packages
+
+
+def profile_first_use():
+    """Time building the Context and the first use of each registry entry."""
+    profile = UpstreamProfile(latency=0.0)
+    timings = {}
+    with FakeEnvironment(profile, profile, profile):
+        start = time.perf_counter()
+        from core.context import Context
+        timings["import core.context"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        context = Context()
+        timings["Context()"] = time.perf_counter() - start
+
+        for kind, registry in (("tool", context.tools.get_tools()),
+                               ("chain", context.chains.get_chains()),
+                               ("agent", context.agents.get_agents())):
+            for name in registry:
+                start = time.perf_counter()
+                registry[name]
+                timings[f"{kind} {name}"] = time.perf_counter() - start
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup profiling report")
+    parser.add_argument("--top", type=int, default=15,
+                        help="number of packages to list (default: 15)")
+    parser.add_argument("--output", help="write the report as JSON to this path")
+    args = parser.parse_args(argv)
+
+    total, packages = profile_imports()
+    first_use = profile_first_use()
+
+    print(f"import main: {total * 1000:8.1f}ms")
+    print(f"\nTop {args.top} packages by cumulative import time:")
+    for name, seconds in sorted(packages.items(), key=lambda p: -p[1])[:args.top]:
+        print(f"  {name:30s} {seconds * 1000:8.1f}ms")
+    print("\nConstruction on first use:")
+    for name, seconds in first_use.items():
+        print(f"  {name:45s} {seconds * 1000:8.1f}ms")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"import_main": total, "packages": packages,
+                       "first_use": first_use}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
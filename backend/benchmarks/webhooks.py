@@ -0,0 +1,99 @@
+"""
+Replay GitHub webhook deliveries against a running backend.
+
+Deliveries are signed with `GITHUB_WEBHOOK_SECRET` (or `--secret`) like
+GitHub does and posted to the webhook endpoint. They are read from files
+holding either one payload (the event type is then taken from `--event`)
+or recordings of the form `{"event": ..., "payload": ...}`, one JSON
+document per file or per line. `--pushes` instead generates a burst of
+`synchronize` events for one pull request, to observe the debouncing.
+Examples, from the `backend` directory:
+
+    python -m benchmarks.webhooks recorded/*.json --interval 0.5
+    python -m benchmarks.webhooks --pushes 10 --repo owner/repo --pr 1
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import uuid
+
+import httpx
+
+
+def load_deliveries(paths, event):
+    deliveries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        try:
+            documents = [json.loads(text)]
+        except json.JSONDecodeError:
+            documents = [json.loads(line) for line in text.splitlines() if line.strip()]
+        for document in documents:
+            if "event" in document and "payload" in document:
+                deliveries.append((document["event"], document["payload"]))
+            else:
+                deliveries.append((event, document))
+    return deliveries
+
+
+def synthetic_pushes(repo, pr_number, count):
+    return [("pull_request", {
+        "action": "synchronize",
+        "number": pr_number,
+        "pull_request": {"number": pr_number, "draft": False,
+                         "head": {"sha": hashlib.sha1(f"{repo}{pr_number}{i}".encode())
+                                  .hexdigest()}},
+        "repository": {"full_name": repo},
+    }) for i in range(count)]
+
+
+def deliver(client, url, secret, event, payload):
+    body = json.dumps(payload).encode("utf-8")
+    signature = "sha256=" + hmac.new(secret.encode("utf-8"), body,
+                                     hashlib.sha256).hexdigest()
+    return client.post(url, content=body, headers={
+        "Content-Type": "application/json",
+        "X-GitHub-Event": event,
+        "X-GitHub-Delivery": str(uuid.uuid4()),
+        "X-Hub-Signature-256": signature,
+    })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("files", nargs="*", help="recorded deliveries")
+    parser.add_argument("--url", default="http://localhost:8000/github/webhook")
+    parser.add_argument("--secret", default=os.getenv("GITHUB_WEBHOOK_SECRET"))
+    parser.add_argument("--event", default="pull_request",
+                        help="event type of files holding a bare payload")
+    parser.add_argument("--interval", type=float, default=0.0,
+                        help="seconds between deliveries")
+    parser.add_argument("--pushes", type=int, default=0,
+                        help="generate this many synchronize events instead")
+    parser.add_argument("--repo", default="owner/repo")
+    parser.add_argument("--pr", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.secret:
+        sys.exit("Set GITHUB_WEBHOOK_SECRET or pass --secret")
+    deliveries = (synthetic_pushes(args.repo, args.pr, args.pushes) if args.pushes
+                  else load_deliveries(args.files, args.event))
+
+    with httpx.Client(timeout=30) as client:
+        for i, (event, payload) in enumerate(deliveries):
+            if i and args.interval:
+                time.sleep(args.interval)
+            response = deliver(client, args.url, args.secret, event, payload)
+            print(f"{event:<14} {response.status_code} {response.text}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The application modules import each other by top-level name, as they do
+# when run from `backend/backend`; state goes to a scratch directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "backend")]
+os.environ.setdefault("STATE_DIR", tempfile.mkdtemp(prefix="backend-tests-"))
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import tool
+
+from core.agents import AgentRuntime, MemoizingTool
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Answers with the given messages in turn, after `delay` seconds each."""
+
+    replies: list
+    delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        return ChatResult(generations=[ChatGeneration(message=self.replies.pop(0))])
+
+
+def lookup_call(call_id, query="x"):
+    return AIMessage("", tool_calls=[{"name": "lookup", "args": {"query": query},
+                                      "id": call_id}])
+
+
+def counting_tool():
+    calls = []
+
+    @tool
+    async def lookup(query: str) -> str:
+        """Look something up."""
+        calls.append(query)
+        return f"result for {query}"
+
+    return lookup, calls
+
+
+def test_identical_tool_calls_run_once():
+    lookup, calls = counting_tool()
+    model = ScriptedChatModel(replies=[lookup_call("1"), lookup_call("2"), lookup_call("3", "y"),
+                                       AIMessage("done")])
+    runtime = AgentRuntime("test", model, [lookup], max_steps=10, max_repeats=5)
+    messages = asyncio.run(runtime.ainvoke([]))["messages"]
+    assert calls == ["x", "y"]
+    answers = [(m.tool_call_id, m.content) for m in messages if m.type == "tool"]
+    assert answers == [("1", "result for x"), ("2", "result for x"), ("3", "result for y")]
+    assert messages[-1].content == "done"
+    # Outside of agent runs, every call runs
+    asyncio.run(MemoizingTool(lookup).ainvoke({"name": "lookup", "args": {"query": "x"},
+                                               "id": "4", "type": "tool_call"}))
+    assert calls == ["x", "y", "x"]
+
+
+def test_stopped_run_gets_a_final_answer():
+    lookup, calls = counting_tool()
+    model = ScriptedChatModel(replies=[lookup_call("1"), lookup_call("2"), lookup_call("3"),
+                                       AIMessage("best effort")])
+    runtime = AgentRuntime("test", model, [lookup], max_steps=10, max_repeats=2)
+    messages = asyncio.run(runtime.ainvoke([]))["messages"]
+    assert calls == ["x"]
+    assert messages[-1].content == "best effort"
+
+
+def test_final_answer_is_bounded():
+    lookup, _ = counting_tool()
+    model = ScriptedChatModel(replies=[lookup_call("1"), AIMessage("late")], delay=0.2)
+    runtime = AgentRuntime("test", model, [lookup], max_steps=1, timeout=1.0,
+                           final_answer_timeout=0.05)
+    with pytest.raises(TimeoutError):
+        asyncio.run(runtime.ainvoke([]))
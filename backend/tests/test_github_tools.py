@@ -0,0 +1,75 @@
+import types
+
+from core.tools import GitHubCommentTool, GitHubPullRequestPatchCommentTool
+
+
+class FakeAPI(object):
+    """The GitHub API calls of the patch comment tool, against a list of comments."""
+
+    def __init__(self, comments=(), head="head-sha"):
+        self.comments = list(comments)
+        self.head = head
+
+    def get(self, url, name, revalidate=True):
+        return {"head": {"sha": self.head}}, None
+
+    def iter_all(self, url, name, revalidate=True):
+        return iter(self.comments)
+
+    def post(self, url, name, payload):
+        self.comments.append(dict(payload, original_line=payload["line"]))
+        return types.SimpleNamespace(is_success=True, json=lambda: {"html_url": "url"})
+
+
+def patch_comment_tool(api):
+    tool = GitHubPullRequestPatchCommentTool("token")
+    tool._api = api
+    return tool
+
+
+def test_patch_comment_is_posted_once():
+    api = FakeAPI()
+    tool = patch_comment_tool(api)
+    assert tool.add_patch_comment("o/r", 1, "Check for None", "a.py", 3)["status"] == "success"
+    assert tool.add_patch_comment("o/r", 1, "Check for None ", "a.py", 3)["status"] == "duplicate"
+    assert tool.add_patch_comment("o/r", 1, "Check for None", "a.py", 4)["status"] == "success"
+    assert tool.add_patch_comment("o/r", 1, "Check for None", "b.py", 3)["status"] == "success"
+    assert len(api.comments) == 3
+
+
+def test_comments_of_earlier_reviews_are_skipped():
+    # A comment on an earlier commit, whose line has moved since
+    api = FakeAPI([{"path": "a.py", "line": 12, "original_line": 10, "body": "Typo"}])
+    tool = patch_comment_tool(api)
+    posted = tool.posted_comments("o/r", 1)
+    for line in (10, 12):
+        assert tool.add_patch_comment("o/r", 1, "Typo", "a.py", line, posted)["status"] \
+            == "duplicate"
+    assert tool.add_patch_comment("o/r", 1, "Typo", "a.py", 20, posted)["status"] == "success"
+    assert ("a.py", 20, "Typo") in posted
+
+
+def test_patch_comment_is_posted_on_the_reviewed_commit():
+    api = FakeAPI(head="pushed-meanwhile")
+    tool = patch_comment_tool(api)
+    tool.add_patch_comment("o/r", 1, "Typo", "a.py", 3, commit_id="reviewed")
+    tool.add_patch_comment("o/r", 1, "Typo", "a.py", 4)
+    assert [c["commit_id"] for c in api.comments] == ["reviewed", "pushed-meanwhile"]
+
+
+def test_comment_duplicates():
+    earlier = {"body": "Please add a test for `parse_args()`.", "url": "u", "user": "bot"}
+    find = GitHubCommentTool._find_duplicate
+    assert find("please add a test for parse_args", [earlier], "bot") is earlier
+    assert find("Please add a test for parse_args() here.", [earlier], "bot") is earlier
+    assert find("Looks good to me", [earlier], "bot") is None
+    # Someone else's comment is not ours to skip, unless the login is not known
+    assert find("Please add a test for parse_args()", [earlier], "someone") is None
+    assert find("Please add a test for parse_args()", [earlier], None) is earlier
+
+
+def test_comments_on_other_numbers_are_not_duplicates():
+    earlier = {"body": "Line 12 does not close the file", "url": "u", "user": "bot"}
+    find = GitHubCommentTool._find_duplicate
+    assert find("Line 12 does not close the file.", [earlier], "bot") is earlier
+    assert find("Line 13 does not close the file", [earlier], "bot") is None
@@ -0,0 +1,32 @@
+import logging
+import queue
+
+from utils.logger import DeferredQueueHandler, truncate
+
+
+def queued(msg, *args):
+    """A record as the listener thread gets it."""
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.handle(logging.LogRecord("test", logging.INFO, __file__, 1, msg, args, None))
+    return records.get_nowait()
+
+
+def test_records_are_formatted_as_they_were_logged():
+    responses = ["first"]
+    record = queued("Responses: %s, payload %s", responses, truncate(responses, 100))
+    responses.append("second")
+    assert record.getMessage() == "Responses: ['first'], payload ['first']"
+
+
+def test_immutable_arguments_are_formatted_by_the_listener():
+    payload = truncate("x" * 100, 10)
+    record = queued("%s %d %s", "name", 3, payload)
+    assert record.args == ("name", 3, payload)
+    assert record.getMessage() == "name 3 xxxxxxxxxx... [90 chars truncated]"
+
+
+def test_large_payloads_are_cut_before_they_are_rendered():
+    assert str(truncate(list(range(10 ** 6)), 50)) == "[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, ...]"
+    assert str(truncate({"a": "b" * 1000}, 20)) == "{'a': 'bbbbbbb...bbb... [truncated]"
+    assert str(truncate([1, 2], 20)) == "[1, 2]"
@@ -0,0 +1,86 @@
+import pytest
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api import quotas
+from api.quotas import QuotaMiddleware
+from config import settings
+from utils.ratelimit import RateLimiter
+from utils.store import SharedStore
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    # One request unit per second, and one LLM token per second
+    return RateLimiter(SharedStore(str(tmp_path / "store.sqlite3")), request_rate=60,
+                       request_burst=10, token_rate=60, token_burst=100)
+
+
+@pytest.fixture
+def client(limiter, monkeypatch):
+    monkeypatch.setenv("API_KEYS", "alice:alice-key,bob:bob-key")
+    monkeypatch.setattr(settings, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(settings, "RATE_LIMIT_COSTS", {"/joke": 1, "/joke/batch": 1})
+    monkeypatch.setattr(quotas, "get_rate_limiter", lambda: limiter)
+    app = FastAPI()
+
+    @app.post("/joke")
+    async def joke():
+        return {"response": "joke"}
+
+    @app.post("/joke/batch")
+    async def jokes(body: dict):
+        return {"responses": ["joke"] * len(body["items"])}
+
+    app.add_middleware(QuotaMiddleware)
+    return TestClient(app)
+
+
+def post(client, path, key, json=None):
+    return client.post(path, json=json or {}, headers={"X-API-Key": key})
+
+
+def test_bucket_refills_over_time(limiter, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.ratelimit.time.time", lambda: now[0])
+    assert limiter.acquire("alice", 10) == 0
+    assert limiter.acquire("alice", 2) == pytest.approx(2)
+    now[0] += 2
+    assert limiter.acquire("alice", 2) == 0
+    # Token debt blocks requests until it is paid off
+    limiter.charge("alice", 160)
+    assert limiter.acquire("alice", 1) == pytest.approx(60)
+    now[0] += 60
+    assert limiter.acquire("alice", 1) == 0
+
+
+def test_requests_are_limited_per_user(client):
+    for _ in range(10):
+        assert post(client, "/joke", "alice-key").status_code == 200
+    response = post(client, "/joke", "alice-key")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert post(client, "/joke", "bob-key").status_code == 200
+
+
+def test_unknown_key_is_refused(client):
+    assert post(client, "/joke", "mallory-key").status_code == 401
+    assert client.post("/joke").status_code == 401
+
+
+def test_large_batch_is_served_and_leaves_debt(client):
+    # 100 items cost 100 units: admitted with the 10 units of a full bucket,
+    # then 90 units in debt, paid off at one unit per second
+    response = post(client, "/joke/batch", "alice-key", {"items": ["x"] * 100})
+    assert response.status_code == 200
+    assert len(response.json()["responses"]) == 100
+    response = post(client, "/joke/batch", "alice-key", {"items": ["x"]})
+    assert response.status_code == 429
+    assert 90 <= int(response.headers["Retry-After"]) <= 91
+
+
+def test_open_without_keys(client, monkeypatch):
+    monkeypatch.setenv("API_KEYS", "")
+    for _ in range(20):
+        assert client.post("/joke").status_code == 200
@@ -0,0 +1,110 @@
+import asyncio
+
+import httpx
+import pytest
+
+from utils import resilience
+from utils.resilience import CircuitBreaker, CircuitOpenError, Upstream
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    return clock
+
+
+def open_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes_the_breaker(clock):
+    breaker = open_breaker()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # One trial at a time
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_trial_reopens_the_breaker(clock):
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_trial_without_outcome_makes_way(clock):
+    breaker = open_breaker()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    # A trial that hangs is given up after the reset timeout
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+class HangingTransport(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        await asyncio.Event().wait()
+
+
+def test_cancelled_trial_is_released(clock):
+    upstream = Upstream("test", timeout=5, retries=0)
+    transport = upstream.transport()
+    transport._async = HangingTransport()
+    breaker = upstream.breaker
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    request = httpx.Request("GET", "http://upstream/")
+
+    async def main():
+        with pytest.raises(CircuitOpenError):
+            await transport.handle_async_request(request)
+        clock.now += breaker.reset_timeout
+        trial = asyncio.create_task(transport.handle_async_request(request))
+        await asyncio.sleep(0)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    asyncio.run(main())
+    # The next call is the trial, rather than waiting out the reset timeout
+    assert breaker.allow()
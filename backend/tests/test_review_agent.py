@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+import pytest
+
+from core.agents import GitHubPullRequestReviewAgent
+
+
+class FakeFilesTool(object):
+    """Yields files whose fetches take a while, counting the unfinished iterations."""
+
+    def __init__(self, count):
+        self.count = count
+        self.open = 0
+
+    def iter_pr_files(self, repo, pr_number, contents=True, revalidate=True):
+        self.open += 1
+        try:
+            for number in range(self.count):
+                # Long enough for the review of the previous file to fail
+                threading.Event().wait(0.05)
+                yield {"filename": f"{number}.py", "sha": str(number), "status": "modified",
+                       "ref": "head", "contents": "", "hunks": [(1, 2, "@@\n", "+x")]}
+        finally:
+            self.open -= 1
+
+
+class FailingChain(object):
+    async def ainvoke(self, *args):
+        raise RuntimeError("model is down")
+
+
+class FakeCommentTool(object):
+    def posted_comments(self, repo, pr_number):
+        return set()
+
+
+def test_failed_review_waits_for_the_fetch_and_closes_the_files():
+    files = FakeFilesTool(3)
+    agent = GitHubPullRequestReviewAgent(None, files, FailingChain(), FakeCommentTool())
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await agent.ainvoke("o/r", 1)
+        # Nothing is left running in the background
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(main())
+    assert files.open == 0
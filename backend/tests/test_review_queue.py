@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import types
+import urllib.parse
+
+import pytest
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.routes import api_router
+from benchmarks.webhooks import deliver, synthetic_pushes
+from services import review_queue
+from services.review_queue import ReviewQueue
+
+SECRET = "test-secret"
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    queue = ReviewQueue(str(tmp_path / "reviews.sqlite3"), debounce=0, concurrency=1,
+                        lease=0.2, max_attempts=3)
+    monkeypatch.setattr(review_queue, "_queue", queue)
+    return queue
+
+
+@pytest.fixture
+def client(queue, monkeypatch):
+    monkeypatch.setenv("GITHUB_WEBHOOK_SECRET", SECRET)
+    app = FastAPI()
+    app.include_router(api_router)
+    return TestClient(app)
+
+
+def post(client, event, body, content_type):
+    signature = "sha256=" + hmac.new(SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return client.post("/github/webhook", content=body, headers={
+        "Content-Type": content_type,
+        "X-GitHub-Event": event,
+        "X-Hub-Signature-256": signature,
+    })
+
+
+def queued(queue):
+    return queue._connection().execute(
+        "SELECT repo, pr_number, head FROM reviews").fetchall()
+
+
+def test_push_is_queued(client, queue):
+    [(event, payload)] = synthetic_pushes("owner/repo", 1, 1)
+    response = deliver(client, "/github/webhook", SECRET, event, payload)
+    assert response.status_code == 202
+    assert response.json() == {"status": "queued"}
+    assert queued(queue) == [("owner/repo", 1, payload["pull_request"]["head"]["sha"])]
+
+
+def test_burst_of_pushes_is_coalesced(client, queue):
+    pushes = synthetic_pushes("owner/repo", 1, 5)
+    statuses = [deliver(client, "/github/webhook", SECRET, event, payload).json()["status"]
+                for event, payload in pushes]
+    assert statuses == ["queued"] + ["coalesced"] * 4
+    assert queued(queue) == [("owner/repo", 1, pushes[-1][1]["pull_request"]["head"]["sha"])]
+
+
+def test_form_encoded_delivery(client, queue):
+    [(event, payload)] = synthetic_pushes("owner/repo", 2, 1)
+    body = urllib.parse.urlencode({"payload": json.dumps(payload)}).encode("utf-8")
+    response = post(client, event, body, "application/x-www-form-urlencoded")
+    assert response.status_code == 202
+    assert response.json() == {"status": "queued"}
+
+
+@pytest.mark.parametrize("payload", [
+    {"action": "synchronize", "repository": {"full_name": "owner/repo"},
+     "pull_request": {"number": 1}},
+    {"action": "synchronize", "repository": {"full_name": "owner/repo"}},
+    [],
+])
+def test_malformed_payload_is_rejected(client, queue, payload):
+    response = deliver(client, "/github/webhook", SECRET, "pull_request", payload)
+    assert response.status_code == 400
+    assert queued(queue) == []
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (b"{not json", "application/json"),
+    (b"action=synchronize", "application/x-www-form-urlencoded"),
+])
+def test_undecodable_body_is_rejected(client, queue, body, content_type):
+    assert post(client, "pull_request", body, content_type).status_code == 400
+
+
+def test_timed_out_review_is_cancelled(queue):
+    cancelled = asyncio.Event()
+
+    class StuckAgent(object):
+        async def ainvoke(self, repo, pr_number):
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+    context = types.SimpleNamespace(agents=types.SimpleNamespace(
+        get_agents=lambda: {"github_pullrequest_patch_review_agent": StuckAgent()}))
+
+    async def run():
+        queue.enqueue("owner/repo", 1, "a" * 40)
+        # Retry only well after the test
+        queue.debounce = 60
+        worker = asyncio.create_task(queue.work(context, poll_interval=0.01))
+        try:
+            await asyncio.wait_for(cancelled.wait(), 5)
+            # The failed review is rescheduled, not left claimed
+            while reviewing():
+                await asyncio.sleep(0.01)
+        finally:
+            worker.cancel()
+
+    def reviewing():
+        return queue._connection().execute("SELECT reviewing FROM reviews").fetchone()[0]
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert queue._connection().execute("SELECT attempts FROM reviews").fetchone() == (1,)
@@ -0,0 +1,78 @@
+import asyncio
+import hashlib
+
+import numpy as np
+import pytest
+
+from langchain_core.embeddings import Embeddings
+
+from core.semantic_cache import SemanticCache
+
+
+class WordEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings: similar wording, similar vectors."""
+
+    def embed_query(self, text):
+        vector = np.zeros(64)
+        for word in text.casefold().replace("?", "").split():
+            vector[int(hashlib.sha256(word.encode()).hexdigest(), 16) % 64] += 1
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+@pytest.fixture
+def cache():
+    return SemanticCache(WordEmbeddings(), threshold=0.9,
+                         ttl={"query": 3600, "events": 3600}, max_entries=100)
+
+
+def ask(cache, namespace, text):
+    """The answer for `text`, and whether it was computed rather than cached."""
+    computed = []
+
+    async def compute():
+        computed.append(text)
+        return f"answer to {text}"
+
+    answer = asyncio.run(cache.cached(namespace, text, compute))
+    return answer, bool(computed)
+
+
+def test_repeat_is_a_hit(cache):
+    assert ask(cache, "query", "what is the capital of france") == \
+        ("answer to what is the capital of france", True)
+    assert ask(cache, "query", "What is the capital of France?") == \
+        ("answer to what is the capital of france", False)
+
+
+def test_different_question_is_a_miss(cache):
+    ask(cache, "query", "what is the capital of france")
+    assert ask(cache, "query", "who wrote the iliad") == ("answer to who wrote the iliad", True)
+
+
+def test_similarity_below_threshold_is_a_miss(cache):
+    ask(cache, "query", "what is the capital of france")
+    # One word in six differs: a cosine similarity of 5/6, below 0.9
+    assert ask(cache, "query", "what is the capital of spain")[1]
+
+
+def test_different_numbers_are_a_miss(cache):
+    ask(cache, "query", "what is the population of the 10 largest cities in europe")
+    assert ask(cache, "query", "what is the population of the 20 largest cities in europe") \
+        == ("answer to what is the population of the 20 largest cities in europe", True)
+
+
+def test_different_dates_are_a_miss(cache):
+    ask(cache, "events", "music and art festivals in the city of paris | 2025-05-03")
+    assert ask(cache, "events", "music and art festivals in the city of paris | 2025-05-04")[1]
+    ask(cache, "events", "music and art festivals in the city of paris | next saturday")
+    assert ask(cache, "events", "music and art festivals in the city of paris | next sunday")[1]
+    assert not ask(cache, "events",
+                   "Music and art festivals in the city of Paris | next Saturday")[1]
+
+
+def test_namespaces_are_separate(cache):
+    ask(cache, "query", "what is the capital of france")
+    assert ask(cache, "events", "what is the capital of france")[1]
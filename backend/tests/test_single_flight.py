@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from services import business_logic
+from services.business_logic import _single_flight
+
+
+class Work(object):
+    """A computation that runs until released, counting its runs and cancellations."""
+
+    def __init__(self):
+        self.runs = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.runs += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return self.runs
+
+
+def run(coroutine):
+    asyncio.run(asyncio.wait_for(coroutine, 5))
+    assert not business_logic._in_flight and not business_logic._waiters
+
+
+def test_concurrent_callers_share_one_run():
+    async def main():
+        work = Work()
+        callers = [asyncio.create_task(_single_flight(("test", "x"), work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        work.release.set()
+        assert await asyncio.gather(*callers) == [1, 1, 1]
+        assert work.runs == 1
+
+    run(main())
+
+
+def test_work_goes_on_while_a_caller_waits():
+    async def main():
+        work = Work()
+        first = asyncio.create_task(_single_flight(("test", "x"), work))
+        second = asyncio.create_task(_single_flight(("test", "x"), work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        work.release.set()
+        assert await second == 1
+        assert (work.runs, work.cancelled) == (1, 0)
+
+    run(main())
+
+
+def test_work_is_cancelled_when_the_last_caller_leaves():
+    async def main():
+        work = Work()
+        callers = [asyncio.create_task(_single_flight(("test", "x"), work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert work.cancelled == 1
+        # A later caller starts afresh
+        work.release.set()
+        assert await _single_flight(("test", "x"), work) == 2
+
+    run(main())
+
+
+def test_errors_are_shared():
+    async def main():
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        callers = [asyncio.create_task(_single_flight(("test", "x"), fail)) for _ in range(2)]
+        for caller in callers:
+            with pytest.raises(ValueError):
+                await caller
+
+    run(main())
+
+
+def test_reviews_of_different_heads_are_separate():
+    reviews = []
+
+    class Agent(object):
+        async def ainvoke(self, repo, pr_number):
+            reviews.append((repo, pr_number))
+            await asyncio.sleep(0.01)
+            return []
+
+    class Agents(object):
+        def get_agents(self):
+            return {"github_pullrequest_patch_review_agent": Agent()}
+
+    context = type("Context", (object,), {"agents": Agents()})()
+
+    async def main():
+        await asyncio.gather(
+            business_logic.review_github_pr(context, "o/r", 1, timeout=1, head="a"),
+            business_logic.review_github_pr(context, "O/r", 1, timeout=1, head="a"),
+            business_logic.review_github_pr(context, "o/r", 1, timeout=1, head="b"))
+
+    run(main())
+    assert len(reviews) == 2